@@ -0,0 +1,397 @@
+"""Stock analytics over goods and shops_goods, computed by NumPy chunk by chunk.
+
+Rows of shops_goods joined with package parameters of their goods are fetched by fetchmany into
+column arrays of at most chunk_size rows. Every report is an aggregate updated by vectorized
+operations on one chunk at a time, so memory doesn't grow with the catalogue:
+
+- stock by location: goods, amount and footprint (amount × package_height × package_width)
+  summed by np.bincount on codes of locations;
+- exact percentiles of stock of a good in a shop and of total stock of goods: counts of distinct
+  amounts are merged chunk by chunk, and there are far fewer of them than rows;
+- top-N shortages: goods with the smallest total stock, candidates of every chunk are merged
+  with the N found so far.
+
+Rows are read in the order of goods in one read transaction, so every report describes one
+snapshot, and totals of a good split between two chunks are carried over to the next one.
+
+NumPy is needed only by this module and isn't installed with the rest: pip install numpy.
+
+Usage: python analytics.py --db goods.db [--top 10] [--percentiles 50 95 99] [--chunk-size 100000]
+"""
+import argparse
+import sys
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
+from operator import itemgetter
+from sqlite3.dbapi2 import Connection, Cursor
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import main
+
+try:
+    import numpy as np
+except ImportError:  # stock_report and iter_stock_chunks raise a clear ImportError, see require_numpy
+    np = None  # type: ignore
+
+DEFAULT_CHUNK_SIZE = 100_000
+DEFAULT_TOP = 10
+DEFAULT_PERCENTILES = (5.0, 25.0, 50.0, 75.0, 95.0, 99.0)
+
+
+def require_numpy() -> None:
+    """Raise ImportError telling how to install NumPy if it isn't installed."""
+    if np is None:
+        raise ImportError("Stock analytics needs NumPy, install it by: pip install numpy")
+
+
+@dataclass
+class StockChunk:
+    """Rows of shops_goods as column arrays, in the order of goods.
+
+    Attributes:
+        id_good: Ids of goods.
+        location: Codes of locations, see iter_stock_chunks.
+        amount: Amounts of goods in locations.
+        footprint: package_height × package_width of goods.
+    """
+
+    id_good: "np.ndarray"
+    location: "np.ndarray"
+    amount: "np.ndarray"
+    footprint: "np.ndarray"
+
+
+class GoodStock(NamedTuple):
+    """Total stock of goods as column arrays."""
+
+    id_good: "np.ndarray"
+    amount: "np.ndarray"
+    locations: "np.ndarray"
+
+
+def iter_stock_chunks(
+    cursor: Cursor, locations: Dict[int, str], chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[StockChunk]:
+    """Yield rows of shops_goods with package parameters of their goods as column arrays, in the order of goods.
+
+    Args:
+        cursor: Database Cursor object, used by the generator until it's exhausted.
+        locations: Names of locations by their codes in chunks, filled by the generator as they appear.
+        chunk_size: Number of rows fetched at once and held in a chunk.
+
+    Yields:
+        Chunks of at most chunk_size rows.
+
+    Raises:
+        ImportError: If NumPy isn't installed.
+    """
+    require_numpy()
+    codes: Optional[Dict[str, int]] = None
+    if main.is_normalized(cursor):
+        # Locations are coded by ids of the normalized layout, the shops_goods view would only decode them.
+        locations.update(cursor.execute("SELECT id, name FROM locations").fetchall())
+        cursor.execute(
+            """SELECT id_good, id_location, amount, package_height * package_width
+               FROM stock JOIN goods ON goods.id = stock.id_good ORDER BY id_good"""
+        )
+    else:
+        codes = {name: code for code, name in locations.items()}
+        cursor.execute(
+            """SELECT id_good, location, amount, package_height * package_width
+               FROM shops_goods JOIN goods ON goods.id = shops_goods.id_good ORDER BY id_good"""
+        )
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        # Columns are read straight into arrays, transposing rows by zip(*rows) would take longer than the rest.
+        location = map(itemgetter(1), rows)
+        if codes is not None:
+            for name in set(map(itemgetter(1), rows)).difference(codes):
+                codes[name] = len(codes)
+                locations[codes[name]] = name
+            location = map(codes.__getitem__, location)
+        yield StockChunk(
+            np.fromiter(map(itemgetter(0), rows), np.int64, len(rows)),
+            np.fromiter(location, np.intp, len(rows)),
+            np.fromiter(map(itemgetter(2), rows), np.int64, len(rows)),
+            np.fromiter(map(itemgetter(3), rows), np.float64, len(rows)),
+        )
+
+
+class ValueCounts:
+    """Counts of distinct values merged chunk by chunk, they give exact percentiles of all values."""
+
+    def __init__(self) -> None:
+        """Start with nothing counted."""
+        self.values = np.zeros(0, np.int64)
+        self.counts = np.zeros(0, np.int64)
+
+    def add(self, values: "np.ndarray") -> None:
+        """Count values of a chunk."""
+        chunk_values, chunk_counts = np.unique(values, return_counts=True)
+        self.values, inverse = np.unique(np.concatenate((self.values, chunk_values)), return_inverse=True)
+        counts = np.zeros(len(self.values), np.int64)
+        np.add.at(counts, inverse, np.concatenate((self.counts, chunk_counts)))
+        self.counts = counts
+
+    def percentiles(self, percentiles: Sequence[float]) -> Dict[float, int]:
+        """Return percentiles of counted values by the nearest-rank method, none if nothing is counted.
+
+        The p-th percentile of n values is the value at rank ceil(p * n / 100) in sorted values, the
+        0-th one is the smallest value. Every percentile is one of the values, none is interpolated.
+        """
+        if not len(self.counts):
+            return {}
+        cumulative = np.cumsum(self.counts)
+        ranks = np.maximum(np.ceil(np.asarray(percentiles, np.float64) * cumulative[-1] / 100), 1)
+        return {
+            percentile: int(self.values[index])
+            for percentile, index in zip(percentiles, np.searchsorted(cumulative, ranks))
+        }
+
+
+class LocationTotals:
+    """Goods, amounts and footprints of stock summed by location codes chunk by chunk."""
+
+    def __init__(self) -> None:
+        """Start with no locations."""
+        self.goods = np.zeros(0, np.int64)
+        self.amount = np.zeros(0, np.int64)
+        self.footprint = np.zeros(0, np.float64)
+
+    def add(self, chunk: StockChunk) -> None:
+        """Add stock of a chunk."""
+        size = max(len(self.goods), int(chunk.location.max()) + 1)
+        self.goods = _grow(self.goods, size) + np.bincount(chunk.location, minlength=size)
+        # Weights are summed as float64, which is exact for integer amounts up to 2**53.
+        amount = np.bincount(chunk.location, weights=chunk.amount, minlength=size)
+        self.amount = _grow(self.amount, size) + np.rint(amount).astype(np.int64)
+        self.footprint = _grow(self.footprint, size) + np.bincount(
+            chunk.location, weights=chunk.amount * chunk.footprint, minlength=size
+        )
+
+
+def _grow(totals: "np.ndarray", size: int) -> "np.ndarray":
+    """Pad totals with zeros for locations which appeared in a later chunk."""
+    return np.concatenate((totals, np.zeros(size - len(totals), totals.dtype)))
+
+
+class GoodTotals:
+    """Total stock of goods from chunks in the order of goods.
+
+    The last good of a chunk may continue in the next one, so its totals are held back until then.
+    """
+
+    def __init__(self) -> None:
+        """Start with nothing carried."""
+        self._carry: Optional[Tuple[int, int, int]] = None
+
+    def add(self, chunk: StockChunk) -> GoodStock:
+        """Return totals of goods of a chunk which are complete, with the one carried from the previous chunk."""
+        starts = np.flatnonzero(np.concatenate(([True], chunk.id_good[1:] != chunk.id_good[:-1])))
+        id_good = chunk.id_good[starts]
+        amount = np.add.reduceat(chunk.amount, starts)
+        locations = np.diff(np.append(starts, len(chunk.id_good)))
+        if self._carry is not None:
+            carried_id, carried_amount, carried_locations = self._carry
+            if carried_id == id_good[0]:
+                amount[0] += carried_amount
+                locations[0] += carried_locations
+            else:
+                id_good = np.insert(id_good, 0, carried_id)
+                amount = np.insert(amount, 0, carried_amount)
+                locations = np.insert(locations, 0, carried_locations)
+        self._carry = (int(id_good[-1]), int(amount[-1]), int(locations[-1]))
+        return GoodStock(id_good[:-1], amount[:-1], locations[:-1])
+
+    def finish(self) -> GoodStock:
+        """Return totals of the good held back from the last chunk."""
+        carried = () if self._carry is None else (self._carry,)
+        self._carry = None
+        return GoodStock(*(np.array(column, np.int64) for column in zip(*carried))) if carried else _no_goods()
+
+
+def _no_goods() -> GoodStock:
+    return GoodStock(np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64))
+
+
+class Shortages:
+    """Goods with the smallest total stock found so far, the ones with smaller ids first among equal stock."""
+
+    def __init__(self, top: int) -> None:
+        """Start with no shortages, at most top of them are kept."""
+        self.top = top
+        self.goods = _no_goods()
+
+    def add(self, goods: GoodStock) -> None:
+        """Merge totals of goods of a chunk with the shortages found so far."""
+        merged = [np.concatenate(columns) for columns in zip(self.goods, goods)]
+        order = np.lexsort((merged[0], merged[1]))[: self.top]
+        self.goods = GoodStock(*(column[order] for column in merged))
+
+
+@dataclass
+class LocationStock:
+    """Stock of a location."""
+
+    location: str
+    goods: int
+    amount: int
+    footprint: float
+
+
+@dataclass
+class Shortage:
+    """A good with one of the smallest total stocks."""
+
+    id_good: int
+    name: str
+    amount: int
+    locations: int
+
+
+@dataclass
+class StockReport:
+    """Reports of stock computed by stock_report.
+
+    Attributes:
+        rows: Number of rows of shops_goods.
+        goods: Number of goods with shops.
+        locations: Stock of locations, the ones with larger footprints first.
+        shop_percentiles: Percentiles of stock of a good in a shop.
+        good_percentiles: Percentiles of total stock of goods.
+        shortages: Goods with the smallest total stock, the smallest first.
+        elapsed: Seconds taken by the reports.
+    """
+
+    rows: int = 0
+    goods: int = 0
+    locations: List[LocationStock] = field(default_factory=list)
+    shop_percentiles: Dict[float, int] = field(default_factory=dict)
+    good_percentiles: Dict[float, int] = field(default_factory=dict)
+    shortages: List[Shortage] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    def __str__(self) -> str:
+        lines = [f"Остатков товаров в магазинах: {self.rows}, товаров: {self.goods}, время: {self.elapsed:.2f} с"]
+        lines.append("Остатки по магазинам (товаров, штук, площадь упаковок):")
+        lines.extend(
+            f"  {stock.location}: {stock.goods}, {stock.amount}, {stock.footprint:.0f}" for stock in self.locations
+        )
+        for title, percentiles in (
+            ("Перцентили остатка товара в магазине", self.shop_percentiles),
+            ("Перцентили общего остатка товара", self.good_percentiles),
+        ):
+            lines.append(f"{title}: " + ", ".join(f"{p:g}%: {value}" for p, value in percentiles.items()))
+        lines.append("Товары с наименьшим общим остатком:")
+        lines.extend(
+            f"  {shortage.id_good} {shortage.name}: {shortage.amount} шт. в {shortage.locations} магазинах"
+            for shortage in self.shortages
+        )
+        return "\n".join(lines)
+
+
+def stock_report(
+    conn: Connection,
+    top: int = DEFAULT_TOP,
+    percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> StockReport:
+    """Compute reports of stock by location, its percentiles and shortages from one snapshot of the database.
+
+    Args:
+        conn: Database Connection object, no transaction may be open on it.
+        top: Number of shortages to report.
+        percentiles: Percentiles of stock to report, from 0 to 100.
+        chunk_size: Number of rows of shops_goods held in memory at once.
+
+    Returns:
+        The reports.
+
+    Raises:
+        ImportError: If NumPy isn't installed.
+    """
+    require_numpy()
+    started = time.perf_counter()
+    report = StockReport()
+    locations: Dict[int, str] = {}
+    by_location, goods, shortages = LocationTotals(), GoodTotals(), Shortages(top)
+    shop_amounts, good_amounts = ValueCounts(), ValueCounts()
+
+    def add_goods(stock: GoodStock) -> None:
+        report.goods += len(stock.id_good)
+        good_amounts.add(stock.amount)
+        shortages.add(stock)
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    try:
+        for chunk in iter_stock_chunks(cursor, locations, chunk_size):
+            report.rows += len(chunk.id_good)
+            by_location.add(chunk)
+            shop_amounts.add(chunk.amount)
+            add_goods(goods.add(chunk))
+        add_goods(goods.finish())
+        ids = [int(id_good) for id_good in shortages.goods.id_good]
+        names: Dict[int, str] = {}
+        # A large --top would exceed the limit of SQL parameters in a single IN list.
+        for batch in main.iter_batches(ids, main.SQLITE_MAX_PARAMETERS):
+            placeholders = ", ".join("?" * len(batch))
+            names.update(cursor.execute(f"SELECT id, name FROM goods WHERE id IN ({placeholders})", batch))
+    finally:
+        conn.rollback()  # nothing is written, the read transaction is just finished
+    report.locations = sorted(
+        (
+            LocationStock(
+                name, int(by_location.goods[code]), int(by_location.amount[code]), float(by_location.footprint[code])
+            )
+            for code, name in locations.items()
+            if code < len(by_location.goods) and by_location.goods[code]
+        ),
+        key=lambda stock: (-stock.footprint, stock.location),
+    )
+    report.shop_percentiles = shop_amounts.percentiles(percentiles)
+    report.good_percentiles = good_amounts.percentiles(percentiles)
+    report.shortages = [
+        Shortage(id_good, names[id_good], int(amount), int(locations_count))
+        for id_good, amount, locations_count in zip(ids, shortages.goods.amount, shortages.goods.locations)
+    ]
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def main_analytics(argv: Optional[Sequence[str]] = None) -> int:
+    """Compute reports of stock from command line and print them."""
+    parser = argparse.ArgumentParser(description="Report stock of goods by locations, its percentiles and shortages.")
+    parser.add_argument("--db", default="goods.db", help="path to SQLite database (default: goods.db)")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help=f"shortages to report (default: {DEFAULT_TOP})")
+    parser.add_argument(
+        "--percentiles",
+        type=float,
+        nargs="+",
+        default=DEFAULT_PERCENTILES,
+        help="percentiles of stock to report (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"rows of shops_goods held in memory at once (default: {DEFAULT_CHUNK_SIZE})",
+    )
+    args = parser.parse_args(argv)
+    if np is None:
+        parser.error("NumPy isn't installed, install it by: pip install numpy")
+    if not all(0 <= percentile <= 100 for percentile in args.percentiles):
+        parser.error("percentiles must be from 0 to 100")
+    if args.top < 0 or args.chunk_size < 1:
+        parser.error("--top must not be negative and --chunk-size must be positive")
+    with closing(main.connect(args.db)) as conn:
+        main.create_tables_in_db(conn.cursor())
+        print(stock_report(conn, args.top, args.percentiles, args.chunk_size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_analytics())
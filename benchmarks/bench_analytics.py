@@ -0,0 +1,113 @@
+"""Compare analytics.stock_report with the same reports computed row by row over fetchall.
+
+A database of --count goods is filled once. The row-by-row reports fetch every row of
+shops_goods and aggregate them in dicts, the NumPy reports aggregate chunks of --chunk-size rows.
+Time and peak memory traced by tracemalloc in a second run are reported for both, and the reports
+are compared. With --normalize the database is normalized by main.normalize_db first.
+
+Usage: python benchmarks/bench_analytics.py --count 200000 [--chunk-size 100000] [--top 10] [--normalize]
+"""
+import argparse
+import math
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import closing
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics  # noqa: E402
+import datagen  # noqa: E402
+import main  # noqa: E402
+import records  # noqa: E402
+
+T = TypeVar("T")
+
+
+def row_by_row_report(conn: sqlite3.Connection, top: int) -> analytics.StockReport:
+    """Compute the reports of analytics.stock_report by aggregating fetched rows in dicts."""
+    rows = conn.execute(
+        """SELECT id_good, location, amount, package_height * package_width
+           FROM shops_goods JOIN goods ON goods.id = shops_goods.id_good"""
+    ).fetchall()
+    locations: Dict[str, List[float]] = defaultdict(lambda: [0, 0, 0.0])
+    goods: Dict[int, List[int]] = defaultdict(lambda: [0, 0])
+    for id_good, location, amount, footprint in rows:
+        stock = locations[location]
+        stock[0] += 1
+        stock[1] += amount
+        stock[2] += amount * footprint
+        goods[id_good][0] += amount
+        goods[id_good][1] += 1
+    shortages = sorted(goods.items(), key=lambda item: (item[1][0], item[0]))[:top]
+    names: Dict[int, str] = {}
+    for batch in main.iter_batches([id_good for id_good, _ in shortages], main.SQLITE_MAX_PARAMETERS):
+        names.update(conn.execute("SELECT id, name FROM goods WHERE id IN (%s)" % ", ".join("?" * len(batch)), batch))
+    return analytics.StockReport(
+        len(rows),
+        len(goods),
+        sorted(
+            (
+                analytics.LocationStock(location, int(count), int(amount), footprint)
+                for location, (count, amount, footprint) in locations.items()
+            ),
+            key=lambda stock: (-stock.footprint, stock.location),
+        ),
+        percentiles([row[2] for row in rows]),
+        percentiles([amount for amount, _ in goods.values()]),
+        [analytics.Shortage(id_good, names[id_good], amount, count) for id_good, (amount, count) in shortages],
+    )
+
+
+def percentiles(values: List[int]) -> Dict[float, int]:
+    """Return analytics.DEFAULT_PERCENTILES of values by the nearest-rank method."""
+    values = sorted(values)
+    return {p: values[max(math.ceil(p * len(values) / 100), 1) - 1] for p in analytics.DEFAULT_PERCENTILES}
+
+
+def measure(compute: Callable[[], T]) -> Tuple[T, float, int]:
+    """Return result, seconds and peak traced memory of a computation, it's run again to trace memory."""
+    started = time.perf_counter()
+    result = compute()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()  # tracing slows allocations down a lot, so the timed run isn't traced
+    compute()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=200_000, help="goods in the database (default: 200000)")
+    parser.add_argument("--chunk-size", type=int, default=analytics.DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--top", type=int, default=analytics.DEFAULT_TOP)
+    parser.add_argument("--normalize", action="store_true", help="normalize the database first")
+    args = parser.parse_args()
+    analytics.require_numpy()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with closing(main.connect(os.path.join(tmp_dir, "goods.db"))) as conn:
+            main.create_tables_in_db(conn.cursor())
+            for batch in records.iter_goods_batches(datagen.generate_goods(args.count), main.DEFAULT_BATCH_SIZE):
+                main.write_records(conn, batch)
+            if args.normalize:
+                main.normalize_db(conn.cursor())
+            expected, elapsed, peak = measure(lambda: row_by_row_report(conn, args.top))
+            print(f"{'row by row over fetchall':<28}{elapsed:8.2f} s{peak / 2**20:10.1f} MiB peak")
+            report, elapsed, peak = measure(lambda: analytics.stock_report(conn, args.top, chunk_size=args.chunk_size))
+            print(f"{'NumPy chunk by chunk':<28}{elapsed:8.2f} s{peak / 2**20:10.1f} MiB peak")
+    for stock in report.locations + expected.locations:
+        stock.footprint = round(stock.footprint, 3)  # summed in different orders
+    report.elapsed = expected.elapsed = 0.0
+    print(f"reports are the same: {report == expected}")
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,79 @@
+"""Measure export.py: rate, peak memory of the export and cost of change tracking for writers.
+
+Goods are written to fresh databases with and without change tracking, then exported in full
+and since the watermark taken before the last --changed goods were rewritten. Peak memory is
+traced by tracemalloc and shouldn't grow with --count.
+
+Usage: python benchmarks/bench_export.py --count 200000 [--changed 1000] [--fetch-size 1000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import closing
+from sqlite3.dbapi2 import Connection
+from typing import Callable, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datagen  # noqa: E402
+import export  # noqa: E402
+import main  # noqa: E402
+import records  # noqa: E402
+
+
+def write_goods(conn: Connection, goods: List[dict], batch_size: int) -> float:
+    """Write goods in column batches, return goods written per second."""
+    started = time.perf_counter()
+    for batch in records.iter_goods_batches(goods, batch_size):
+        main.write_records(conn, batch)
+    return len(goods) / (time.perf_counter() - started)
+
+
+def traced(run: Callable[[], export.ExportReport]) -> str:
+    """Run an export twice and describe its rate and, traced by tracemalloc which slows it down, peak memory."""
+    report = run()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return f"{report.goods} goods, {report.goods / report.elapsed:.0f} goods/s, peak {peak / 2**20:.2f} MiB"
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=200_000, help="number of goods (default: 200000)")
+    parser.add_argument("--changed", type=int, default=1000, help="goods changed after the watermark (default: 1000)")
+    parser.add_argument("--fetch-size", type=int, default=main.DEFAULT_FETCH_SIZE)
+    parser.add_argument("--batch-size", type=int, default=main.DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    goods = list(datagen.generate_goods(args.count))
+    changed = [dict(good, name=f"{good['name']} *") for good in goods[: args.changed]]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for tracked in (False, True):
+            with closing(main.connect(os.path.join(tmp_dir, f"goods-{tracked}.db"))) as conn:
+                main.create_tables_in_db(conn.cursor())
+                if tracked:
+                    main.enable_change_tracking(conn.cursor())
+                rate = write_goods(conn, goods, args.batch_size)
+                print(f"change tracking {'on' if tracked else 'off'}: written {rate:.0f} goods/s")
+            if not tracked:
+                continue
+            with closing(main.connect(os.path.join(tmp_dir, "goods-True.db"))) as conn, open(
+                os.devnull, "w", encoding="utf-8"
+            ) as devnull:
+                print("full export:", traced(lambda: export.export_goods(conn, devnull, fetch_size=args.fetch_size)))
+                watermark = main.goods_version(conn.cursor())
+                write_goods(conn, changed, args.batch_size)
+                print(
+                    "incremental export:",
+                    traced(lambda: export.export_goods(conn, devnull, since=watermark, fetch_size=args.fetch_size)),
+                )
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,145 @@
+"""Time every ingestion stage separately and the full pipeline on generated goods.
+
+Results are written as JSON, pass results of a previous version with --baseline to see the change.
+
+Usage: python benchmarks/bench_pipeline.py --count 100000 --output results.json [--baseline old.json]
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import closing, redirect_stdout
+from typing import Any, Callable, Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datagen  # noqa: E402
+import main  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READ_JSON_FILES = 2000
+
+
+def timed(documents: int, func: Callable[[], Any]) -> Dict[str, float]:
+    """Call func and return elapsed seconds and throughput in documents per second."""
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    return {"seconds": round(elapsed, 4), "docs_per_second": round(documents / elapsed, 1) if elapsed else 0.0}
+
+
+def write_in_batches(
+    db_path: str, writer: Callable[[sqlite3.Cursor, List[dict]], None], batches: List[List[dict]]
+) -> None:
+    """Write every batch with writer in its own transaction to a fresh database."""
+    with closing(main.connect(db_path, "default")) as conn:
+        main.create_tables_in_db(conn.cursor())
+        for batch in batches:
+            with conn:
+                writer(conn.cursor(), batch)
+
+
+def run(args: argparse.Namespace, tmp_dir: str) -> Dict[str, Dict[str, float]]:
+    """Run every stage, return their timings."""
+    goods = datagen.generate_goods(
+        args.count, args.shops, update_share=args.update_share, invalid_share=args.invalid_share, seed=args.seed
+    )
+    ndjson_path = os.path.join(tmp_dir, "goods.ndjson")
+    datagen.write_goods(ndjson_path, goods)
+    files_dir = os.path.join(tmp_dir, "files")
+    os.mkdir(files_dir)
+    file_count = min(args.count, READ_JSON_FILES)
+    for number, good in enumerate(datagen.generate_goods(file_count, args.shops, seed=args.seed)):
+        datagen.write_goods(os.path.join(files_dir, f"{number}.json"), [good], "array")
+    file_paths = list(main.iter_json_files([files_dir]))
+    schema = main.read_json(os.path.join(ROOT, "goods.schema.json"))
+    documents: List[Any] = []
+    valid: List[Any] = []
+    prepared: List[dict] = []
+    stages = {}
+
+    stages["read_json"] = timed(file_count, lambda: [main.read_json(path) for path in file_paths])
+    stages["iter_json_documents"] = timed(args.count, lambda: documents.extend(main.iter_json_documents(ndjson_path)))
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        stages["is_data_valid"] = timed(
+            args.count, lambda: valid.extend(doc for doc in documents if main.is_data_valid(doc, schema))
+        )
+    stages["prepare_data_for_insert_update"] = timed(
+        len(valid), lambda: prepared.extend(main.prepare_data_for_insert_update(doc) for doc in valid)
+    )
+    batches = list(main.iter_batches(prepared, args.batch_size))
+    stages["goods_writer"] = timed(
+        len(prepared),
+        lambda: write_in_batches(
+            os.path.join(tmp_dir, "goods.db"), main.insert_or_replace_batch_to_goods_table, batches
+        ),
+    )
+    stages["shops_goods_writer"] = timed(
+        len(prepared),
+        lambda: write_in_batches(
+            os.path.join(tmp_dir, "shops.db"), main.insert_or_replace_batch_to_shops_goods_table, batches
+        ),
+    )
+
+    def full_pipeline() -> None:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            with closing(main.connect(os.path.join(tmp_dir, "pipeline.db"), args.profile)) as conn:
+                main.create_tables_in_db(conn.cursor())
+                main.ingest_files(conn, [ndjson_path], schema, args.batch_size)
+
+    stages["full_pipeline"] = timed(args.count, full_pipeline)
+    return stages
+
+
+def git_revision() -> str:
+    """Return current git revision of the repository or an empty string."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=100_000, help="number of documents (default: 100000)")
+    parser.add_argument("--shops", type=int, default=3, help="shops per good (default: 3)")
+    parser.add_argument("--update-share", type=float, default=0.2, help="share of updates (default: 0.2)")
+    parser.add_argument("--invalid-share", type=float, default=0.01, help="share of invalid documents (default: 0.01)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=main.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--profile", choices=sorted(main.CONNECTION_PROFILES), default=main.DEFAULT_CONNECTION_PROFILE)
+    parser.add_argument("--output", default="bench_results.json", help="file for JSON results")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stages = run(args, tmp_dir)
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "stages": stages,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = main.read_json(args.baseline)["stages"] if args.baseline else {}
+    for name, timing in stages.items():
+        line = f"{name:<32} {timing['seconds']:10.3f} s {timing['docs_per_second']:12.1f} docs/s"
+        if name in baseline and baseline[name]["docs_per_second"]:
+            line += f" {(timing['docs_per_second'] / baseline[name]['docs_per_second'] - 1) * 100:+7.1f}%"
+        print(line)
+    print(f"results are written to {args.output}")
+
+
+if __name__ == "__main__":
+    main_benchmark()
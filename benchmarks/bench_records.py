@@ -0,0 +1,124 @@
+"""Compare prepared dicts with records.GoodsBatch columns: memory of a batch and write throughput.
+
+Memory is what a batch of --count goods parsed from NDJSON keeps alive, traced by tracemalloc.
+Throughput is measured for building batches of --batch-size goods, for the shops_goods writer
+alone and for the whole transaction writing built batches to a fresh database.
+
+Usage: python benchmarks/bench_records.py --count 200000 [--batch-size 1000]
+"""
+import argparse
+import gc
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import closing
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datagen  # noqa: E402
+import main  # noqa: E402
+import records  # noqa: E402
+
+
+def build_dicts(documents: List[dict]) -> Any:
+    """Batch of the dict path: prepared data of every good."""
+    return [main.prepare_data_for_insert_update(document) for document in documents]
+
+
+def build_records(documents: List[dict]) -> Any:
+    """Batch of the column path."""
+    batch = records.GoodsBatch()
+    for document in documents:
+        batch.append(document)
+    return batch
+
+
+def retained_memory(build: Callable[[List[dict]], Any], lines: List[str]) -> int:
+    """Return bytes kept alive by a batch built from goods parsed from NDJSON lines.
+
+    Prepared dicts refer to location_and_quantity lists of parsed documents, so these stay
+    alive with the batch, column batches copy the values and let the documents go.
+    """
+    gc.collect()
+    tracemalloc.start()
+    batch = build([json.loads(line) for line in lines])
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del batch
+    return retained
+
+
+def write_shops(db_path: str, batches: List[Any], writer: Callable[[sqlite3.Cursor, Any], None]) -> None:
+    """Write shops of built batches with writer, every batch in its own transaction."""
+    with closing(main.connect(db_path, "default")) as conn:
+        main.create_tables_in_db(conn.cursor())
+        for batch in batches:
+            with conn:
+                writer(conn.cursor(), batch)
+
+
+def write_dicts(db_path: str, documents: List[dict], batch_size: int) -> None:
+    """Prepare and write goods the dict way."""
+    with closing(main.connect(db_path, "default")) as conn:
+        main.create_tables_in_db(conn.cursor())
+        for batch in main.iter_batches(documents, batch_size):
+            main.write_batch(conn, build_dicts(batch))
+
+
+def write_records(db_path: str, documents: List[dict], batch_size: int) -> None:
+    """Collect and write goods as column batches."""
+    with closing(main.connect(db_path, "default")) as conn:
+        main.create_tables_in_db(conn.cursor())
+        for batch in records.iter_goods_batches(documents, batch_size):
+            main.write_records(conn, batch)
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=200_000, help="number of goods (default: 200000)")
+    parser.add_argument("--shops", type=int, default=3, help="shops per good (default: 3)")
+    parser.add_argument("--batch-size", type=int, default=main.DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    documents = list(datagen.generate_goods(args.count, args.shops))
+    lines = [json.dumps(document, ensure_ascii=False) for document in documents]
+    paths: Dict[str, Tuple[Callable[[List[dict]], Any], Callable[..., None], Callable[[str, List[dict], int], None]]]
+    paths = {
+        "dicts": (build_dicts, main.insert_or_replace_batch_to_shops_goods_table, write_dicts),
+        "records": (build_records, main.insert_or_replace_records_to_shops_goods_table, write_records),
+    }
+    results: Dict[str, Dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, (build, shops_writer, write) in paths.items():
+            started = time.perf_counter()
+            batches = [build(batch) for batch in main.iter_batches(documents, args.batch_size)]
+            build_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            write_shops(os.path.join(tmp_dir, f"{name}-shops.db"), batches, shops_writer)
+            shops_seconds = time.perf_counter() - started
+            del batches
+            started = time.perf_counter()
+            write(os.path.join(tmp_dir, f"{name}.db"), documents, args.batch_size)
+            write_seconds = time.perf_counter() - started
+            results[name] = {
+                "retained_mib": retained_memory(build, lines) / 2**20,
+                "build": args.count / build_seconds,
+                "shops_writer": args.count / shops_seconds,
+                "build_and_write": args.count / write_seconds,
+            }
+    print(f"{'path':<8} {'batch, MiB':>11} {'build, goods/s':>15} {'shops writer, goods/s':>22} {'total, goods/s':>15}")
+    for name, result in results.items():
+        print(
+            f"{name:<8} {result['retained_mib']:11.1f} {result['build']:15.0f}"
+            f" {result['shops_writer']:22.0f} {result['build_and_write']:15.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main_benchmark()
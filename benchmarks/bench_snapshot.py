@@ -0,0 +1,128 @@
+"""Measure contention of a writer and a reader with and without snapshot.py replicas.
+
+A writer commits batches of goods for --seconds seconds while a reader repeats a long
+aggregate query, first against the live database and then against a replica published by
+snapshot.SnapshotPublisher after every --every-batches batches. The reader reopens the
+replica before every query, so it always reads the latest snapshot. Commit latency of the
+writer, query latency of the reader and copy time of snapshots are reported.
+
+Usage: python benchmarks/bench_snapshot.py --count 100000 [--profile default] [--seconds 10]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import closing
+from typing import Callable, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datagen  # noqa: E402
+import main  # noqa: E402
+import records  # noqa: E402
+import snapshot  # noqa: E402
+
+READER_QUERY = """
+    SELECT goods.id, sum(shops_goods.amount) * goods.package_height * goods.package_width
+    FROM goods JOIN shops_goods ON shops_goods.id_good = goods.id
+    GROUP BY goods.id
+"""
+
+
+def percentile(values: List[float], share: float) -> float:
+    """Return the value below which share of sorted values lie."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def describe(title: str, latencies: List[float]) -> str:
+    """Describe latencies in milliseconds."""
+    if not latencies:
+        return f"{title}: none"
+    return (
+        f"{title}: {len(latencies)}, ms p50 {percentile(latencies, 0.5) * 1000:.1f}, "
+        f"p99 {percentile(latencies, 0.99) * 1000:.1f}, max {max(latencies) * 1000:.1f}"
+    )
+
+
+def read_repeatedly(open_reader: Callable[[], sqlite3.Connection], stop: threading.Event) -> List[float]:
+    """Run the reader query until stopped, return its latencies."""
+    latencies = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        with closing(open_reader()) as conn:
+            conn.execute(READER_QUERY).fetchall()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run(db_path: str, args: argparse.Namespace, replica: bool) -> None:
+    """Write batches while a reader queries the live database or the replica."""
+    goods = datagen.generate_goods(10**9, seed=1)
+    publisher = snapshot.SnapshotPublisher(db_path, db_path + ".replica", args.every_batches) if replica else None
+    commits: List[float] = []
+    stop = threading.Event()
+    reader_latencies: List[float] = []
+    if publisher is not None:
+        publisher.start()
+        publisher.publish()
+    open_reader = (
+        (lambda: snapshot.open_replica(db_path + ".replica"))
+        if replica
+        else (lambda: main.connect(db_path, args.profile))
+    )
+    reader = threading.Thread(target=lambda: reader_latencies.extend(read_repeatedly(open_reader, stop)))
+    reader.start()
+    with closing(main.connect(db_path, args.profile)) as conn:
+        deadline = time.perf_counter() + args.seconds
+        while time.perf_counter() < deadline:
+            batch = records.GoodsBatch()
+            for _ in range(args.batch_size):
+                batch.append(next(goods))
+            started = time.perf_counter()
+            main.write_records(conn, batch)
+            commits.append(time.perf_counter() - started)
+            if publisher is not None:
+                publisher.batch_committed()
+            time.sleep(args.pause)
+    stop.set()
+    reader.join()
+    print(f"reader on the {'replica' if replica else 'live database'}:")
+    print("  " + describe("writer batches", commits))
+    print("  " + describe("reader queries", reader_latencies))
+    if publisher is not None:
+        publisher.close()
+        print(f"  snapshots: {publisher.published}, last {publisher.last}")
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=100_000, help="goods in the database (default: 100000)")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of every run (default: 10)")
+    parser.add_argument("--batch-size", type=int, default=100, help="goods in a batch (default: 100)")
+    parser.add_argument("--pause", type=float, default=0.02, help="seconds between batches (default: 0.02)")
+    parser.add_argument("--every-batches", type=int, default=50, help="batches between snapshots (default: 50)")
+    parser.add_argument(
+        "--profile",
+        choices=sorted(main.CONNECTION_PROFILES),
+        default="default",
+        help="connection settings of the writer and of readers of the live database (default: default)",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "goods.db")
+        with closing(main.connect(db_path, args.profile)) as conn:
+            main.create_tables_in_db(conn.cursor())
+            for batch in records.iter_goods_batches(datagen.generate_goods(args.count), main.DEFAULT_BATCH_SIZE):
+                main.write_records(conn, batch)
+        for replica in (False, True):
+            run(db_path, args, replica)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,87 @@
+"""Measure startup of main.py: import time and cold start of a run ingesting a single document.
+
+Every measurement runs a fresh interpreter --runs times and reports the median wall time.
+Cold starts are compared without the checker cache and with a warm one. Bytecode of modules
+is cached in a temporary directory, as it's cached for an installed package, unless
+--no-bytecode-cache is given.
+
+Usage: python benchmarks/bench_startup.py [--runs 20] [--no-bytecode-cache]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GOOD = {
+    "id": 1,
+    "name": "Холодильник",
+    "package_params": {"width": 120, "height": 270},
+    "location_and_quantity": [{"location": "Магазин на Ленина", "amount": 5}],
+}
+
+
+def median_run(command: List[str], env: Dict[str, str], runs: int) -> float:
+    """Run a command runs times, return median wall time in milliseconds."""
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def imported_modules(env: Dict[str, str], *modules: str) -> List[str]:
+    """Return which of modules are imported by importing main."""
+    code = f"import sys, main; print(json.dumps([m for m in {list(modules)!r} if m in sys.modules]))"
+    output = subprocess.run(
+        [sys.executable, "-c", f"import json; {code}"], cwd=ROOT, env=env, check=True, capture_output=True
+    )
+    return json.loads(output.stdout)
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20, help="runs of every command (default: 20)")
+    parser.add_argument("--no-bytecode-cache", action="store_true", help="compile modules from source in every run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ)
+        if args.no_bytecode_cache:
+            env["PYTHONDONTWRITEBYTECODE"] = "1"
+        else:
+            env.pop("PYTHONDONTWRITEBYTECODE", None)
+            env["PYTHONPYCACHEPREFIX"] = os.path.join(tmp_dir, "pycache")
+        document = os.path.join(tmp_dir, "good.json")
+        with open(document, "w", encoding="utf-8") as f:
+            json.dump(GOOD, f, ensure_ascii=False)
+        run = [sys.executable, "main.py", document, "--db", os.path.join(tmp_dir, "goods.db")]
+        cache = ["--checker-cache", os.path.join(tmp_dir, "checkers")]
+        subprocess.run(run + cache, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)  # warm both caches
+
+        print(
+            f"imported by main: {imported_modules(env, 'jsonschema', 'multiprocessing') or 'none'} "
+            "of jsonschema, multiprocessing"
+        )
+        interpreter = median_run([sys.executable, "-c", "pass"], env, args.runs)
+        print(f"{'python -c pass':<32}{interpreter:8.1f} ms")
+        for title, command in (
+            ("import main", [sys.executable, "-c", "import main"]),
+            ("import jsonschema", [sys.executable, "-c", "import jsonschema"]),
+            ("run without checker cache", run + ["--no-checker-cache"]),
+            ("run with warm checker cache", run + cache),
+        ):
+            elapsed = median_run(command, env, args.runs)
+            print(f"{title:<32}{elapsed:8.1f} ms  (+{elapsed - interpreter:.1f} ms over the interpreter)")
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,102 @@
+"""Measure per-row cost of shops_goods writes as the table grows.
+
+For every table size the table is filled with that many rows, then a sample of goods
+(half updates of existing rows, half new ones) is written and the cost per row is reported.
+The legacy path (correlated SELECT without index + INSERT OR REPLACE) is measured on a tenth
+of the sample and only up to --legacy-limit rows because it scans the whole table for every row.
+
+Usage: python benchmarks/bench_upsert_scaling.py [--sizes 10000 100000 1000000 10000000]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable, Iterator, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+SHOPS_PER_GOOD = 10
+LEGACY_SHOPS_SQL = """INSERT OR REPLACE INTO shops_goods
+                   VALUES (
+                       (SELECT id FROM shops_goods
+                       WHERE shops_goods.id_good = :id_good and
+                       shops_goods.location = :location),
+                       :id_good, :location, :amount)"""
+
+
+def shop_rows(first_good: int, goods: int) -> Iterator[Tuple[int, str, int]]:
+    """Yield shops_goods rows of goods with ids starting at first_good."""
+    for good_id in range(first_good, first_good + goods):
+        for shop in range(SHOPS_PER_GOOD):
+            yield good_id, f"Магазин №{shop}", good_id % 50
+
+
+def sample(rows: int, sample_goods: int) -> List[dict]:
+    """Prepared goods of which half exist in a table of rows rows and half are new."""
+    existing_goods = rows // SHOPS_PER_GOOD
+    ids = list(range(existing_goods - sample_goods // 2, existing_goods + sample_goods // 2))
+    return [
+        {"id": good_id, "location_and_quantity": [{"location": f"Магазин №{shop}", "amount": 7} for shop in range(10)]}
+        for good_id in ids
+    ]
+
+
+def legacy_writer(cursor: sqlite3.Cursor, batch: List[dict]) -> None:
+    """Shops writer as it was before the unique index and UPSERT."""
+    for prepared_data in batch:
+        for shop in prepared_data["location_and_quantity"]:
+            params = {"id_good": prepared_data["id"], "location": shop["location"], "amount": shop["amount"]}
+            cursor.execute(LEGACY_SHOPS_SQL, params)
+
+
+def measure(rows: int, sample_goods: int, legacy: bool) -> float:
+    """Fill a fresh database with rows rows, return microseconds per written sample row."""
+    writer: Callable[[sqlite3.Cursor, List[dict]], None]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conn = sqlite3.connect(os.path.join(tmp_dir, "bench.db"))
+        if legacy:
+            conn.execute(
+                "CREATE TABLE shops_goods (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "
+                "id_good INTEGER NOT NULL, location VARCHAR(100) NOT NULL, amount INTEGER NOT NULL)"
+            )
+            writer = legacy_writer
+        else:
+            main.create_tables_in_db(conn.cursor())
+            writer = main.insert_or_replace_batch_to_shops_goods_table
+        with conn:
+            conn.executemany(
+                "INSERT INTO shops_goods (id_good, location, amount) VALUES (?, ?, ?)",
+                shop_rows(0, rows // SHOPS_PER_GOOD),
+            )
+        batch = sample(rows, sample_goods)
+        started = time.perf_counter()
+        with conn:
+            writer(conn.cursor(), batch)
+        elapsed = time.perf_counter() - started
+        conn.close()
+    return elapsed / (len(batch) * SHOPS_PER_GOOD) * 1e6
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--sample-goods", type=int, default=1000, help="goods written per measurement")
+    parser.add_argument("--legacy-limit", type=int, default=100_000, help="largest table for the legacy path")
+    args = parser.parse_args()
+
+    print(f"{'rows':>12} {'upsert us/row':>14} {'legacy us/row':>14}")
+    for rows in args.sizes:
+        upsert = measure(rows, args.sample_goods, legacy=False)
+        legacy = "-"
+        if rows <= args.legacy_limit:
+            legacy = f"{measure(rows, max(args.sample_goods // 10, 2), legacy=True):.1f}"
+        print(f"{rows:12d} {upsert:14.1f} {legacy:>14}")
+
+
+if __name__ == "__main__":
+    main_benchmark()
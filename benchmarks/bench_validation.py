@@ -0,0 +1,59 @@
+"""Compare per-call jsonschema.validate with compiled and generated validators.
+
+Usage: python benchmarks/bench_validation.py [--count 100000]
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Callable, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsonschema  # noqa: E402
+from jsonschema.exceptions import ValidationError  # noqa: E402
+
+import datagen  # noqa: E402
+import main  # noqa: E402
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "goods.schema.json")
+
+
+def validate_per_call(schema: dict) -> Callable[[dict], bool]:
+    """Validation as is_data_valid did it before validators were compiled once."""
+
+    def is_valid(instance: dict) -> bool:
+        try:
+            jsonschema.validate(instance, schema)
+        except ValidationError:
+            return False
+        return True
+
+    return is_valid
+
+
+def run(name: str, is_valid: Callable[[dict], bool], goods: List[dict]) -> float:
+    """Validate every good, print and return elapsed seconds."""
+    started = time.perf_counter()
+    valid = sum(1 for good in goods if is_valid(good))
+    elapsed = time.perf_counter() - started
+    print(f"{name:<28} {elapsed:8.3f} s {len(goods) / elapsed:12.0f} docs/s  valid: {valid}")
+    return elapsed
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100_000, help="number of documents (default: 100000)")
+    args = parser.parse_args()
+
+    schema = main.read_json(SCHEMA_FILE)
+    goods = list(datagen.generate_goods(args.count, shops_per_good=3, invalid_share=0.01))
+    baseline = run("jsonschema.validate per call", validate_per_call(schema), goods)
+    compiled = run("compiled jsonschema", main.SchemaValidator(schema, fast=False).is_valid, goods)
+    fast = run("generated checker", main.SchemaValidator(schema).is_valid, goods)
+    print(f"speedup: compiled x{baseline / compiled:.1f}, generated x{baseline / fast:.1f}")
+
+
+if __name__ == "__main__":
+    main_benchmark()
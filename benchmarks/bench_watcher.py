@@ -0,0 +1,89 @@
+"""Measure latency of watcher.py from a file landing in the spool to the commit of its goods.
+
+A producer thread drops --rate files per second for --seconds seconds, every file holds
+--goods-per-file goods and is written under a temporary name and renamed into the spool.
+The watcher ingests them in another thread, latency of a pickup is the time from the
+earliest modification of its files to the commit.
+
+Usage: python benchmarks/bench_watcher.py --rate 500 --seconds 10 [--poll]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import closing
+from typing import List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datagen  # noqa: E402
+import main  # noqa: E402
+import watcher  # noqa: E402
+
+
+def produce(spool: str, rate: int, seconds: float, goods_per_file: int) -> int:
+    """Drop files into the spool at a steady rate, return the number of dropped files."""
+    goods = datagen.generate_goods(int(rate * seconds) * goods_per_file, update_share=0.2)
+    started = time.perf_counter()
+    dropped = 0
+    while dropped < rate * seconds:
+        delay = started + dropped / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        path = os.path.join(spool, f"goods-{dropped:06d}.json")
+        with open(path + ".part", "w", encoding="utf-8") as f:
+            json.dump([next(goods) for _ in range(goods_per_file)], f, ensure_ascii=False)
+        os.rename(path + ".part", path)
+        dropped += 1
+    return dropped
+
+
+def percentile(values: List[float], share: float) -> float:
+    """Return the value below which share of sorted values lie."""
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def main_benchmark() -> None:
+    """Run the benchmark from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=int, default=500, help="files per second (default: 500)")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of the run (default: 10)")
+    parser.add_argument("--goods-per-file", type=int, default=5, help="goods in every file (default: 5)")
+    parser.add_argument("--poll", action="store_true", help="poll the spool instead of using inotify")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        spool = os.path.join(tmp_dir, "spool")
+        os.mkdir(spool)
+        pickups: List[watcher.Pickup] = []
+        stop = threading.Event()
+        with closing(main.connect(os.path.join(tmp_dir, "goods.db"), "default", check_same_thread=False)) as conn:
+            main.create_tables_in_db(conn.cursor())
+            daemon = watcher.Watcher(conn, spool, main.read_json("goods.schema.json"))
+            waiter = watcher.PollingWaiter() if args.poll else watcher.open_waiter(spool)
+            thread = threading.Thread(target=daemon.run, args=(waiter, stop, pickups.append))
+            thread.start()
+            started = time.perf_counter()
+            dropped = produce(spool, args.rate, args.seconds, args.goods_per_file)
+            while sum(len(pickup.files) for pickup in pickups) < dropped:
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - started
+            stop.set()
+            thread.join()
+            waiter.close()
+    latencies = sorted(pickup.latency for pickup in pickups)
+    print(
+        f"{type(waiter).__name__}: {dropped} files in {elapsed:.1f} s ({dropped / elapsed:.0f} files/s), "
+        f"{len(pickups)} pickups ({dropped / len(pickups):.1f} files each)"
+    )
+    print(
+        f"latency, s: p50 {percentile(latencies, 0.5):.3f}, p99 {percentile(latencies, 0.99):.3f}, "
+        f"max {latencies[-1]:.3f}"
+    )
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,122 @@
+"""Deterministic generator of goods documents matching goods.schema.json.
+
+Usage: python benchmarks/datagen.py --count 1000000 --shops 5 --update-share 0.3 --out goods.ndjson
+"""
+import argparse
+import json
+import random
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+NAMES = ("Холодильник", "Телевизор", "Микроволновка", "Пылесос", "Чайник", "Утюг", "Стиральная машина", "Плита")
+STREETS = ("Ленина", "Пушкина", "Гагарина", "Мира", "Советской", "Кирова", "Победы", "Садовой")
+
+
+def _wrong_id(good: Dict[str, Any]) -> None:
+    good["id"] = str(good["id"])
+
+
+def _missing_name(good: Dict[str, Any]) -> None:
+    del good["name"]
+
+
+def _extra_key(good: Dict[str, Any]) -> None:
+    good["price"] = 100
+
+
+def _wrong_width(good: Dict[str, Any]) -> None:
+    good["package_params"]["width"] = "широкий"
+
+
+def _wrong_amount(good: Dict[str, Any]) -> None:
+    good["location_and_quantity"].append({"location": "Склад", "amount": None})
+
+
+# Ways to break a document, invalid documents use them in turn.
+VIOLATIONS: List[Callable[[Dict[str, Any]], None]] = [_wrong_id, _missing_name, _extra_key, _wrong_width, _wrong_amount]
+
+
+def location(number: int) -> str:
+    """Return address of shop number."""
+    return f"Магазин на {STREETS[number % len(STREETS)]}, {number // len(STREETS) + 1}"
+
+
+def generate_goods(
+    count: int,
+    shops_per_good: int = 3,
+    shop_count: int = 100,
+    update_share: float = 0.0,
+    invalid_share: float = 0.0,
+    seed: int = 0,
+) -> Iterator[Dict[str, Any]]:
+    """Generate goods documents, the same arguments always give the same documents.
+
+    Args:
+        count: Number of documents.
+        shops_per_good: Number of shops in location_and_quantity of every good.
+        shop_count: Number of distinct shops the goods are spread over.
+        update_share: Share of documents repeating id of an earlier document with new amounts.
+        invalid_share: Share of documents violating the schema.
+        seed: Seed of the random generator.
+
+    Yields:
+        Goods documents.
+    """
+    rnd = random.Random(seed)
+    generated = 0
+    for number in range(count):
+        if generated and rnd.random() < update_share:
+            good_id = rnd.randrange(generated)
+        else:
+            good_id = generated
+            generated += 1
+        good_rnd = random.Random(seed * 1_000_003 + good_id)  # static data of a good doesn't change in updates
+        good: Dict[str, Any] = {
+            "id": good_id,
+            "name": f"{NAMES[good_id % len(NAMES)]} {good_id}",
+            "package_params": {"width": good_rnd.randint(1, 200), "height": good_rnd.randint(1, 300)},
+            "location_and_quantity": [
+                {"location": location(shop), "amount": rnd.randint(0, 50)}
+                for shop in good_rnd.sample(range(shop_count), min(shops_per_good, shop_count))
+            ],
+        }
+        if rnd.random() < invalid_share:
+            VIOLATIONS[number % len(VIOLATIONS)](good)
+        yield good
+
+
+def write_goods(path: str, goods: Iterable[Dict[str, Any]], file_format: str = "ndjson") -> int:
+    """Write goods to a file as NDJSON or as a JSON array, return number of written goods."""
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        if file_format == "array":
+            f.write("[\n")
+        for good in goods:
+            if written and file_format == "array":
+                f.write(",\n")
+            f.write(json.dumps(good, ensure_ascii=False))
+            if file_format == "ndjson":
+                f.write("\n")
+            written += 1
+        if file_format == "array":
+            f.write("\n]\n")
+    return written
+
+
+def main_datagen() -> None:
+    """Generate goods from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=100_000, help="number of documents (default: 100000)")
+    parser.add_argument("--shops", type=int, default=3, help="shops per good (default: 3)")
+    parser.add_argument("--shop-count", type=int, default=100, help="distinct shops (default: 100)")
+    parser.add_argument("--update-share", type=float, default=0.0, help="share of updates of earlier goods")
+    parser.add_argument("--invalid-share", type=float, default=0.0, help="share of invalid documents")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=("ndjson", "array"), default="ndjson")
+    parser.add_argument("--out", required=True, help="output file")
+    args = parser.parse_args()
+    goods = generate_goods(args.count, args.shops, args.shop_count, args.update_share, args.invalid_share, args.seed)
+    print(f"{write_goods(args.out, goods, args.format)} goods written to {args.out}")
+
+
+if __name__ == "__main__":
+    main_datagen()
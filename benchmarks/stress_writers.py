@@ -0,0 +1,237 @@
+"""Stress test of concurrent writer processes with overlapping goods against one database file.
+
+--writers processes are started at once, each one ingests its own file by main.ingest_files in
+the goods phase and by main.ingest_stock_delta_files in the deltas phase. The first --shared
+goods are written by every writer, the rest by only one of them.
+
+Writer w names its goods "... #w" and sets every amount to w + 1, so the goods phase is checked
+without knowing the order of commits: every good must be present with exactly its shops and
+the name and amounts of a single writer which wrote it. In the deltas phase every writer adds
+w + 1 to every shop of the shared goods and subtracts 1 from every shop of its own goods, so
+the final amounts must be the amounts after the goods phase plus exact sums of deltas.
+
+Throughput, time writers waited for the write lock (goods_lock_wait_seconds), retries of
+transactions (goods_write_retries_total) and failed writers are reported for every phase.
+A --busy-timeout shorter than the transactions of other writers makes writers give up waiting
+and retry with backoff, --write-attempts 1 shows what happens without retries.
+
+Usage: python benchmarks/stress_writers.py --writers 8 [--goods 20000] [--shared 5000] [--busy-timeout 0.05]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Set, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+import datagen  # noqa: E402
+import main  # noqa: E402
+import metrics  # noqa: E402
+
+
+@dataclass
+class WriterResult:
+    """Counters of one writer process."""
+
+    documents: int = 0
+    transactions: int = 0
+    lock_wait: float = 0.0
+    lock_wait_buckets: List[int] = field(default_factory=list)
+    retries: int = 0
+    error: Optional[str] = None
+
+
+def good_ids(writer: int, goods: int, shared: int) -> List[int]:
+    """Return ids of goods of a writer: the shared ones and its own ones."""
+    own = goods - shared
+    return list(range(shared)) + list(range(shared + writer * own, shared + (writer + 1) * own))
+
+
+def good_locations(good_id: int, shops_per_good: int) -> List[str]:
+    """Return shops of a good, the same for every writer."""
+    return [datagen.location(shop) for shop in random.Random(good_id).sample(range(100), shops_per_good)]
+
+
+def write_inputs(directory: str, args: argparse.Namespace) -> Tuple[List[str], List[str]]:
+    """Write goods and stock-delta files of every writer, return their paths."""
+    goods_paths, delta_paths = [], []
+    for writer in range(args.writers):
+        ids = good_ids(writer, args.goods, args.shared)
+        random.Random(writer).shuffle(ids)  # writers collide on shared goods in different orders
+        goods_paths.append(os.path.join(directory, f"goods-{writer}.ndjson"))
+        delta_paths.append(os.path.join(directory, f"deltas-{writer}.ndjson"))
+        with open(goods_paths[-1], "w", encoding="utf-8") as goods, open(
+            delta_paths[-1], "w", encoding="utf-8"
+        ) as deltas:
+            for good_id in ids:
+                locations = good_locations(good_id, args.shops_per_good)
+                document = {
+                    "id": good_id,
+                    "name": f"{datagen.NAMES[good_id % len(datagen.NAMES)]} #{writer}",
+                    "package_params": {"width": good_id % 200 + 1, "height": good_id % 300 + 1},
+                    "location_and_quantity": [{"location": location, "amount": writer + 1} for location in locations],
+                }
+                goods.write(json.dumps(document, ensure_ascii=False) + "\n")
+                delta = writer + 1 if good_id < args.shared else -1
+                for location in locations:
+                    deltas.write(json.dumps({"id_good": good_id, "location": location, "delta": delta}) + "\n")
+    return goods_paths, delta_paths
+
+
+def run_writer(db_path: str, path: str, schema_path: str, deltas: bool, args: argparse.Namespace) -> WriterResult:
+    """Ingest a file in a writer process, return its counters."""
+    metrics.REGISTRY.enabled = True
+    metrics.REGISTRY.reset()
+    main.use_write_retry(replace(main.DEFAULT_WRITE_RETRY, attempts=args.write_attempts))
+    result = WriterResult()
+    kwargs = {} if args.busy_timeout is None else {"timeout": args.busy_timeout}
+    try:
+        with closing(main.connect(db_path, args.profile, **kwargs)) as conn:
+            ingest = main.ingest_stock_delta_files if deltas else main.ingest_files
+            report = ingest(conn, [path], main.read_json(schema_path), args.batch_size)
+        result.documents, result.transactions = report.documents, report.batches
+    except sqlite3.Error as err:
+        result.error = f"{type(err).__name__}: {err}"
+    result.lock_wait = main.LOCK_WAIT_SECONDS.sum
+    result.lock_wait_buckets = list(main.LOCK_WAIT_SECONDS.bucket_counts)
+    result.retries = int(main.WRITE_RETRIES.value)
+    return result
+
+
+def run_phase(title: str, db_path: str, paths: List[str], schema_path: str, args: argparse.Namespace) -> None:
+    """Start a writer for every path at once and print their counters."""
+    deltas = title == "deltas"
+    started = time.perf_counter()
+    with ProcessPoolExecutor(len(paths)) as executor:
+        futures = [executor.submit(run_writer, db_path, path, schema_path, deltas, args) for path in paths]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    documents = sum(result.documents for result in results)
+    transactions = sum(result.transactions for result in results)
+    lock_wait = sum(result.lock_wait for result in results)
+    buckets = [sum(counts) for counts in zip(*(result.lock_wait_buckets for result in results))]
+    waits = sum(buckets)
+    p99 = next(
+        (
+            f"{bound * 1000:g} ms"
+            for bound, total in zip(metrics.DEFAULT_BUCKETS, _cumulative(buckets))
+            if total >= 0.99 * waits
+        ),
+        "over the largest bucket",
+    )
+    print(
+        f"{title} phase: {len(paths)} writers, {documents} documents in {elapsed:.1f} s "
+        f"({documents / elapsed:.0f} docs/s), failed writers: {sum(result.error is not None for result in results)}"
+    )
+    print(
+        f"  transactions: {transactions}, lock wait: total {lock_wait:.1f} s, "
+        f"mean {lock_wait / max(waits, 1) * 1000:.1f} ms, p99 <= {p99}, "
+        f"retries: {sum(result.retries for result in results)}"
+    )
+    for result in results:
+        if result.error is not None:
+            print(f"  writer failed: {result.error}")
+
+
+def _cumulative(counts: List[int]) -> List[int]:
+    totals, total = [], 0
+    for count in counts:
+        total += count
+        totals.append(total)
+    return totals
+
+
+def read_shops(conn: sqlite3.Connection) -> Dict[int, Dict[str, int]]:
+    """Return amounts by location of every good in shops_goods."""
+    shops: Dict[int, Dict[str, int]] = defaultdict(dict)
+    for id_good, location, amount in conn.execute("SELECT id_good, location, amount FROM shops_goods"):
+        shops[id_good][location] = amount
+    return shops
+
+
+def check_goods(conn: sqlite3.Connection, args: argparse.Namespace) -> List[str]:
+    """Return problems of goods and shops_goods after the goods phase."""
+    writers_of: Dict[int, Set[int]] = defaultdict(set)
+    for writer in range(args.writers):
+        for good_id in good_ids(writer, args.goods, args.shared):
+            writers_of[good_id].add(writer)
+    names = dict(conn.execute("SELECT id, name FROM goods").fetchall())
+    shops = read_shops(conn)
+    problems = [f"unexpected good {good_id}" for good_id in set(names) - set(writers_of)]
+    for good_id, writers in writers_of.items():
+        if good_id not in names:
+            problems.append(f"good {good_id} is lost")
+            continue
+        writer = int(names[good_id].rsplit("#", 1)[1])
+        expected = {location: writer + 1 for location in good_locations(good_id, args.shops_per_good)}
+        if writer not in writers or shops.get(good_id) != expected:
+            problems.append(f"good {good_id} named by writer {writer} has shops {shops.get(good_id)}")
+    return problems
+
+
+def check_deltas(before: Dict[int, Dict[str, int]], conn: sqlite3.Connection, args: argparse.Namespace) -> List[str]:
+    """Return problems of shops_goods amounts after the deltas phase."""
+    shared_delta = sum(writer + 1 for writer in range(args.writers))
+    problems = []
+    after = read_shops(conn)
+    for good_id, amounts in before.items():
+        delta = shared_delta if good_id < args.shared else -1
+        expected = {location: amount + delta for location, amount in amounts.items()}
+        if after.get(good_id) != expected:
+            problems.append(f"good {good_id} has amounts {after.get(good_id)} instead of {expected}")
+    return problems
+
+
+def print_check(problems: List[str]) -> None:
+    """Print outcome of a check."""
+    print(f"  check: {'ok' if not problems else f'{len(problems)} problems'}")
+    for problem in problems[:5]:
+        print(f"    {problem}")
+
+
+def main_benchmark() -> None:
+    """Run the stress test from command line."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8, help="concurrent writer processes (default: 8)")
+    parser.add_argument("--goods", type=int, default=20_000, help="goods of every writer (default: 20000)")
+    parser.add_argument("--shared", type=int, default=5_000, help="goods written by every writer (default: 5000)")
+    parser.add_argument("--shops-per-good", type=int, default=3, help="shops of every good (default: 3)")
+    parser.add_argument("--batch-size", type=int, default=main.DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        "--profile",
+        choices=sorted(main.CONNECTION_PROFILES),
+        default=main.DEFAULT_CONNECTION_PROFILE,
+        help=f"connection settings of writers (default: {main.DEFAULT_CONNECTION_PROFILE})",
+    )
+    parser.add_argument("--busy-timeout", type=float, help="seconds to wait for the lock (default: of the profile)")
+    parser.add_argument("--write-attempts", type=int, default=main.DEFAULT_WRITE_RETRY.attempts)
+    args = parser.parse_args()
+    if not 0 <= args.shared <= args.goods:
+        parser.error("--shared must be between 0 and --goods")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "goods.db")
+        with closing(main.connect(db_path, args.profile)) as conn:
+            main.create_tables_in_db(conn.cursor())
+        goods_paths, delta_paths = write_inputs(tmp_dir, args)
+        run_phase("goods", db_path, goods_paths, os.path.join(ROOT, "goods.schema.json"), args)
+        with closing(main.connect(db_path, args.profile)) as conn:
+            print_check(check_goods(conn, args))
+            before = read_shops(conn)
+        run_phase("deltas", db_path, delta_paths, os.path.join(ROOT, "delta.schema.json"), args)
+        with closing(main.connect(db_path, args.profile)) as conn:
+            print_check(check_deltas(before, conn, args))
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,185 @@
+"""Streaming export of goods with their shops for downstream consumers.
+
+Goods are read by main.iter_goods in the shape of goods.schema.json and written as NDJSON or as
+a JSON array, with a fixed number of rows in memory whatever the size of the tables. An export
+reads one snapshot in a single read transaction, so in WAL mode it doesn't block writers and
+readers of the export don't touch the database file at all.
+
+Incremental exports hold only goods changed since a watermark. The watermark of an export is
+the latest version of a good in its snapshot, see main.enable_change_tracking: the next export
+since that watermark holds every good changed after the snapshot. With --watermark-file it's
+read before the export and replaced by the new one after it, the first export is a full one.
+
+Usage: python export.py --db goods.db --output goods.ndjson [--format array] [--watermark-file goods.watermark]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from sqlite3.dbapi2 import Connection
+from typing import Iterable, Optional, Sequence, TextIO
+
+import main
+
+FORMATS = ("ndjson", "array")
+
+
+@dataclass
+class ExportReport:
+    """Outcome of an export."""
+
+    goods: int
+    watermark: int
+    since: Optional[int] = None
+    elapsed: float = 0.0
+
+    def __str__(self) -> str:
+        changed = "" if self.since is None else f" изменённых после версии {self.since}"
+        return (
+            f"Выгружено товаров{changed}: {self.goods}, версия выгрузки: {self.watermark}, "
+            f"время: {self.elapsed:.2f} с"
+        )
+
+
+def write_goods(goods: Iterable[dict], f: TextIO, file_format: str = "ndjson") -> int:
+    """Write goods to a text file as NDJSON or as a JSON array, return number of written goods."""
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown export format {file_format!r}, expected one of {FORMATS}")
+    written = 0
+    if file_format == "ndjson":
+        for good in goods:
+            f.write(json.dumps(good, ensure_ascii=False))
+            f.write("\n")
+            written += 1
+        return written
+    f.write("[")
+    for good in goods:
+        f.write(",\n" if written else "\n")
+        f.write(json.dumps(good, ensure_ascii=False))
+        written += 1
+    f.write("\n]\n" if written else "]\n")
+    return written
+
+
+def export_goods(
+    conn: Connection,
+    f: TextIO,
+    file_format: str = "ndjson",
+    since: Optional[int] = None,
+    track_changes: bool = False,
+    fetch_size: int = main.DEFAULT_FETCH_SIZE,
+) -> ExportReport:
+    """Write a snapshot of goods, or of goods changed since a watermark, to a text file.
+
+    Args:
+        conn: Database Connection object, no transaction may be open on it.
+        f: Text file to write to.
+        file_format: "ndjson" or "array".
+        since: If given, only goods whose version is greater are written.
+        track_changes: Enable change tracking if it isn't enabled, so the watermark can be used later.
+        fetch_size: Number of rows fetched at once.
+
+    Returns:
+        Number of written goods and the watermark of the snapshot.
+
+    Raises:
+        ValueError: If since is given, but changes of goods aren't tracked.
+    """
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    tracked = main.has_change_tracking(cursor)
+    if track_changes and not tracked:
+        main.enable_change_tracking(cursor)
+        tracked = True
+    if since is not None and not tracked:
+        raise ValueError("Changes of goods aren't tracked, make a full export with change tracking first")
+    cursor.execute("BEGIN")
+    try:
+        watermark = main.goods_version(cursor) if tracked else 0
+        written = write_goods(main.iter_goods(cursor, since, fetch_size), f, file_format)
+    finally:
+        conn.rollback()  # nothing is written, the read transaction is just finished
+    return ExportReport(written, watermark, since, time.perf_counter() - started)
+
+
+def export_to_file(
+    conn: Connection,
+    output: str,
+    file_format: str = "ndjson",
+    since: Optional[int] = None,
+    track_changes: bool = False,
+    fetch_size: int = main.DEFAULT_FETCH_SIZE,
+) -> ExportReport:
+    """Export goods to a file by export_goods, the file is replaced only once the export is complete."""
+    temporary = f"{output}.tmp"
+    try:
+        with open(temporary, "w", encoding="utf-8") as f:
+            report = export_goods(conn, f, file_format, since, track_changes, fetch_size)
+        os.replace(temporary, output)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return report
+
+
+def read_watermark(path: str) -> Optional[int]:
+    """Return watermark saved in a file or None if there is no file yet."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def save_watermark(path: str, watermark: int) -> None:
+    """Replace watermark saved in a file."""
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        f.write(f"{watermark}\n")
+    os.replace(f"{path}.tmp", path)
+
+
+def main_export(argv: Optional[Sequence[str]] = None) -> int:
+    """Run an export from command line and print its report."""
+    parser = argparse.ArgumentParser(description="Export goods with their shops in the shape of goods.schema.json.")
+    parser.add_argument("--db", default="goods.db", help="path to SQLite database (default: goods.db)")
+    parser.add_argument("--output", default="-", help="file to write, - for standard output (default: -)")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson", help="NDJSON or a JSON array (default: ndjson)")
+    parser.add_argument("--since", type=int, help="export only goods changed after this watermark")
+    parser.add_argument(
+        "--watermark-file",
+        help="export goods changed after the watermark in this file and save the new one to it, implies tracking",
+    )
+    parser.add_argument(
+        "--track-changes", action="store_true", help="keep versions of goods for later incremental exports"
+    )
+    parser.add_argument(
+        "--fetch-size",
+        type=int,
+        default=main.DEFAULT_FETCH_SIZE,
+        help=f"rows fetched at once (default: {main.DEFAULT_FETCH_SIZE})",
+    )
+    args = parser.parse_args(argv)
+    if args.since is not None and args.watermark_file:
+        parser.error("--since can't be used with --watermark-file")
+    since = read_watermark(args.watermark_file) if args.watermark_file else args.since
+    track_changes = args.track_changes or args.watermark_file is not None
+    with closing(main.connect(args.db)) as conn:
+        main.create_tables_in_db(conn.cursor())
+        if since is not None and not track_changes and not main.has_change_tracking(conn.cursor()):
+            parser.error("changes of goods aren't tracked, make a full export with --track-changes first")
+        if args.output == "-":
+            report = export_goods(conn, sys.stdout, args.format, since, track_changes, args.fetch_size)
+        else:
+            report = export_to_file(conn, args.output, args.format, since, track_changes, args.fetch_size)
+    if args.watermark_file:
+        save_watermark(args.watermark_file, report.watermark)
+    print(report, file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_export())
@@ -1,9 +1,301 @@
+import argparse
+import hashlib
 import json
+import marshal
+import os
+import queue
+import random
+import re
 import sqlite3
-from sqlite3.dbapi2 import Cursor
+import sys
+import threading
+import time
+import weakref
+from collections import ChainMap, OrderedDict, deque
+from contextlib import closing, contextmanager, nullcontext
+from dataclasses import dataclass, field, replace
+from sqlite3.dbapi2 import Connection, Cursor
+from types import CodeType
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TextIO,
+    Tuple,
+    TypeVar,
+)
 
-import jsonschema
-from jsonschema.exceptions import ValidationError
+import metrics
+import records
+import rejections
+import snapshot
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from jsonschema.exceptions import ValidationError
+
+    # Goods, documents, invalid documents and rejections of a work item parsed in a worker process.
+    ParsedFuture = Future[Tuple[List[dict], int, int, List[dict]]]
+
+T = TypeVar("T")
+
+DEFAULT_BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 64 * 1024
+MAX_DOCUMENT_SIZE = 16 * 1024 * 1024
+SPLIT_SIZE = 4 * 1024 * 1024
+DEFAULT_QUEUE_DEPTH = 8
+DEFAULT_FINGERPRINT_CACHE_SIZE = 100000
+SQLITE_MAX_PARAMETERS = 900
+DEFAULT_GOODS_CACHE_SIZE = 10000
+DEFAULT_GOODS_CACHE_TTL = 60.0
+DEFAULT_FETCH_SIZE = 1000
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+STAGE_SECONDS = metrics.REGISTRY.counter(
+    "goods_stage_seconds_total", "Seconds spent in ingestion stages.", labelnames=("stage",)
+)
+DOCUMENTS = metrics.REGISTRY.counter("goods_documents_total", "Documents read from input.")
+VALIDATION_FAILURES = metrics.REGISTRY.counter(
+    "goods_validation_failures_total", "Documents rejected as invalid or unreadable."
+)
+ROWS_WRITTEN = metrics.REGISTRY.counter(
+    "goods_rows_written_total", "Rows inserted or updated by writers.", labelnames=("table",)
+)
+SKIPPED_WRITES = metrics.REGISTRY.counter("goods_skipped_writes_total", "Rows not written because they are unchanged.")
+COLLAPSED_DOCUMENTS = metrics.REGISTRY.counter(
+    "goods_collapsed_documents_total", "Documents merged into a later document of the same good in a batch."
+)
+COMMIT_SECONDS = metrics.REGISTRY.histogram("goods_commit_seconds", "Latency of transaction commits in seconds.")
+LOCK_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    "goods_lock_wait_seconds", "Seconds write transactions waited for the write lock of the database."
+)
+WRITE_RETRIES = metrics.REGISTRY.counter(
+    "goods_write_retries_total", "Write transactions retried because the database stayed locked."
+)
+
+# Changes of tables created by earlier versions, applied by migrate_db in order.
+MIGRATIONS = (
+    # Unique (id_good, location) index: removes duplicates, makes shop lookups indexed and is the UPSERT target.
+    """
+    DELETE FROM shops_goods WHERE id NOT IN (SELECT max(id) FROM shops_goods GROUP BY id_good, location);
+    CREATE UNIQUE INDEX IF NOT EXISTS shops_goods_id_good_location ON shops_goods (id_good, location);
+    """,
+    # Stock aggregates for the website, maintained by triggers in the transactions writing shops_goods.
+    """
+    CREATE TABLE goods_stock (
+        id_good INTEGER NOT NULL PRIMARY KEY,
+        total_amount INTEGER NOT NULL,
+        locations INTEGER NOT NULL,
+        out_of_stock_locations INTEGER NOT NULL
+    );
+    CREATE TABLE location_stock (
+        location VARCHAR(100) NOT NULL PRIMARY KEY,
+        total_amount INTEGER NOT NULL,
+        goods INTEGER NOT NULL,
+        out_of_stock_goods INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    INSERT INTO goods_stock
+        SELECT id_good, sum(amount), count(*), sum(amount = 0) FROM shops_goods GROUP BY id_good;
+    INSERT INTO location_stock
+        SELECT location, sum(amount), count(*), sum(amount = 0) FROM shops_goods GROUP BY location;
+    CREATE INDEX goods_stock_total_amount ON goods_stock (total_amount);
+    CREATE INDEX shops_goods_location_amount ON shops_goods (location, amount);
+    CREATE TRIGGER shops_goods_stock_insert AFTER INSERT ON shops_goods BEGIN
+        INSERT INTO goods_stock VALUES (NEW.id_good, NEW.amount, 1, NEW.amount = 0)
+            ON CONFLICT (id_good) DO UPDATE SET
+                total_amount = total_amount + excluded.total_amount,
+                locations = locations + 1,
+                out_of_stock_locations = out_of_stock_locations + excluded.out_of_stock_locations;
+        INSERT INTO location_stock VALUES (NEW.location, NEW.amount, 1, NEW.amount = 0)
+            ON CONFLICT (location) DO UPDATE SET
+                total_amount = total_amount + excluded.total_amount,
+                goods = goods + 1,
+                out_of_stock_goods = out_of_stock_goods + excluded.out_of_stock_goods;
+    END;
+    CREATE TRIGGER shops_goods_stock_delete AFTER DELETE ON shops_goods BEGIN
+        UPDATE goods_stock SET
+            total_amount = total_amount - OLD.amount,
+            locations = locations - 1,
+            out_of_stock_locations = out_of_stock_locations - (OLD.amount = 0)
+        WHERE id_good = OLD.id_good;
+        UPDATE location_stock SET
+            total_amount = total_amount - OLD.amount,
+            goods = goods - 1,
+            out_of_stock_goods = out_of_stock_goods - (OLD.amount = 0)
+        WHERE location = OLD.location;
+        DELETE FROM goods_stock WHERE id_good = OLD.id_good AND locations = 0;
+        DELETE FROM location_stock WHERE location = OLD.location AND goods = 0;
+    END;
+    CREATE TRIGGER shops_goods_stock_update_amount AFTER UPDATE OF amount ON shops_goods
+    WHEN OLD.id_good = NEW.id_good AND OLD.location = NEW.location BEGIN
+        UPDATE goods_stock SET
+            total_amount = total_amount - OLD.amount + NEW.amount,
+            out_of_stock_locations = out_of_stock_locations - (OLD.amount = 0) + (NEW.amount = 0)
+        WHERE id_good = NEW.id_good;
+        UPDATE location_stock SET
+            total_amount = total_amount - OLD.amount + NEW.amount,
+            out_of_stock_goods = out_of_stock_goods - (OLD.amount = 0) + (NEW.amount = 0)
+        WHERE location = NEW.location;
+    END;
+    CREATE TRIGGER shops_goods_stock_update_key AFTER UPDATE OF id_good, location ON shops_goods
+    WHEN OLD.id_good != NEW.id_good OR OLD.location != NEW.location BEGIN
+        UPDATE goods_stock SET
+            total_amount = total_amount - OLD.amount,
+            locations = locations - 1,
+            out_of_stock_locations = out_of_stock_locations - (OLD.amount = 0)
+        WHERE id_good = OLD.id_good;
+        UPDATE location_stock SET
+            total_amount = total_amount - OLD.amount,
+            goods = goods - 1,
+            out_of_stock_goods = out_of_stock_goods - (OLD.amount = 0)
+        WHERE location = OLD.location;
+        DELETE FROM goods_stock WHERE id_good = OLD.id_good AND locations = 0;
+        DELETE FROM location_stock WHERE location = OLD.location AND goods = 0;
+        INSERT INTO goods_stock VALUES (NEW.id_good, NEW.amount, 1, NEW.amount = 0)
+            ON CONFLICT (id_good) DO UPDATE SET
+                total_amount = total_amount + excluded.total_amount,
+                locations = locations + 1,
+                out_of_stock_locations = out_of_stock_locations + excluded.out_of_stock_locations;
+        INSERT INTO location_stock VALUES (NEW.location, NEW.amount, 1, NEW.amount = 0)
+            ON CONFLICT (location) DO UPDATE SET
+                total_amount = total_amount + excluded.total_amount,
+                goods = goods + 1,
+                out_of_stock_goods = out_of_stock_goods + excluded.out_of_stock_goods;
+    END;
+    """,
+)
+
+# Optional normalized layout made by normalize_db: shops are stored once in locations table and stock rows
+# refer to them by id. shops_goods becomes a view of the original shape and the stock triggers move to stock.
+NORMALIZE_SCRIPT = """
+    CREATE TABLE locations (
+        id INTEGER NOT NULL PRIMARY KEY,
+        name VARCHAR(100) NOT NULL UNIQUE
+    );
+    CREATE TABLE stock (
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        id_good INTEGER NOT NULL,
+        id_location INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        FOREIGN KEY (id_good) references goods(id),
+        FOREIGN KEY (id_location) references locations(id)
+    );
+    INSERT INTO locations (name) SELECT DISTINCT location FROM shops_goods ORDER BY location;
+    INSERT INTO stock
+        SELECT shops_goods.id, id_good, locations.id, amount
+        FROM shops_goods JOIN locations ON locations.name = shops_goods.location;
+    DROP TABLE shops_goods;
+    CREATE UNIQUE INDEX stock_id_good_location ON stock (id_good, id_location);
+    CREATE INDEX stock_location_amount ON stock (id_location, amount);
+    CREATE VIEW shops_goods AS
+        SELECT stock.id AS id, id_good, locations.name AS location, amount
+        FROM stock JOIN locations ON locations.id = stock.id_location;
+    CREATE TRIGGER stock_insert AFTER INSERT ON stock BEGIN
+        INSERT INTO goods_stock VALUES (NEW.id_good, NEW.amount, 1, NEW.amount = 0)
+            ON CONFLICT (id_good) DO UPDATE SET
+                total_amount = total_amount + excluded.total_amount,
+                locations = locations + 1,
+                out_of_stock_locations = out_of_stock_locations + excluded.out_of_stock_locations;
+        INSERT INTO location_stock
+            SELECT name, NEW.amount, 1, NEW.amount = 0 FROM locations WHERE id = NEW.id_location
+            ON CONFLICT (location) DO UPDATE SET
+                total_amount = total_amount + excluded.total_amount,
+                goods = goods + 1,
+                out_of_stock_goods = out_of_stock_goods + excluded.out_of_stock_goods;
+    END;
+    CREATE TRIGGER stock_delete AFTER DELETE ON stock BEGIN
+        UPDATE goods_stock SET
+            total_amount = total_amount - OLD.amount,
+            locations = locations - 1,
+            out_of_stock_locations = out_of_stock_locations - (OLD.amount = 0)
+        WHERE id_good = OLD.id_good;
+        UPDATE location_stock SET
+            total_amount = total_amount - OLD.amount,
+            goods = goods - 1,
+            out_of_stock_goods = out_of_stock_goods - (OLD.amount = 0)
+        WHERE location = (SELECT name FROM locations WHERE id = OLD.id_location);
+        DELETE FROM goods_stock WHERE id_good = OLD.id_good AND locations = 0;
+        DELETE FROM location_stock
+        WHERE location = (SELECT name FROM locations WHERE id = OLD.id_location) AND goods = 0;
+    END;
+    CREATE TRIGGER stock_update_amount AFTER UPDATE OF amount ON stock
+    WHEN OLD.id_good = NEW.id_good AND OLD.id_location = NEW.id_location BEGIN
+        UPDATE goods_stock SET
+            total_amount = total_amount - OLD.amount + NEW.amount,
+            out_of_stock_locations = out_of_stock_locations - (OLD.amount = 0) + (NEW.amount = 0)
+        WHERE id_good = NEW.id_good;
+        UPDATE location_stock SET
+            total_amount = total_amount - OLD.amount + NEW.amount,
+            out_of_stock_goods = out_of_stock_goods - (OLD.amount = 0) + (NEW.amount = 0)
+        WHERE location = (SELECT name FROM locations WHERE id = NEW.id_location);
+    END;
+    CREATE TRIGGER stock_update_key AFTER UPDATE OF id_good, id_location ON stock
+    WHEN OLD.id_good != NEW.id_good OR OLD.id_location != NEW.id_location BEGIN
+        UPDATE goods_stock SET
+            total_amount = total_amount - OLD.amount,
+            locations = locations - 1,
+            out_of_stock_locations = out_of_stock_locations - (OLD.amount = 0)
+        WHERE id_good = OLD.id_good;
+        UPDATE location_stock SET
+            total_amount = total_amount - OLD.amount,
+            goods = goods - 1,
+            out_of_stock_goods = out_of_stock_goods - (OLD.amount = 0)
+        WHERE location = (SELECT name FROM locations WHERE id = OLD.id_location);
+        DELETE FROM goods_stock WHERE id_good = OLD.id_good AND locations = 0;
+        DELETE FROM location_stock
+        WHERE location = (SELECT name FROM locations WHERE id = OLD.id_location) AND goods = 0;
+        INSERT INTO goods_stock VALUES (NEW.id_good, NEW.amount, 1, NEW.amount = 0)
+            ON CONFLICT (id_good) DO UPDATE SET
+                total_amount = total_amount + excluded.total_amount,
+                locations = locations + 1,
+                out_of_stock_locations = out_of_stock_locations + excluded.out_of_stock_locations;
+        INSERT INTO location_stock
+            SELECT name, NEW.amount, 1, NEW.amount = 0 FROM locations WHERE id = NEW.id_location
+            ON CONFLICT (location) DO UPDATE SET
+                total_amount = total_amount + excluded.total_amount,
+                goods = goods + 1,
+                out_of_stock_goods = out_of_stock_goods + excluded.out_of_stock_goods;
+    END;
+"""
+
+# Versions of goods for incremental exports, created by enable_change_tracking. Every real change of a goods
+# row or of a shop of a good gives the good the next version. Formatted with the table keeping shops of
+# the layout and its shop column, the statements giving a good the next version are formatted with its id.
+CHANGE_TRACKING_SCRIPT = """
+    CREATE TABLE IF NOT EXISTS goods_versions (
+        id_good INTEGER NOT NULL PRIMARY KEY,
+        version INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS goods_versions_version ON goods_versions (version);
+    CREATE TRIGGER IF NOT EXISTS goods_version_insert AFTER INSERT ON goods BEGIN {bump_new_id} END;
+    CREATE TRIGGER IF NOT EXISTS goods_version_update AFTER UPDATE ON goods
+    WHEN OLD.name IS NOT NEW.name OR OLD.package_height IS NOT NEW.package_height
+        OR OLD.package_width IS NOT NEW.package_width OR OLD.id != NEW.id BEGIN
+        {bump_new_id}
+    END;
+    CREATE TRIGGER IF NOT EXISTS {shops}_version_insert AFTER INSERT ON {shops} BEGIN {bump_new_good} END;
+    CREATE TRIGGER IF NOT EXISTS {shops}_version_delete AFTER DELETE ON {shops} BEGIN {bump_old_good} END;
+    CREATE TRIGGER IF NOT EXISTS {shops}_version_update_amount AFTER UPDATE OF amount ON {shops}
+    WHEN OLD.amount IS NOT NEW.amount BEGIN {bump_new_good} END;
+    CREATE TRIGGER IF NOT EXISTS {shops}_version_update_key AFTER UPDATE OF id_good, {location} ON {shops}
+    WHEN OLD.id_good != NEW.id_good OR OLD.{location} != NEW.{location} BEGIN
+        {bump_old_good}
+        {bump_new_good}
+    END;
+"""
+_BUMP_VERSION = """INSERT INTO goods_versions VALUES ({}, (SELECT coalesce(max(version), 0) + 1 FROM goods_versions))
+            ON CONFLICT (id_good) DO UPDATE SET version = excluded.version;"""
 
 
 def read_json(json_file: str) -> dict:
@@ -19,24 +311,528 @@ def read_json(json_file: str) -> dict:
         return json.load(f)
 
 
-def is_data_valid(instance: dict, schema: dict) -> bool:
+def iter_json_documents(
+    json_file: str, chunk_size: int = READ_CHUNK_SIZE, max_document_size: int = MAX_DOCUMENT_SIZE
+) -> Iterator[Any]:
+    """Lazily deserialize JSON-documents from JSON-file reading it by chunks.
+
+    The file may contain a single document, newline-delimited (or just whitespace-separated)
+    documents or a top-level array of documents. Only the current chunk and the document being
+    decoded are kept in memory, so files of any size are read with constant memory. A document
+    which can't be decoded is read on only up to max_document_size characters, a malformed
+    document doesn't make the rest of the file buffered.
+
+    Args:
+        json_file: A path to json-file containing JSON documents.
+        chunk_size: Number of characters read from the file at once.
+        max_document_size: Number of characters a document may take at most.
+
+    Yields:
+        Python objects, one per document or per item of top-level array.
+
+    Raises:
+        ValueError: If the file is not valid JSON or a document is longer than max_document_size.
+    """
+    return _iter_json_documents(json_file, chunk_size, 0, False, max_document_size)
+
+
+def iter_json_documents_with_offsets(
+    json_file: str, start: int = 0, chunk_size: int = READ_CHUNK_SIZE, max_document_size: int = MAX_DOCUMENT_SIZE
+) -> Iterator[Tuple[Any, int]]:
+    """Lazily deserialize JSON-documents like iter_json_documents, telling where every one ends.
+
+    Reading may start at an offset yielded for a document of the same file, the rest of the file
+    is then read as if it was read from the beginning: documents after that one and, for
+    a top-level array, its closing bracket.
+
+    Args:
+        json_file: A path to json-file containing JSON documents.
+        start: Byte offset to start reading at, 0 or the end of a document.
+        chunk_size: Number of characters read from the file at once.
+        max_document_size: Number of characters a document may take at most.
+
+    Yields:
+        Tuples of Python object and byte offset in the file right after its document.
+
+    Raises:
+        ValueError: If the file is not valid JSON or a document is longer than max_document_size.
+    """
+    return _iter_json_documents(json_file, chunk_size, start, True, max_document_size)
+
+
+def _iter_json_documents(
+    json_file: str, chunk_size: int, start: int, offsets: bool, max_document_size: int = MAX_DOCUMENT_SIZE
+) -> Iterator[Any]:
+    """Yield documents of the file read from start, paired with their end offsets if offsets is true."""
+    raw_decode = json.JSONDecoder().raw_decode
+    # "start" - nothing is read yet, "stream" - whitespace-separated documents,
+    # "item"/"first item" - an array item is expected, "separator" - "," or "]" is expected, "end" - array is closed.
+    state = "start"
+    # Newlines aren't translated, so lengths of the decoded text are byte lengths of the file even with CRLF.
+    with open(json_file, "r", encoding="utf-8", newline="") as f:
+        if start:
+            state = "separator" if _starts_with_array(f, chunk_size) else "stream"
+            f.seek(start)  # positions of a UTF-8 text file are byte offsets
+        buffer, pos, eof = "", 0, False
+        # Byte offset of buffer[mark] in the file, it's advanced only up to yielded documents.
+        offset, mark = start, 0
+        while True:
+            pos = _JSON_WHITESPACE.match(buffer, pos).end()  # type: ignore[union-attr]
+            if pos == len(buffer):
+                if eof:
+                    break
+                chunk = f.read(chunk_size)
+                offset += len(buffer[mark:pos].encode())
+                buffer, pos, mark, eof = buffer[pos:] + chunk, 0, 0, not chunk
+                continue
+            char = buffer[pos]
+            if state == "start":
+                state = "first item" if char == "[" else "stream"
+                pos += char == "["
+                continue
+            if state == "end":
+                raise ValueError(f"Extra data after top-level array in {json_file}")
+            if state == "separator" or state == "first item" and char == "]":
+                if char not in ",]":
+                    raise ValueError(f"Expecting ',' or ']' at position {pos} of chunk in {json_file}")
+                state = "item" if char == "," else "end"
+                pos += 1
+                continue
+            try:
+                document, end = raw_decode(buffer, pos)
+            except json.JSONDecodeError as err:
+                if eof:
+                    raise
+                if len(buffer) - pos >= max_document_size:
+                    # Either malformed or too long, reading on would buffer the rest of the file.
+                    raise ValueError(
+                        f"Malformed document or document longer than {max_document_size} characters "
+                        f"at byte offset {offset + len(buffer[mark:pos].encode())} of {json_file}: {err}"
+                    ) from err
+                end = len(buffer)
+            if end == len(buffer) and not eof:
+                # The document may be truncated by the chunk border, decode it again with the next chunk.
+                chunk = f.read(chunk_size)
+                offset += len(buffer[mark:pos].encode())
+                buffer, pos, mark, eof = buffer[pos:] + chunk, 0, 0, not chunk
+                continue
+            if offsets:
+                offset += len(buffer[mark:end].encode())
+                mark = end
+            pos = end
+            if state != "stream":
+                state = "separator"
+            yield (document, offset) if offsets else document
+    if state in ("first item", "item", "separator"):
+        raise ValueError(f"Unterminated top-level array in {json_file}")
+
+
+def _starts_with_array(f: TextIO, chunk_size: int) -> bool:
+    """Tell whether a text file opened at its beginning holds a top-level array."""
+    while True:
+        chunk = f.read(chunk_size)
+        head = chunk.lstrip(" \t\n\r")
+        if head or not chunk:
+            return head.startswith("[")
+
+
+# Keywords that do not affect validation result, the fast checker skips them.
+_ANNOTATION_KEYWORDS = frozenset({"$schema", "$id", "$comment", "title", "description", "default", "examples"})
+# Type checks of draft 6 and later: floats with zero fractional part are integers, booleans are not numbers.
+_TYPE_CHECKS = {
+    "object": "isinstance({0}, dict)",
+    "array": "isinstance({0}, list)",
+    "string": "isinstance({0}, str)",
+    "integer": "(isinstance({0}, int) and not isinstance({0}, bool) or isinstance({0}, float) and {0}.is_integer())",
+    "number": "(isinstance({0}, (int, float)) and not isinstance({0}, bool))",
+    "boolean": "isinstance({0}, bool)",
+    "null": "{0} is None",
+}
+
+
+class _UnsupportedSchema(Exception):
+    """Schema uses a keyword the fast checker can't generate code for."""
+
+
+class _CheckerSourceGenerator:
+    """Generator of Python source of a function checking instances against a schema."""
+
+    def __init__(self) -> None:
+        self.functions: List[str] = []
+        self.constants: List[str] = []
+        self._names = 0
+
+    def new_name(self, prefix: str) -> str:
+        self._names += 1
+        return f"{prefix}{self._names}"
+
+    def function(self, schema: Any) -> str:
+        """Generate a function returning True if its argument is valid to schema, return its name."""
+        name = self.new_name("_check")
+        body = self.body(schema, "instance", 1)
+        self.functions.append("\n".join([f"def {name}(instance):", *body, "    return True"]))
+        return name
+
+    def body(self, schema: Any, var: str, depth: int) -> List[str]:
+        """Generate statements returning False if var is not valid to schema."""
+        indent = "    " * depth
+        if schema is True or schema == {}:
+            return []
+        if schema is False:
+            return [f"{indent}return False"]
+        if not isinstance(schema, dict):
+            raise _UnsupportedSchema(schema)
+        keywords = set(schema) - _ANNOTATION_KEYWORDS
+        if "items" in schema and isinstance(schema["items"], dict):
+            keywords.discard("additionalItems")  # ignored when items is a single schema
+        unsupported = keywords - {"type", "required", "properties", "additionalProperties", "items", "anyOf"}
+        if unsupported:
+            raise _UnsupportedSchema(unsupported)
+
+        lines = []
+        if "type" in schema:
+            types = [schema["type"]] if isinstance(schema["type"], str) else schema["type"]
+            if any(type_name not in _TYPE_CHECKS for type_name in types):
+                raise _UnsupportedSchema(types)
+            lines.append(f"{indent}if not ({' or '.join(_TYPE_CHECKS[t].format(var) for t in types)}):")
+            lines.append(f"{indent}    return False")
+        if "anyOf" in schema:
+            names = [self.function(subschema) for subschema in schema["anyOf"]]
+            lines.append(f"{indent}if not ({' or '.join(f'{name}({var})' for name in names)}):")
+            lines.append(f"{indent}    return False")
+
+        object_lines = []
+        properties = schema.get("properties", {})
+        if schema.get("required"):
+            required = self.constant(frozenset(schema["required"]))
+            object_lines.append(f"{indent}    if not {required} <= {var}.keys():")
+            object_lines.append(f"{indent}        return False")
+        additional = schema.get("additionalProperties", True)
+        if additional is False:
+            known = self.constant(frozenset(properties))
+            object_lines.append(f"{indent}    if not {var}.keys() <= {known}:")
+            object_lines.append(f"{indent}        return False")
+        elif additional is not True:
+            raise _UnsupportedSchema(additional)
+        for key, subschema in properties.items():
+            value = self.new_name("value")
+            subbody = self.body(subschema, value, depth + 2)
+            if subbody:
+                object_lines.append(f"{indent}    if {key!r} in {var}:")
+                object_lines.append(f"{indent}        {value} = {var}[{key!r}]")
+                object_lines.extend(subbody)
+        if object_lines:
+            lines.append(f"{indent}if isinstance({var}, dict):")
+            lines.extend(object_lines)
+
+        if "items" in schema:
+            if not isinstance(schema["items"], (dict, bool)):
+                raise _UnsupportedSchema(schema["items"])
+            item = self.new_name("item")
+            subbody = self.body(schema["items"], item, depth + 2)
+            if subbody:
+                lines.append(f"{indent}if isinstance({var}, list):")
+                lines.append(f"{indent}    for {item} in {var}:")
+                lines.extend(subbody)
+        return lines
+
+    def constant(self, value: Any) -> str:
+        name = self.new_name("_CONST")
+        self.constants.append(f"{name} = {value!r}")
+        return name
+
+
+def generate_checker_source(schema: dict) -> Optional[str]:
+    """Generate source of a specialized checker for schema.
+
+    The generated module defines function check(instance) -> bool which checks types,
+    required keys, properties, additionalProperties, items and anyOf directly, without
+    jsonschema machinery. Instances are expected to be deserialized from JSON.
+
+    Args:
+        schema: Draft 6 or draft 7 schema.
+
+    Returns:
+        Source code of the module or None if schema uses keywords the checker does not support.
+    """
+    from jsonschema import Draft6Validator, Draft7Validator, validators
+
+    if validators.validator_for(schema) not in (Draft6Validator, Draft7Validator):
+        return None
+    generator = _CheckerSourceGenerator()
+    try:
+        name = generator.function(schema)
+    except _UnsupportedSchema:
+        return None
+    return "\n\n".join([*generator.constants, *generator.functions, f"check = {name}"]) + "\n"
+
+
+def _compile_checker_code(schema: dict) -> Optional[CodeType]:
+    """Return code object of the checker module generated for schema or None if schema is not supported."""
+    source = generate_checker_source(schema)
+    return None if source is None else compile(source, "<schema checker>", "exec")
+
+
+def _checker_from_code(code: CodeType) -> Callable[[Any], bool]:
+    """Execute code of a checker module and return its check function."""
+    namespace: Dict[str, Any] = {}
+    exec(code, namespace)
+    return namespace["check"]
+
+
+def compile_fast_checker(schema: dict) -> Optional[Callable[[Any], bool]]:
+    """Compile a specialized checker for schema, see generate_checker_source.
+
+    Returns:
+        Function returning True if instance is valid to schema or None if schema is not supported.
+    """
+    code = _compile_checker_code(schema)
+    return None if code is None else _checker_from_code(code)
+
+
+# Bump when generated checkers change, so checkers cached by earlier versions aren't loaded.
+CHECKER_CACHE_VERSION = 1
+
+_checker_cache_dir: Optional[str] = None
+
+
+def default_checker_cache_dir() -> str:
+    """Return directory of cached checkers in the user cache directory."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "goods-accounting")
+
+
+def use_checker_cache(directory: Optional[str]) -> None:
+    """Cache code of checkers of validators created later in a directory, None disables the cache.
+
+    Generating a checker needs jsonschema to check the schema, which costs more than the whole
+    run of a process ingesting a single document. A cached checker is loaded by marshal without
+    importing jsonschema at all, it's imported only once an invalid document has to be described.
+    """
+    global _checker_cache_dir
+    _checker_cache_dir = directory
+
+
+def checker_cache_path(schema: dict, directory: str) -> str:
+    """Return path of the cached checker of schema, keyed by a hash of the schema and the Python version."""
+    key = json.dumps([CHECKER_CACHE_VERSION, schema], sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(directory, f"checker-{digest[:32]}.{sys.implementation.cache_tag}")
+
+
+def _load_cached_checker_code(path: str) -> Optional[CodeType]:
+    """Return code object cached in a file or None if it's missing or unreadable."""
+    try:
+        with open(path, "rb") as f:
+            code = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return code if isinstance(code, CodeType) else None
+
+
+def _save_cached_checker_code(path: str, code: CodeType) -> None:
+    """Write code object to a file atomically, failures to write the cache are ignored."""
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temporary, "wb") as f:
+            marshal.dump(code, f)
+        os.replace(temporary, path)
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+class SchemaValidator:
+    """Validator compiled once from a schema and reused for every instance.
+
+    The schema is checked against its meta-schema only once, on creation.
+    If fast is True and schema is supported by compile_fast_checker, instances are checked
+    by the generated checker and jsonschema is used only to describe errors of invalid ones.
+    With a checker cache, see use_checker_cache, a cached checker is used without checking the
+    schema again: it was checked before the checker was cached.
+    """
+
+    def __init__(self, schema: dict, fast: bool = True) -> None:
+        """Check schema and compile validators for it."""
+        self.schema = schema
+        self._validator: Any = None
+        self._check: Optional[Callable[[Any], bool]] = None
+        if not fast:
+            self._jsonschema_validator()
+            return
+        path = checker_cache_path(schema, _checker_cache_dir) if _checker_cache_dir is not None else None
+        code = _load_cached_checker_code(path) if path is not None else None
+        if code is None:
+            self._jsonschema_validator()
+            code = _compile_checker_code(schema)
+            if code is not None and path is not None:
+                _save_cached_checker_code(path, code)
+        self._check = None if code is None else _checker_from_code(code)
+
+    def _jsonschema_validator(self) -> Any:
+        """Return jsonschema validator of the schema, it's created and the schema is checked on the first call."""
+        if self._validator is None:
+            from jsonschema import validators
+
+            validator_class = validators.validator_for(self.schema)
+            validator_class.check_schema(self.schema)
+            self._validator = validator_class(self.schema)
+        return self._validator
+
+    def is_valid(self, instance: Any) -> bool:
+        """Return True if instance is valid to the schema."""
+        if self._check is not None:
+            return self._check(instance)
+        return self._jsonschema_validator().is_valid(instance)
+
+    def best_error(self, instance: Any) -> Optional["ValidationError"]:
+        """Return the same error jsonschema.validate would raise for instance or None if it's valid."""
+        from jsonschema.exceptions import best_match
+
+        return best_match(self._jsonschema_validator().iter_errors(instance))
+
+    def iter_errors(self, instance: Any) -> Iterator["ValidationError"]:
+        """Yield every validation error of instance."""
+        return self._jsonschema_validator().iter_errors(instance)
+
+
+_VALIDATORS: Dict[Tuple[int, bool], SchemaValidator] = {}
+
+
+def get_validator(schema: dict, fast: bool = True) -> SchemaValidator:
+    """Return validator compiled from schema, it's compiled only on the first call for a schema object.
+
+    Schemas are cached by identity, so schema must not be mutated after the first call.
+    """
+    validator = _VALIDATORS.get((id(schema), fast))
+    if validator is None or validator.schema is not schema:
+        validator = _VALIDATORS[(id(schema), fast)] = SchemaValidator(schema, fast)
+    return validator
+
+
+def is_data_valid(
+    instance: dict, schema: dict, fast: bool = True, sink: Optional[rejections.RejectionSink] = None
+) -> bool:
     """Validate an instance under the given schema.
 
     Args:
         instance: The instance to validate.
         schema: The schema to validate with.
+        fast: Use a checker generated from the schema if it's supported.
+        sink: If given, invalid instance is written to it with its errors instead of printing the best error.
 
     Returns:
         True if instance valid to schema, False if not.
     """
-    try:
-        jsonschema.validate(instance, schema)
-    except ValidationError as err:
-        print("---------------------------")
-        print("Данные не прошли валидацию:\n", err, "\n")
-        return False
-    else:
+    validator = get_validator(schema, fast)
+    if validator.is_valid(instance):
         return True
+    if sink is not None:
+        sink.reject(instance, validator.iter_errors(instance))
+        return False
+    print("---------------------------")
+    print("Данные не прошли валидацию:\n", validator.best_error(instance), "\n")
+    return False
+
+
+@dataclass(frozen=True)
+class ConnectionProfile:
+    """Settings applied to every connection opened by connect.
+
+    Attributes:
+        pragmas: PRAGMA statements executed in order right after connecting.
+        busy_timeout: Seconds to wait for a lock held by another connection before failing.
+        drop_indexes: Drop secondary indexes while loading and rebuild them afterwards, see secondary_indexes_dropped.
+    """
+
+    pragmas: Tuple[Tuple[str, Any], ...]
+    busy_timeout: float
+    drop_indexes: bool = False
+
+
+CONNECTION_PROFILES = {
+    # SQLite defaults: rollback journal and synchronous=FULL.
+    "default": ConnectionProfile(pragmas=(), busy_timeout=5.0),
+    # Readers don't block the writer, commits are durable unless the OS crashes.
+    "safe": ConnectionProfile(pragmas=(("journal_mode", "WAL"), ("synchronous", "NORMAL")), busy_timeout=30.0),
+    # Initial loads: the last transactions may be lost if the OS crashes, the database itself is not corrupted.
+    "bulk-load": ConnectionProfile(
+        pragmas=(
+            ("journal_mode", "WAL"),
+            ("synchronous", "OFF"),
+            ("cache_size", -1024 * 1024),
+            ("mmap_size", 4 * 1024 * 1024 * 1024),
+            ("temp_store", "MEMORY"),
+        ),
+        busy_timeout=300.0,
+        drop_indexes=True,
+    ),
+}
+DEFAULT_CONNECTION_PROFILE = "safe"
+
+
+def connect(database: str, profile: str = DEFAULT_CONNECTION_PROFILE, **kwargs: Any) -> Connection:
+    """Open SQLite database with settings of a profile from CONNECTION_PROFILES.
+
+    Args:
+        database: Path to database file.
+        profile: Name of the connection profile.
+        kwargs: Other arguments of sqlite3.connect, timeout replaces busy_timeout of the profile.
+
+    Returns:
+        Database Connection object.
+    """
+    settings = CONNECTION_PROFILES[profile]
+    kwargs.setdefault("timeout", settings.busy_timeout)
+    conn = sqlite3.connect(database, **kwargs)
+    for pragma, value in settings.pragmas:
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+
+@contextmanager
+def secondary_indexes_dropped(conn: Connection) -> Iterator[List[str]]:
+    """Drop secondary indexes for the time of a bulk load and rebuild them afterwards.
+
+    Unique indexes are kept: they enforce constraints and are targets of the UPSERT writers.
+    SQL of dropped indexes is kept in dropped_indexes table until they are rebuilt, so if the
+    process is killed during the load, create_tables_in_db rebuilds them on the next start.
+
+    Yields:
+        Names of dropped indexes.
+    """
+    indexes = conn.execute(
+        """SELECT name, sql FROM sqlite_master
+           WHERE type = 'index' AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE INDEX%'"""
+    ).fetchall()
+    with transaction(conn) as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS dropped_indexes (name TEXT NOT NULL PRIMARY KEY, sql TEXT NOT NULL)")
+        cursor.executemany("INSERT OR REPLACE INTO dropped_indexes (name, sql) VALUES (?, ?)", indexes)
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX "{name}"')
+    try:
+        yield [name for name, _ in indexes]
+    finally:
+        rebuild_dropped_indexes(conn.cursor())
+
+
+def rebuild_dropped_indexes(cursor: Cursor) -> List[str]:
+    """Rebuild indexes dropped by secondary_indexes_dropped which aren't rebuilt yet, in one transaction.
+
+    Returns:
+        Names of rebuilt indexes.
+    """
+    if not cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dropped_indexes'").fetchone():
+        return []
+    with transaction(cursor.connection):
+        pending = cursor.execute("SELECT name, sql FROM dropped_indexes").fetchall()
+        existing = {name for name, in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for name, sql in pending:
+            if name not in existing:
+                cursor.execute(sql)
+        cursor.execute("DELETE FROM dropped_indexes")
+    return [name for name, _ in pending if name not in existing]
 
 
 def create_tables_in_db(cursor: Cursor) -> None:
@@ -58,6 +854,157 @@ def create_tables_in_db(cursor: Cursor) -> None:
                     );
                     """
     )
+    migrate_db(cursor)
+    rebuild_dropped_indexes(cursor)  # left dropped by a killed bulk load
+
+
+def migrate_db(cursor: Cursor) -> int:
+    """Apply pending MIGRATIONS to database, each one in its own transaction.
+
+    The number of applied migrations is stored in PRAGMA user_version of the database.
+
+    Returns:
+        Number of migrations applied by this call.
+    """
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            cursor.executescript(f"BEGIN; {script} PRAGMA user_version = {number}; COMMIT;")
+        except sqlite3.Error:
+            cursor.connection.rollback()
+            raise
+    return max(len(MIGRATIONS) - version, 0)
+
+
+def is_normalized(cursor: Cursor) -> bool:
+    """Return True if database has the normalized layout made by normalize_db."""
+    row = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'locations'").fetchone()
+    return row is not None
+
+
+def _used_bytes(cursor: Cursor) -> int:
+    page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    return (page_count - freelist_count) * cursor.execute("PRAGMA page_size").fetchone()[0]
+
+
+@dataclass
+class SizeReport:
+    """Bytes of database pages in use before and after normalize_db."""
+
+    before: int
+    after: int
+
+    def __str__(self) -> str:
+        change = (self.after / self.before - 1) * 100 if self.before else 0.0
+        return (
+            f"Размер данных до нормализации: {self.before / 2**20:.1f} МиБ, "
+            f"после: {self.after / 2**20:.1f} МиБ ({change:+.1f}%)"
+        )
+
+
+def normalize_db(cursor: Cursor) -> SizeReport:
+    """Move shops_goods rows to stock table referring to shops in locations table, in one transaction.
+
+    Ids of rows are kept and shops_goods is replaced by a view of the same shape, so readers
+    don't change. Writers use the stock table when they are given LocationIds or find the
+    database normalized. Freed pages are reused by later writes, VACUUM returns them to the file system.
+
+    Returns:
+        Bytes in use before and after the migration.
+    """
+    before = _used_bytes(cursor)
+    script = NORMALIZE_SCRIPT
+    if has_change_tracking(cursor):
+        script += _change_tracking_script("stock", "id_location")
+    try:
+        cursor.executescript(f"BEGIN; {script} COMMIT;")
+    except sqlite3.Error:
+        cursor.connection.rollback()
+        raise
+    return SizeReport(before, _used_bytes(cursor))
+
+
+def _change_tracking_script(shops: str, location: str) -> str:
+    """Return CHANGE_TRACKING_SCRIPT for shops table with location column."""
+    return CHANGE_TRACKING_SCRIPT.format(
+        shops=shops,
+        location=location,
+        bump_new_id=_BUMP_VERSION.format("NEW.id"),
+        bump_new_good=_BUMP_VERSION.format("NEW.id_good"),
+        bump_old_good=_BUMP_VERSION.format("OLD.id_good"),
+    )
+
+
+def has_change_tracking(cursor: Cursor) -> bool:
+    """Return True if versions of changed goods are kept in goods_versions table."""
+    row = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'goods_versions'").fetchone()
+    return row is not None
+
+
+def enable_change_tracking(cursor: Cursor) -> None:
+    """Create goods_versions table and triggers giving every changed good the next version.
+
+    Writers pay for the triggers, so versions are only kept once an incremental export asks for
+    them. Changes made earlier have no versions and are only seen by full exports. Rewrites of
+    rows with the same values don't change versions, deleted goods keep their last version.
+    """
+    shops, location = ("stock", "id_location") if is_normalized(cursor) else ("shops_goods", "location")
+    try:
+        cursor.executescript(f"BEGIN; {_change_tracking_script(shops, location)} COMMIT;")
+    except sqlite3.Error:
+        cursor.connection.rollback()
+        raise
+
+
+def goods_version(cursor: Cursor) -> int:
+    """Return the latest version given to a good, 0 if there is none."""
+    return cursor.execute("SELECT coalesce(max(version), 0) FROM goods_versions").fetchone()[0]
+
+
+class LocationIds:
+    """Interned ids of shops of a normalized database.
+
+    Ids of every known shop are kept in memory, so writers map locations to ids without
+    queries. Shops met for the first time are inserted into locations table in the
+    transaction writing their rows, their ids are kept after the transaction commits.
+    """
+
+    def __init__(self, cursor: Cursor) -> None:
+        """Load ids of every shop, the database must be normalized."""
+        self._ids: Dict[str, int] = dict(cursor.execute("SELECT name, id FROM locations"))
+        self._uncommitted: Dict[str, int] = {}
+
+    @classmethod
+    def of_database(cls, cursor: Cursor) -> Optional["LocationIds"]:
+        """Return interned ids of a normalized database or None if it has the original layout."""
+        return cls(cursor) if is_normalized(cursor) else None
+
+    def resolve(self, cursor: Cursor, locations: Iterable[str]) -> Mapping[str, int]:
+        """Return mapping with ids of every location, inserting unknown ones into locations table."""
+        new = {location for location in locations if location not in self._ids and location not in self._uncommitted}
+        if new:
+            cursor.executemany(
+                "INSERT INTO locations (name) VALUES (?) ON CONFLICT (name) DO NOTHING", ((name,) for name in new)
+            )
+            for names in iter_batches(sorted(new), SQLITE_MAX_PARAMETERS):
+                placeholders = ", ".join("?" * len(names))
+                self._uncommitted.update(
+                    cursor.execute(f"SELECT name, id FROM locations WHERE name IN ({placeholders})", names)
+                )
+        return ChainMap(self._uncommitted, self._ids) if self._uncommitted else self._ids
+
+    def commit(self) -> None:
+        """Keep ids of shops inserted by the committed transaction."""
+        self._ids.update(self._uncommitted)
+        self._uncommitted.clear()
+
+    def rollback(self) -> None:
+        """Forget ids of shops inserted by the rolled back transaction."""
+        self._uncommitted.clear()
+
+    def __len__(self) -> int:
+        return len(self._ids)
 
 
 def prepare_data_for_insert_update(data: dict) -> dict:
@@ -72,6 +1019,11 @@ def prepare_data_for_insert_update(data: dict) -> dict:
     return prepared_data
 
 
+def prepare_stock_delta(data: dict) -> dict:
+    """Prepare incoming stock-delta event for merging with write_stock_deltas."""
+    return {"id_good": data["id_good"], "location": data["location"], "delta": data["delta"]}
+
+
 def insert_or_replace_data_to_goods_table(cursor: Cursor, prepared_data: dict) -> None:
     """Insert goods data or update it if goods already exists in goods table.
 
@@ -79,11 +1031,7 @@ def insert_or_replace_data_to_goods_table(cursor: Cursor, prepared_data: dict) -
         cursor: Database Cursor object.
         prepared_data: Incoming data after preparation.
     """
-    cursor.execute(
-        """INSERT OR REPLACE INTO goods
-                   VALUES (:id, :name, :height, :width)""",
-        prepared_data,
-    )
+    insert_or_replace_batch_to_goods_table(cursor, [prepared_data])
 
 
 def insert_or_replace_data_to_shops_goods_table(cursor: Cursor, prepared_data: dict) -> None:
@@ -93,26 +1041,1427 @@ def insert_or_replace_data_to_shops_goods_table(cursor: Cursor, prepared_data: d
         cursor: Database Cursor object.
         prepared_data: Incoming data after preparation.
     """
-    for shop in prepared_data["location_and_quantity"]:
+    insert_or_replace_batch_to_shops_goods_table(cursor, [prepared_data])
+
+
+def insert_or_replace_batch_to_goods_table(cursor: Cursor, batch: Sequence[dict]) -> None:
+    """Insert or update in place a batch of goods in goods table with a single executemany call.
+
+    Args:
+        cursor: Database Cursor object.
+        batch: Incoming data after preparation, one item per good.
+    """
+    cursor.executemany(
+        """INSERT INTO goods VALUES (:id, :name, :height, :width)
+                   ON CONFLICT (id) DO UPDATE SET
+                       name = excluded.name,
+                       package_height = excluded.package_height,
+                       package_width = excluded.package_width""",
+        batch,
+    )
+    ROWS_WRITTEN.labels(table="goods").inc(max(cursor.rowcount, 0))
+    invalidate_cached_goods(prepared_data["id"] for prepared_data in batch)
+
+
+def insert_or_replace_batch_to_shops_goods_table(
+    cursor: Cursor, batch: Sequence[dict], locations: Optional[LocationIds] = None
+) -> None:
+    """Insert or update in place shops of a batch of goods in shops_goods table with a single executemany call.
+
+    Existing rows are found by the unique (id_good, location) index and keep their ids.
+
+    Args:
+        cursor: Database Cursor object.
+        batch: Incoming data after preparation, one item per good.
+        locations: Interned shop ids of a normalized database, rows are written to its stock table.
+    """
+    if locations is not None:
+        shops = [
+            (prepared_data["id"], shop["location"], shop["amount"])
+            for prepared_data in batch
+            for shop in prepared_data["location_and_quantity"]
+        ]
+        _upsert_stock(cursor, shops, locations)
+        invalidate_cached_goods(prepared_data["id"] for prepared_data in batch)
+        return
+    cursor.executemany(
+        """INSERT INTO shops_goods (id_good, location, amount) VALUES (:id_good, :location, :amount)
+                   ON CONFLICT (id_good, location) DO UPDATE SET amount = excluded.amount""",
+        (
+            {"id_good": prepared_data["id"], "location": shop["location"], "amount": shop["amount"]}
+            for prepared_data in batch
+            for shop in prepared_data["location_and_quantity"]
+        ),
+    )
+    ROWS_WRITTEN.labels(table="shops_goods").inc(max(cursor.rowcount, 0))
+    invalidate_cached_goods(prepared_data["id"] for prepared_data in batch)
+
+
+def insert_or_replace_records_to_goods_table(cursor: Cursor, batch: records.GoodsBatch) -> None:
+    """Insert or update in place goods of a column batch in goods table with a single executemany call.
+
+    Args:
+        cursor: Database Cursor object.
+        batch: Valid goods collected into columns.
+    """
+    cursor.executemany(
+        """INSERT INTO goods VALUES (?, ?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET
+                       name = excluded.name,
+                       package_height = excluded.package_height,
+                       package_width = excluded.package_width""",
+        batch.goods_rows(),
+    )
+    ROWS_WRITTEN.labels(table="goods").inc(max(cursor.rowcount, 0))
+    invalidate_cached_goods(batch.ids)
+
+
+def insert_or_replace_records_to_shops_goods_table(
+    cursor: Cursor, batch: records.GoodsBatch, locations: Optional[LocationIds] = None
+) -> None:
+    """Insert or update in place shops of a column batch in shops_goods table with a single executemany call.
+
+    Args:
+        cursor: Database Cursor object.
+        batch: Valid goods collected into columns.
+        locations: Interned shop ids of a normalized database, rows are written to its stock table.
+    """
+    if locations is not None:
+        _upsert_stock(cursor, batch.shop_rows(), locations)
+        invalidate_cached_goods(batch.ids)
+        return
+    cursor.executemany(
+        """INSERT INTO shops_goods (id_good, location, amount) VALUES (?, ?, ?)
+                   ON CONFLICT (id_good, location) DO UPDATE SET amount = excluded.amount""",
+        batch.shop_rows(),
+    )
+    ROWS_WRITTEN.labels(table="shops_goods").inc(max(cursor.rowcount, 0))
+    invalidate_cached_goods(batch.ids)
+
+
+def _upsert_stock(
+    cursor: Cursor,
+    shops: Iterable[Tuple[int, str, int]],
+    locations: LocationIds,
+    new_amount: str = "excluded.amount",
+) -> None:
+    """Insert or update (id_good, location, amount) rows in stock table of a normalized database."""
+    shops = list(shops)
+    location_ids = locations.resolve(cursor, {location for _, location, _ in shops})
+    cursor.executemany(
+        f"""INSERT INTO stock (id_good, id_location, amount) VALUES (?, ?, ?)
+                   ON CONFLICT (id_good, id_location) DO UPDATE SET amount = {new_amount}""",
+        ((id_good, location_ids[location], amount) for id_good, location, amount in shops),
+    )
+    ROWS_WRITTEN.labels(table="shops_goods").inc(max(cursor.rowcount, 0))
+
+
+def merge_stock_deltas(deltas: Iterable[dict]) -> Dict[Tuple[int, str], int]:
+    """Sum deltas of stock-delta events of the same good and shop, keys with zero sum are dropped.
+
+    Args:
+        deltas: Events in the shape of delta.schema.json.
+
+    Returns:
+        Summed delta by (id_good, location) in order of the first event of every key.
+    """
+    merged: Dict[Tuple[int, str], int] = {}
+    for event in deltas:
+        key = event["id_good"], event["location"]
+        merged[key] = merged.get(key, 0) + event["delta"]
+    return {key: delta for key, delta in merged.items() if delta}
+
+
+def apply_stock_deltas_to_shops_goods_table(
+    cursor: Cursor, deltas: Dict[Tuple[int, str], int], locations: Optional[LocationIds] = None
+) -> None:
+    """Add merged deltas to amounts in shops_goods table with a single executemany call.
+
+    A shop missing for a good is inserted with amount equal to its delta.
+
+    Args:
+        cursor: Database Cursor object.
+        deltas: Delta by (id_good, location) as returned by merge_stock_deltas.
+        locations: Interned shop ids of a normalized database, rows are written to its stock table.
+    """
+    if locations is not None:
+        rows = [(id_good, location, delta) for (id_good, location), delta in deltas.items()]
+        _upsert_stock(cursor, rows, locations, "amount + excluded.amount")
+        invalidate_cached_goods({id_good for id_good, _ in deltas})
+        return
+    cursor.executemany(
+        """INSERT INTO shops_goods (id_good, location, amount) VALUES (?, ?, ?)
+                   ON CONFLICT (id_good, location) DO UPDATE SET amount = amount + excluded.amount""",
+        ((id_good, location, delta) for (id_good, location), delta in deltas.items()),
+    )
+    ROWS_WRITTEN.labels(table="shops_goods").inc(max(cursor.rowcount, 0))
+    invalidate_cached_goods({id_good for id_good, _ in deltas})
+
+
+def _fingerprint(*values: Any) -> int:
+    """Return stable across processes 64-bit fingerprint of values."""
+    return int.from_bytes(hashlib.blake2b(repr(values).encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+@dataclass
+class Fingerprints:
+    """Fingerprints calculated by ChangeDetector for a batch."""
+
+    goods: Dict[int, int] = field(default_factory=dict)
+    shops: Dict[Tuple[int, str], int] = field(default_factory=dict)
+    known: Dict[int, Tuple[Optional[int], Dict[str, int]]] = field(default_factory=dict)
+    skipped: int = 0
+
+
+class ChangeDetector:
+    """Finds goods and shops_goods rows whose data differs from what was written last time.
+
+    A fingerprint of every written goods row and shops_goods row is kept in goods_fingerprints
+    and shops_goods_fingerprints tables, fingerprints of the most recently used goods and all
+    their shops are cached in memory. Fingerprints are only updated by write_batch, so every
+    writer of the database should use the detector, otherwise rows changed by other writers
+    may be skipped as unchanged.
+    """
+
+    def __init__(self, cursor: Cursor, cache_size: int = DEFAULT_FINGERPRINT_CACHE_SIZE) -> None:
+        """Create fingerprint tables if they don't exist, cache_size is the number of cached goods."""
+        cursor.executescript(
+            """
+                    CREATE TABLE IF NOT EXISTS goods_fingerprints (
+                        id INTEGER NOT NULL PRIMARY KEY,
+                        fingerprint INTEGER NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS shops_goods_fingerprints (
+                        id_good INTEGER NOT NULL,
+                        location VARCHAR(100) NOT NULL,
+                        fingerprint INTEGER NOT NULL,
+                        PRIMARY KEY (id_good, location)
+                    ) WITHOUT ROWID;
+                    """
+        )
+        self.cache_size = cache_size
+        # good id -> fingerprint of goods row (None if it's unknown) and fingerprints of shops_goods rows by location
+        self._cache: "OrderedDict[int, Tuple[Optional[int], Dict[str, int]]]" = OrderedDict()
+
+    def select_changed(self, cursor: Cursor, batch: Sequence[dict]) -> Tuple[List[dict], List[dict], Fingerprints]:
+        """Leave only changed data of prepared goods.
+
+        Returns:
+            Goods whose goods row changed, goods with only changed shops in location_and_quantity
+            and new fingerprints to pass to save and remember.
+        """
+        known = self._load(cursor, {prepared_data["id"] for prepared_data in batch})
+        fingerprints = Fingerprints()
+        goods_batch, shops_batch = [], []
+        for prepared_data in batch:
+            good_id = prepared_data["id"]
+            good_fingerprint, shop_fingerprints = known[good_id]
+            fingerprint = _fingerprint(prepared_data["name"], prepared_data["height"], prepared_data["width"])
+            if fingerprint == good_fingerprint:
+                fingerprints.skipped += 1
+            else:
+                goods_batch.append(prepared_data)
+                fingerprints.goods[good_id] = good_fingerprint = fingerprint
+            changed_shops = []
+            for shop in prepared_data["location_and_quantity"]:
+                fingerprint = _fingerprint(shop["amount"])
+                if shop_fingerprints.get(shop["location"]) == fingerprint:
+                    fingerprints.skipped += 1
+                else:
+                    changed_shops.append(shop)
+                    shop_fingerprints[shop["location"]] = fingerprints.shops[(good_id, shop["location"])] = fingerprint
+            if changed_shops:
+                shops_batch.append(dict(prepared_data, location_and_quantity=changed_shops))
+            known[good_id] = good_fingerprint, shop_fingerprints
+        fingerprints.known = known
+        return goods_batch, shops_batch, fingerprints
+
+    def save(self, cursor: Cursor, fingerprints: Fingerprints) -> None:
+        """Write new fingerprints to database in the transaction writing the rows."""
+        cursor.executemany("INSERT OR REPLACE INTO goods_fingerprints VALUES (?, ?)", fingerprints.goods.items())
+        cursor.executemany(
+            "INSERT OR REPLACE INTO shops_goods_fingerprints VALUES (?, ?, ?)",
+            ((good_id, location, fingerprint) for (good_id, location), fingerprint in fingerprints.shops.items()),
+        )
+
+    def forget(self, cursor: Cursor, keys: Iterable[Tuple[int, str]]) -> None:
+        """Drop fingerprints of shops_goods rows changed without the detector, e.g. by stock deltas.
+
+        The next snapshot of these rows is written even if it's the same as the last written one.
+        Cached goods are dropped at once: if the transaction is rolled back, they are loaded again.
+        """
+        keys = list(keys)
+        cursor.executemany("DELETE FROM shops_goods_fingerprints WHERE id_good = ? AND location = ?", keys)
+        for good_id, _ in keys:
+            self._cache.pop(good_id, None)
+
+    def remember(self, fingerprints: Fingerprints) -> None:
+        """Cache new fingerprints after the transaction writing them is committed."""
+        self._cache.update(fingerprints.known)
+        for good_id in fingerprints.known:
+            self._cache.move_to_end(good_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _load(self, cursor: Cursor, good_ids: Iterable[int]) -> Dict[int, Tuple[Optional[int], Dict[str, int]]]:
+        """Return copies of fingerprints of goods and their shops, loading ones missing in the cache."""
+        known: Dict[int, Tuple[Optional[int], Dict[str, int]]] = {}
+        missing = []
+        for good_id in good_ids:
+            if good_id in self._cache:
+                good_fingerprint, shop_fingerprints = self._cache[good_id]
+                known[good_id] = good_fingerprint, dict(shop_fingerprints)
+            else:
+                known[good_id] = None, {}
+                missing.append(good_id)
+        for start in range(0, len(missing), SQLITE_MAX_PARAMETERS):
+            chunk = missing[start : start + SQLITE_MAX_PARAMETERS]
+            placeholders = ", ".join("?" * len(chunk))
+            query = f"SELECT id, fingerprint FROM goods_fingerprints WHERE id IN ({placeholders})"
+            for good_id, fingerprint in cursor.execute(query, chunk):
+                known[good_id] = fingerprint, known[good_id][1]
+            query = (
+                "SELECT id_good, location, fingerprint FROM shops_goods_fingerprints "
+                f"WHERE id_good IN ({placeholders})"
+            )
+            for good_id, location, fingerprint in cursor.execute(query, chunk):
+                known[good_id][1][location] = fingerprint
+        return known
+
+
+def _number(value: float) -> float:
+    """Return value stored in a FLOAT column as int if it has no fractional part."""
+    return int(value) if float(value).is_integer() else value
+
+
+def get_good(cursor: Cursor, id_good: int) -> Optional[dict]:
+    """Return a good with its shops in the shape of goods.schema.json or None if there is no such good."""
+    row = cursor.execute(
+        "SELECT id, name, package_height, package_width FROM goods WHERE id = ?", (id_good,)
+    ).fetchone()
+    if row is None:
+        return None
+    good_id, name, height, width = row
+    shops = cursor.execute("SELECT location, amount FROM shops_goods WHERE id_good = ? ORDER BY id", (id_good,))
+    return {
+        "id": good_id,
+        "name": name,
+        "package_params": {"width": _number(width), "height": _number(height)},
+        "location_and_quantity": [{"location": location, "amount": amount} for location, amount in shops],
+    }
+
+
+def iter_goods(cursor: Cursor, since: Optional[int] = None, fetch_size: int = DEFAULT_FETCH_SIZE) -> Iterator[dict]:
+    """Yield goods with their shops in the shape of goods.schema.json, like get_good does.
+
+    Rows of goods joined with their shops are fetched by fetchmany, so only fetch_size rows and
+    the good being assembled are held in memory whatever the size of the tables.
+
+    Args:
+        cursor: Database Cursor object, used by the generator until it's exhausted.
+        since: If given, only goods whose version is greater are yielded in the order of versions,
+            see enable_change_tracking. Every good is yielded in the order of ids otherwise.
+        fetch_size: Number of rows fetched at once.
+
+    Yields:
+        Goods as dicts.
+    """
+    if is_normalized(cursor):
+        # The shops_goods view would be materialized as a whole to be joined, its tables are joined instead.
+        columns = "goods.id, goods.name, package_height, package_width, locations.name, amount"
+        shops = "LEFT JOIN stock ON stock.id_good = goods.id LEFT JOIN locations ON locations.id = stock.id_location"
+        shops_order = "stock.id"
+    else:
+        columns = "goods.id, name, package_height, package_width, location, amount"
+        shops = "LEFT JOIN shops_goods ON shops_goods.id_good = goods.id"
+        shops_order = "shops_goods.id"
+    if since is None:
+        cursor.execute(f"SELECT {columns} FROM goods {shops} ORDER BY goods.id, {shops_order}")
+    else:
         cursor.execute(
-            """INSERT OR REPLACE INTO shops_goods
-                       VALUES (
-                           (SELECT id FROM shops_goods
-                           WHERE shops_goods.id_good = :id_good and
-                           shops_goods.location = :location),
-                           :id_good, :location, :amount)
-                       """,
-            {"id_good": prepared_data["id"], "location": shop["location"], "amount": shop["amount"]},
+            f"""SELECT {columns} FROM goods_versions JOIN goods ON goods.id = goods_versions.id_good {shops}
+                WHERE version > ? ORDER BY version, {shops_order}""",
+            (since,),
+        )
+    good: Optional[dict] = None
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        for good_id, name, height, width, location, amount in rows:
+            if good is None or good["id"] != good_id:
+                if good is not None:
+                    yield good
+                good = {
+                    "id": good_id,
+                    "name": name,
+                    "package_params": {"width": _number(width), "height": _number(height)},
+                    "location_and_quantity": [],
+                }
+            if location is not None:
+                good["location_and_quantity"].append({"location": location, "amount": amount})
+    if good is not None:
+        yield good
+
+
+_GOODS_CACHES: "weakref.WeakSet[GoodsCache]" = weakref.WeakSet()
+
+
+class GoodsCache:
+    """Bounded LRU cache of get_good results with time-to-live of entries.
+
+    Entries of goods touched by the table writers are invalidated in every cache of the process,
+    when the rows are written and again when write_batch commits them. A good read while an
+    invalidation happens isn't cached, it may be read before the commit. Changes made by other
+    processes are seen after ttl seconds. Cached goods are shared, callers must not modify them.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_GOODS_CACHE_SIZE, ttl: float = DEFAULT_GOODS_CACHE_TTL) -> None:
+        """Create an empty cache of at most maxsize goods kept for ttl seconds."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[int, Tuple[float, Optional[dict]]]" = OrderedDict()
+        self._epoch = 0  # incremented by every invalidation
+        self._lock = threading.Lock()
+        _GOODS_CACHES.add(self)
+
+    def get(self, cursor: Cursor, id_good: int) -> Optional[dict]:
+        """Return cached good or read it with get_good and cache it."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(id_good)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(id_good)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            epoch = self._epoch
+        good = get_good(cursor, id_good)
+        with self._lock:
+            if epoch != self._epoch:
+                return good  # an invalidation raced with the read, the good may be older than a commit
+            self._entries[id_good] = now + self.ttl, good
+            self._entries.move_to_end(id_good)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return good
+
+    def invalidate(self, ids: Iterable[int]) -> None:
+        """Remove goods from the cache."""
+        with self._lock:
+            self._epoch += 1
+            for id_good in ids:
+                self._entries.pop(id_good, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def invalidate_cached_goods(ids: Iterable[int]) -> None:
+    """Remove goods from every GoodsCache of the process."""
+    if _GOODS_CACHES:
+        ids = list(ids)
+        for cache in list(_GOODS_CACHES):
+            cache.invalidate(ids)
+
+
+def get_total_amount(cursor: Cursor, id_good: int) -> int:
+    """Return total amount of a good in all shops, 0 if there is no such good."""
+    row = cursor.execute("SELECT total_amount FROM goods_stock WHERE id_good = ?", (id_good,)).fetchone()
+    return row[0] if row else 0
+
+
+def get_location_stock(cursor: Cursor, location: str) -> Dict[str, int]:
+    """Return total amount of goods, number of goods and of out-of-stock goods in a shop."""
+    row = cursor.execute(
+        "SELECT total_amount, goods, out_of_stock_goods FROM location_stock WHERE location = ?", (location,)
+    ).fetchone()
+    total_amount, goods, out_of_stock_goods = row or (0, 0, 0)
+    return {"total_amount": total_amount, "goods": goods, "out_of_stock_goods": out_of_stock_goods}
+
+
+def get_goods_in_stock_at_location(cursor: Cursor, location: str) -> List[Tuple[int, int]]:
+    """Return (id_good, amount) pairs of goods available in a shop, ordered by id_good."""
+    return cursor.execute(
+        "SELECT id_good, amount FROM shops_goods WHERE location = ? AND amount > 0 ORDER BY id_good", (location,)
+    ).fetchall()
+
+
+def get_out_of_stock_goods(cursor: Cursor, location: Optional[str] = None) -> List[int]:
+    """Return ids of goods with zero amount in a shop or, if location is None, in every shop."""
+    if location is None:
+        rows = cursor.execute("SELECT id_good FROM goods_stock WHERE total_amount = 0 ORDER BY id_good")
+    else:
+        rows = cursor.execute(
+            "SELECT id_good FROM shops_goods WHERE location = ? AND amount = 0 ORDER BY id_good", (location,)
+        )
+    return [id_good for id_good, in rows]
+
+
+class FileProgress(NamedTuple):
+    """Committed position in an input file and the file version it belongs to."""
+
+    size: int
+    mtime_ns: int
+    offset: int
+    documents: int
+
+
+class Checkpoint:
+    """Positions in input files up to which their documents are committed.
+
+    Documents are read by read_documents, which notes the byte offset after every one. The writers
+    save these positions to ingest_progress table in the transaction writing the data read before
+    them, so a rerun over the same files after a crash seeks straight past the last committed batch.
+    A file is the same if it has the same size and modification time, a changed file is read from
+    the beginning.
+    """
+
+    def __init__(self, cursor: Cursor) -> None:
+        """Create progress table if it doesn't exist and load committed positions."""
+        cursor.execute(
+            """
+                    CREATE TABLE IF NOT EXISTS ingest_progress (
+                        path TEXT NOT NULL PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        offset INTEGER NOT NULL,
+                        documents INTEGER NOT NULL
+                    );
+                    """
+        )
+        rows = cursor.execute("SELECT path, size, mtime_ns, offset, documents FROM ingest_progress")
+        self._committed = {path: FileProgress(*progress) for path, *progress in rows}
+        self._pending: Dict[str, FileProgress] = {}
+
+    def position(self, json_file: str) -> FileProgress:
+        """Return committed position in the current version of a file, offset 0 if there is none."""
+        path = os.path.abspath(json_file)
+        stat = os.stat(path)
+        progress = self._pending.get(path) or self._committed.get(path)
+        if progress is None or (progress.size, progress.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return FileProgress(stat.st_size, stat.st_mtime_ns, 0, 0)
+        return progress
+
+    def read_documents(self, json_file: str) -> Iterator[Any]:
+        """Read documents of a file after its committed position, noting the position after every one."""
+        path = os.path.abspath(json_file)
+        progress = self.position(path)
+        if progress.offset:
+            print(
+                f"{json_file}: уже записано документов: {progress.documents}, "
+                f"чтение продолжается с байта {progress.offset} из {progress.size}"
+            )
+        documents = progress.documents
+        for document, offset in iter_json_documents_with_offsets(path, progress.offset):
+            documents += 1
+            self._pending[path] = progress._replace(offset=offset, documents=documents)
+            yield document
+
+    def save(self, cursor: Cursor) -> None:
+        """Write positions noted since the last commit, transaction calls it before committing."""
+        cursor.executemany(
+            "INSERT OR REPLACE INTO ingest_progress VALUES (?, ?, ?, ?, ?)",
+            ((path, *progress) for path, progress in self._pending.items()),
+        )
+
+    def commit(self) -> None:
+        """Keep saved positions as committed after the transaction writing them is committed."""
+        self._committed.update(self._pending)
+        self._pending.clear()
+
+    def flush(self, conn: Connection) -> None:
+        """Commit positions noted after the last write, e.g. of invalid documents at the end of a file."""
+        if self._pending:
+            with transaction(conn, checkpoint=self):
+                pass
+
+
+@contextmanager
+def transaction(
+    conn: Connection, locations: Optional[LocationIds] = None, checkpoint: Optional[Checkpoint] = None
+) -> Iterator[Cursor]:
+    """Run statements of the with-block in a transaction.
+
+    The transaction is committed if the block succeeds and rolled back if it raises.
+    It takes the write lock of the database up front, waiting for it at most the busy timeout
+    of the connection: a deferred transaction which has already read can't wait for the lock,
+    SQLite fails its first write at once instead of calling the busy handler.
+    Time of the block goes to the "write" stage, waiting for the lock to LOCK_WAIT_SECONDS and
+    commit latency to COMMIT_SECONDS metrics.
+    Shop ids interned by locations in the transaction are kept only if it's committed.
+    Positions in input files noted by checkpoint are saved in the transaction.
+
+    Yields:
+        Database Cursor object.
+    """
+    started = time.perf_counter()
+    try:
+        if not conn.in_transaction:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+            finally:
+                LOCK_WAIT_SECONDS.observe(time.perf_counter() - started)
+        cursor = conn.cursor()
+        yield cursor
+        if checkpoint is not None:
+            checkpoint.save(cursor)
+        committing = time.perf_counter()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if locations is not None:
+            locations.rollback()
+        raise
+    if locations is not None:
+        locations.commit()
+    if checkpoint is not None:
+        checkpoint.commit()
+    finished = time.perf_counter()
+    COMMIT_SECONDS.observe(finished - committing)
+    STAGE_SECONDS.labels(stage="write").inc(finished - started)
+
+
+def is_locked_error(err: sqlite3.Error) -> bool:
+    """Return True if err means that the database, a table or the schema is locked by another connection."""
+    return isinstance(err, sqlite3.OperationalError) and "is locked" in str(err)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Retries of write transactions which failed because the database stayed locked.
+
+    Writers wait for the lock by the busy handler of their connection first, see ConnectionProfile.busy_timeout.
+    If the lock is still held when it expires, for example by an overlapping run, the whole
+    transaction is run again after a delay drawn uniformly from zero up to a bound which doubles
+    with every retry, so writers which collided don't collide again in lockstep.
+
+    Attributes:
+        attempts: Maximum number of attempts of a transaction, 1 disables retries.
+        initial_delay: Bound of the delay before the first retry in seconds.
+        max_delay: Largest bound of a delay in seconds.
+    """
+
+    attempts: int = 5
+    initial_delay: float = 0.1
+    max_delay: float = 5.0
+
+    def delay(self, retry: int) -> float:
+        """Return a random delay in seconds before a retry, counted from 0."""
+        return random.uniform(0, min(self.max_delay, self.initial_delay * 2**retry))
+
+    def run(self, write: Callable[[], T]) -> T:
+        """Call write, and call it again after a delay while it fails because the database is locked."""
+        retry = 0
+        while True:
+            try:
+                return write()
+            except sqlite3.OperationalError as err:
+                if not is_locked_error(err) or retry + 1 >= self.attempts:
+                    raise
+            WRITE_RETRIES.inc()
+            time.sleep(self.delay(retry))
+            retry += 1
+
+
+DEFAULT_WRITE_RETRY = RetryPolicy()
+
+_write_retry = DEFAULT_WRITE_RETRY
+
+
+def use_write_retry(policy: RetryPolicy) -> None:
+    """Retry write transactions of the table writers by policy, DEFAULT_WRITE_RETRY is used until it's called."""
+    global _write_retry
+    _write_retry = policy
+
+
+def run_in_transaction(
+    conn: Connection,
+    write: Callable[[Cursor], T],
+    locations: Optional[LocationIds] = None,
+    checkpoint: Optional[Checkpoint] = None,
+) -> T:
+    """Call write with a cursor in a transaction, the transaction is retried while the database is locked.
+
+    Every attempt runs write in a new transaction, see transaction, and the policy set by use_write_retry
+    decides whether a failed attempt is retried, so write must not keep state of an attempt that was rolled back.
+    """
+
+    def attempt() -> T:
+        with transaction(conn, locations, checkpoint) as cursor:
+            return write(cursor)
+
+    return _write_retry.run(attempt)
+
+
+def write_batch(
+    conn: Connection,
+    batch: Sequence[dict],
+    change_detector: Optional[ChangeDetector] = None,
+    locations: Optional[LocationIds] = None,
+    checkpoint: Optional[Checkpoint] = None,
+) -> int:
+    """Write a batch of prepared goods to goods and shops_goods tables in one transaction.
+
+    Args:
+        conn: Database Connection object.
+        batch: Incoming data after preparation, one item per good.
+        change_detector: If given, rows which are the same as the last written ones are not written.
+        locations: Interned shop ids of a normalized database, looked up for every call if not given.
+        checkpoint: If given, positions in input files the batch was read up to are saved with it.
+
+    Returns:
+        Number of goods and shops_goods rows skipped as unchanged.
+    """
+    if locations is None:
+        locations = LocationIds.of_database(conn.cursor())
+    if change_detector is None:
+
+        def write(cursor: Cursor) -> None:
+            insert_or_replace_batch_to_goods_table(cursor, batch)
+            insert_or_replace_batch_to_shops_goods_table(cursor, batch, locations)
+
+        run_in_transaction(conn, write, locations, checkpoint)
+        # Readers could cache rows of the previous commit between the writes and the commit.
+        invalidate_cached_goods(prepared_data["id"] for prepared_data in batch)
+        return 0
+
+    def write_changed(cursor: Cursor) -> Fingerprints:
+        goods_batch, shops_batch, fingerprints = change_detector.select_changed(cursor, batch)
+        insert_or_replace_batch_to_goods_table(cursor, goods_batch)
+        insert_or_replace_batch_to_shops_goods_table(cursor, shops_batch, locations)
+        change_detector.save(cursor, fingerprints)
+        return fingerprints
+
+    fingerprints = run_in_transaction(conn, write_changed, locations, checkpoint)
+    invalidate_cached_goods(prepared_data["id"] for prepared_data in batch)
+    change_detector.remember(fingerprints)
+    SKIPPED_WRITES.inc(fingerprints.skipped)
+    return fingerprints.skipped
+
+
+def write_records(
+    conn: Connection,
+    batch: records.GoodsBatch,
+    locations: Optional[LocationIds] = None,
+    checkpoint: Optional[Checkpoint] = None,
+) -> None:
+    """Write a column batch of goods to goods and shops_goods tables in one transaction.
+
+    Interned shop ids of a normalized database are looked up for every call if locations aren't given.
+    If checkpoint is given, positions in input files the batch was read up to are saved with it.
+    """
+    if locations is None:
+        locations = LocationIds.of_database(conn.cursor())
+
+    def write(cursor: Cursor) -> None:
+        insert_or_replace_records_to_goods_table(cursor, batch)
+        insert_or_replace_records_to_shops_goods_table(cursor, batch, locations)
+
+    run_in_transaction(conn, write, locations, checkpoint)
+    invalidate_cached_goods(batch.ids)
+
+
+def write_stock_deltas(
+    conn: Connection,
+    events: Sequence[dict],
+    change_detector: Optional[ChangeDetector] = None,
+    locations: Optional[LocationIds] = None,
+    checkpoint: Optional[Checkpoint] = None,
+) -> int:
+    """Merge a batch of stock-delta events and add them to shops_goods amounts in one transaction.
+
+    Args:
+        conn: Database Connection object.
+        events: Events in the shape of delta.schema.json.
+        change_detector: Detector used for snapshots of the same database, fingerprints of changed rows are dropped.
+        locations: Interned shop ids of a normalized database, looked up for every call if not given.
+        checkpoint: If given, positions in input files the events were read up to are saved with them.
+
+    Returns:
+        Number of shops_goods rows changed after merging.
+    """
+    deltas = merge_stock_deltas(events)
+    if locations is None:
+        locations = LocationIds.of_database(conn.cursor())
+
+    def write(cursor: Cursor) -> None:
+        apply_stock_deltas_to_shops_goods_table(cursor, deltas, locations)
+        if change_detector is not None:
+            change_detector.forget(cursor, deltas)
+
+    run_in_transaction(conn, write, locations, checkpoint)
+    invalidate_cached_goods({id_good for id_good, _ in deltas})
+    return len(deltas)
+
+
+def iter_json_files(paths: Iterable[str]) -> Iterator[str]:
+    """Expand paths to json-files, directories are walked recursively in sorted order.
+
+    Args:
+        paths: Paths to json-files or to directories containing them.
+
+    Yields:
+        Paths to json-files.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(".json"):
+                    yield os.path.join(root, name)
+
+
+def iter_batches(items: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    """Group items into lists of at most batch_size items."""
+    batch: List[T] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def coalesce_batch(batch: Sequence[dict]) -> List[dict]:
+    """Merge goods of a batch with the same id, so every good and every shop of a good is written once.
+
+    The last document of a good wins, like it would if the documents were written one by one: its
+    fields are kept and amounts of its shops replace amounts of the same shops in earlier documents.
+    Shops only listed by earlier documents are kept as well. Goods keep the position of their first
+    document.
+
+    Args:
+        batch: Prepared goods or valid documents in the shape of goods.schema.json.
+
+    Returns:
+        Merged goods, the batch itself if no good repeats.
+    """
+    latest: Dict[Any, dict] = {}
+    shops: Dict[Any, Dict[str, dict]] = {}
+    shop_count = 0
+    for data in batch:
+        latest[data["id"]] = data  # a reassigned key keeps its position
+        good_shops = shops.setdefault(data["id"], {})
+        for shop in data["location_and_quantity"]:
+            good_shops[shop["location"]] = shop
+            shop_count += 1
+    if len(latest) == len(batch) and shop_count == sum(map(len, shops.values())):
+        return list(batch)
+    return [dict(data, location_and_quantity=list(shops[good_id].values())) for good_id, data in latest.items()]
+
+
+@dataclass
+class IngestReport:
+    """Counters of a bulk ingestion run."""
+
+    documents: int = 0
+    invalid: int = 0
+    batches: int = 0
+    skipped_writes: int = 0
+    collapsed: int = 0
+    elapsed: float = 0.0
+
+    def count_collapsed(self, documents: int) -> None:
+        """Add documents merged by coalesce_batch to the counters."""
+        self.collapsed += documents
+        COLLAPSED_DOCUMENTS.inc(documents)
+
+    @property
+    def documents_per_second(self) -> float:
+        """Throughput of the run in processed documents per second."""
+        return self.documents / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Документов обработано: {self.documents}, невалидных: {self.invalid}, "
+            f"транзакций: {self.batches}, пропущено неизменённых строк: {self.skipped_writes}, "
+            f"объединено повторов товаров: {self.collapsed}, "
+            f"время: {self.elapsed:.2f} с "
+            f"({self.documents_per_second:.1f} док/с)"
+        )
+
+
+def ingest_files(
+    conn: Connection,
+    paths: Iterable[str],
+    schema: dict,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    change_detector: Optional[ChangeDetector] = None,
+    sink: Optional[rejections.RejectionSink] = None,
+    read_documents: Callable[[str], Iterable[Any]] = iter_json_documents,
+    checkpoint: Optional[Checkpoint] = None,
+    publisher: Optional[snapshot.SnapshotPublisher] = None,
+) -> IngestReport:
+    """Validate goods from json-files and write them to database in batches.
+
+    Files are read lazily by iter_json_documents, so a file may hold one good, NDJSON
+    or a top-level array of goods of any size. Documents flow through validation and
+    preparation one at a time and every batch of valid goods is committed in a single
+    transaction. Unreadable or malformed files are counted as one invalid document.
+    Without change detection valid goods are collected straight into records.GoodsBatch
+    columns instead of prepared dicts.
+
+    Args:
+        conn: Database Connection object, tables must already exist.
+        paths: Paths to json-files or to directories containing them.
+        schema: The schema to validate goods with.
+        batch_size: Maximum number of goods committed in one transaction.
+        change_detector: If given, rows which are the same as the last written ones are not written.
+        sink: If given, invalid goods are written to it instead of printing their errors.
+        read_documents: Function reading documents of a file, e.g. rejections.iter_rejected_documents to replay them.
+        checkpoint: If given, files are read by it from their committed positions instead of read_documents
+            and positions are committed with every batch.
+        publisher: If given, it's told of every committed batch to publish snapshots of the database.
+
+    Returns:
+        Counters of the run.
+    """
+    report = IngestReport()
+    started = time.perf_counter()
+    locations = LocationIds.of_database(conn.cursor())
+    if checkpoint is not None:
+        read_documents = checkpoint.read_documents
+    if change_detector is None:
+        documents = iter_prepared_goods(paths, schema, report, sink, read_documents, _validated_document)
+        for goods_batch in records.iter_goods_batches(documents, batch_size):
+            write_records(conn, goods_batch, locations, checkpoint)
+            report.count_collapsed(goods_batch.collapsed)
+            report.batches += 1
+            if publisher is not None:
+                publisher.batch_committed()
+    else:
+        for batch in iter_batches(iter_prepared_goods(paths, schema, report, sink, read_documents), batch_size):
+            coalesced = coalesce_batch(batch)
+            report.skipped_writes += write_batch(conn, coalesced, change_detector, locations, checkpoint)
+            report.count_collapsed(len(batch) - len(coalesced))
+            report.batches += 1
+            if publisher is not None:
+                publisher.batch_committed()
+    if checkpoint is not None:
+        checkpoint.flush(conn)
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def _validated_document(data: dict) -> dict:
+    """Pass a valid document on as it is, it's collected into columns by records.GoodsBatch."""
+    return data
+
+
+def ingest_stock_delta_files(
+    conn: Connection,
+    paths: Iterable[str],
+    schema: dict,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    change_detector: Optional[ChangeDetector] = None,
+    sink: Optional[rejections.RejectionSink] = None,
+    read_documents: Callable[[str], Iterable[Any]] = iter_json_documents,
+    checkpoint: Optional[Checkpoint] = None,
+    publisher: Optional[snapshot.SnapshotPublisher] = None,
+) -> IngestReport:
+    """Validate stock-delta events from json-files and apply them to shops_goods in batches.
+
+    Works like ingest_files, but documents are events of delta.schema.json and every batch
+    is merged and written by write_stock_deltas.
+
+    Args:
+        conn: Database Connection object, tables must already exist.
+        paths: Paths to json-files or to directories containing them.
+        schema: The schema to validate events with.
+        batch_size: Maximum number of events committed in one transaction.
+        change_detector: Detector used for snapshots of the same database.
+        sink: If given, invalid events are written to it instead of printing their errors.
+        read_documents: Function reading documents of a file.
+        checkpoint: If given, files are read by it from their committed positions instead of read_documents
+            and positions are committed with every batch, so no event is applied twice.
+        publisher: If given, it's told of every committed batch to publish snapshots of the database.
+
+    Returns:
+        Counters of the run.
+    """
+    report = IngestReport()
+    started = time.perf_counter()
+    if checkpoint is not None:
+        read_documents = checkpoint.read_documents
+    events = iter_prepared_goods(paths, schema, report, sink, read_documents, prepare_stock_delta)
+    locations = LocationIds.of_database(conn.cursor())
+    for batch in iter_batches(events, batch_size):
+        write_stock_deltas(conn, batch, change_detector, locations, checkpoint)
+        report.batches += 1
+        if publisher is not None:
+            publisher.batch_committed()
+    if checkpoint is not None:
+        checkpoint.flush(conn)
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def iter_prepared_goods(
+    paths: Iterable[str],
+    schema: dict,
+    report: IngestReport,
+    sink: Optional[rejections.RejectionSink] = None,
+    read_documents: Callable[[str], Iterable[Any]] = iter_json_documents,
+    prepare: Callable[[dict], dict] = prepare_data_for_insert_update,
+) -> Iterator[dict]:
+    """Read goods from json-files lazily, validate them and yield prepared ones.
+
+    Read and invalid documents are counted in report. Unreadable or malformed files are
+    counted as one invalid document.
+
+    Args:
+        paths: Paths to json-files or to directories containing them.
+        schema: The schema to validate goods with.
+        report: Counters of the run to update.
+        sink: If given, invalid goods are written to it instead of printing their errors.
+        read_documents: Function reading documents of a file.
+        prepare: Function preparing valid documents, prepare_stock_delta for stock-delta events.
+
+    Yields:
+        Valid goods after preparation.
+    """
+    read_seconds = STAGE_SECONDS.labels(stage="read")
+    validate = metrics.timed(is_data_valid, STAGE_SECONDS.labels(stage="validate"))
+    prepare = metrics.timed(prepare, STAGE_SECONDS.labels(stage="prepare"))
+
+    def documents() -> Iterator[Any]:
+        for json_file in iter_json_files(paths):
+            try:
+                for document in metrics.timed_iter(read_documents(json_file), read_seconds):
+                    report.documents += 1
+                    DOCUMENTS.inc()
+                    yield document
+            except (OSError, ValueError) as err:
+                print("---------------------------")
+                print(f"Не удалось прочитать {json_file}:\n", err, "\n")
+                report.documents += 1
+                report.invalid += 1
+                DOCUMENTS.inc()
+                VALIDATION_FAILURES.inc()
+
+    for document in documents():
+        if validate(document, schema, True, sink):
+            yield prepare(document)
+        else:
+            report.invalid += 1
+            VALIDATION_FAILURES.inc()
+
+
+def iter_work_items(paths: Iterable[str], split_size: int = SPLIT_SIZE) -> Iterator[Tuple[str, int, int]]:
+    """Split json-files into work items for parallel parsing.
+
+    Files bigger than split_size which hold one document per line are treated as NDJSON and split
+    into byte ranges of about split_size bytes; every other file, e.g. a top-level array or
+    pretty-printed documents, is a single item.
+
+    Yields:
+        Tuples (path, start, end), end is -1 for a whole file.
+    """
+    for json_file in iter_json_files(paths):
+        try:
+            size = os.path.getsize(json_file)
+            with open(json_file, "rb") as f:
+                line_delimited = size > split_size and _is_line_delimited(f, size, split_size)
+        except OSError:
+            line_delimited = False
+        if not line_delimited:
+            yield json_file, 0, -1
+            continue
+        for start in range(0, size, split_size):
+            yield json_file, start, start + split_size
+
+
+def _is_line_delimited(f: BinaryIO, size: int, split_size: int) -> bool:
+    """Tell whether a binary file holds a document per line, checking the first line of every range it's split into.
+
+    A top-level array, pretty-printed documents or several documents on a line aren't line-delimited.
+    """
+    for start in range(0, size, split_size):
+        f.seek(max(start - 1, 0))
+        if start:
+            f.readline()  # the same line as _iter_ndjson_range skips
+        line = b""
+        while not line.strip() and f.tell() < min(start + split_size, size):
+            line = f.readline(MAX_DOCUMENT_SIZE)
+        if not line.strip():
+            continue
+        if not line.endswith(b"\n") and f.tell() < size:
+            return False  # longer than a document may be
+        try:
+            document = json.loads(line)
+        except ValueError:
+            return False
+        if start == 0 and isinstance(document, list):
+            return False  # a top-level array on a single line
+    return True
+
+
+def _iter_ndjson_range(json_file: str, start: int, end: int) -> Iterator[Any]:
+    """Deserialize NDJSON-documents whose lines start within [start, end) byte range of the file."""
+    with open(json_file, "rb") as f:
+        if start:
+            f.seek(start - 1)
+            f.readline()  # skip the rest of the line started before the range, it belongs to the previous item
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                yield json.loads(line)
+
+
+_worker_schema: dict = {}
+_worker_collects_rejections = False
+
+
+def _init_parse_worker(
+    schema: dict, collect_rejections: bool = False, checker_cache_dir: Optional[str] = None
+) -> None:
+    """Store schema in a worker process, so it isn't sent with every work item."""
+    global _worker_schema, _worker_collects_rejections
+    _worker_schema = schema
+    _worker_collects_rejections = collect_rejections
+    use_checker_cache(checker_cache_dir)
+
+
+def _parse_work_item(item: Tuple[str, int, int]) -> Tuple[List[dict], int, int, List[dict]]:
+    """Read, validate and prepare goods of a work item in a worker process.
+
+    Returns:
+        Prepared valid goods, number of documents, number of invalid documents and
+        dead-letter records of invalid ones if the worker collects them.
+    """
+    json_file, start, end = item
+    prepared: List[dict] = []
+    rejected: List[dict] = []
+    documents = invalid = 0
+    validator = get_validator(_worker_schema)
+    try:
+        for document in iter_json_documents(json_file) if end < 0 else _iter_ndjson_range(json_file, start, end):
+            documents += 1
+            if validator.is_valid(document):
+                prepared.append(prepare_data_for_insert_update(document))
+                continue
+            invalid += 1
+            if _worker_collects_rejections:
+                rejected.append(rejections.rejection_record(document, validator.iter_errors(document)))
+            else:
+                is_data_valid(document, _worker_schema)  # prints the error
+    except (OSError, ValueError) as err:
+        print("---------------------------")
+        print(f"Не удалось прочитать {json_file}:\n", err, "\n")
+        documents += 1
+        invalid += 1
+    return prepared, documents, invalid, rejected
+
+
+def ingest_files_parallel(
+    db_path: str,
+    paths: Iterable[str],
+    schema: dict,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: Optional[int] = None,
+    queue_depth: int = DEFAULT_QUEUE_DEPTH,
+    change_detector: Optional[ChangeDetector] = None,
+    profile: str = DEFAULT_CONNECTION_PROFILE,
+    sink: Optional[rejections.RejectionSink] = None,
+    publisher: Optional[snapshot.SnapshotPublisher] = None,
+) -> IngestReport:
+    """Parse and validate goods in a process pool and write them from a single writer thread.
+
+    Work items from iter_work_items are parsed, validated and prepared by worker processes.
+    Their results are taken in input order, so the later document of a good still wins, and put
+    into a bounded queue. The writer thread owns the only database connection and drains the
+    queue into transactions of about batch_size goods.
+
+    Args:
+        db_path: Path to SQLite database, tables must already exist.
+        paths: Paths to json-files or to directories containing them.
+        schema: The schema to validate goods with.
+        batch_size: Maximum number of goods committed in one transaction.
+        workers: Number of worker processes, all CPUs by default.
+        queue_depth: Maximum number of parsed work items waiting for the writer.
+        change_detector: If given, rows which are the same as the last written ones are not written.
+        profile: Connection profile of the writer thread.
+        sink: If given, workers send records of invalid goods to it instead of printing their errors.
+        publisher: If given, the writer thread tells it of every committed batch to publish snapshots.
+
+    Returns:
+        Counters of the run.
+    """
+    report = IngestReport()
+    started = time.perf_counter()
+    parsed: "queue.Queue[Optional[List[dict]]]" = queue.Queue(maxsize=queue_depth)
+    writer_errors: List[BaseException] = []
+
+    def write_parsed() -> None:
+        try:
+            with closing(connect(db_path, profile)) as conn:
+                locations = LocationIds.of_database(conn.cursor())
+                pending: List[dict] = []
+                finished = False
+                while not finished:
+                    prepared = parsed.get()
+                    if prepared is None:
+                        finished = True
+                    else:
+                        pending.extend(prepared)
+                    while len(pending) >= batch_size or finished and pending:
+                        coalesced = coalesce_batch(pending[:batch_size])
+                        report.skipped_writes += write_batch(conn, coalesced, change_detector, locations)
+                        report.count_collapsed(min(len(pending), batch_size) - len(coalesced))
+                        del pending[:batch_size]
+                        report.batches += 1
+                        if publisher is not None:
+                            publisher.batch_committed()
+        except BaseException as err:
+            writer_errors.append(err)
+            while parsed.get() is not None:  # unblock the producer
+                pass
+
+    writer = threading.Thread(target=write_parsed, name="sqlite-writer")
+    writer.start()
+    from concurrent.futures import ProcessPoolExecutor  # imports multiprocessing, which slows down startup
+
+    try:
+        with ProcessPoolExecutor(
+            workers, initializer=_init_parse_worker, initargs=(schema, sink is not None, _checker_cache_dir)
+        ) as executor:
+            in_flight: "deque[ParsedFuture]" = deque()
+            max_in_flight = 2 * (workers or os.cpu_count() or 1)
+            for item in iter_work_items(paths):
+                if writer_errors:
+                    break
+                in_flight.append(executor.submit(_parse_work_item, item))
+                while len(in_flight) >= max_in_flight or in_flight and in_flight[0].done():
+                    _collect_parsed(in_flight.popleft(), parsed, report, sink)
+            while in_flight:
+                _collect_parsed(in_flight.popleft(), parsed, report, sink)
+    finally:
+        parsed.put(None)
+        writer.join()
+    if writer_errors:
+        raise writer_errors[0]
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def _collect_parsed(
+    future: "ParsedFuture",
+    parsed: "queue.Queue[Optional[List[dict]]]",
+    report: IngestReport,
+    sink: Optional[rejections.RejectionSink],
+) -> None:
+    """Count results of a parsed work item, pass its goods to the writer thread and its rejections to sink."""
+    prepared, documents, invalid, rejected = future.result()
+    if sink is not None:
+        for record in rejected:
+            sink.write(record)
+    report.documents += documents
+    report.invalid += invalid
+    DOCUMENTS.inc(documents)
+    VALIDATION_FAILURES.inc(invalid)
+    if prepared:
+        parsed.put(prepared)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    """Parse command line arguments of the ingestion entry point."""
+    parser = argparse.ArgumentParser(description="Load goods from json-files into database.")
+    parser.add_argument(
+        "paths", nargs="*", default=["data.json"], help="json-files or directories with them (default: data.json)"
+    )
+    parser.add_argument("--db", default="goods.db", help="path to SQLite database (default: goods.db)")
+    parser.add_argument(
+        "--schema",
+        help="path to JSON schema of documents (default: goods.schema.json or delta.schema.json with --deltas)",
+    )
+    parser.add_argument(
+        "--checker-cache",
+        default=default_checker_cache_dir(),
+        help="directory of checkers compiled from schemas, reused by later runs (default: ~/.cache/goods-accounting)",
+    )
+    parser.add_argument(
+        "--no-checker-cache", action="store_true", help="compile the checker of the schema without the cache"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"goods committed in one transaction (default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--deltas",
+        action="store_true",
+        help="paths hold stock-delta events {id_good, location, delta} added to amounts instead of goods",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processes parsing and validating goods, 0 means all CPUs (default: 1, no worker processes)",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=DEFAULT_QUEUE_DEPTH,
+        help=f"parsed work items waiting for the writer with --workers (default: {DEFAULT_QUEUE_DEPTH})",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(CONNECTION_PROFILES),
+        default=DEFAULT_CONNECTION_PROFILE,
+        help=f"SQLite connection settings, bulk-load is for initial loads (default: {DEFAULT_CONNECTION_PROFILE})",
+    )
+    parser.add_argument("--metrics-file", help="write metrics of the run to this file at the end")
+    parser.add_argument(
+        "--metrics-format", choices=metrics.FORMATS, default="prometheus", help="format of --metrics-file"
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="keep fingerprints of written rows and don't rewrite rows which haven't changed",
+    )
+    parser.add_argument(
+        "--normalize",
+        action="store_true",
+        help="move shops to locations table referred by id before loading and print the size savings",
+    )
+    parser.add_argument(
+        "--rejections", help="append invalid goods with their errors to this NDJSON file instead of printing them"
+    )
+    parser.add_argument(
+        "--max-error-messages",
+        type=int,
+        default=rejections.DEFAULT_MAX_MESSAGES,
+        help=f"rejections printed with --rejections (default: {rejections.DEFAULT_MAX_MESSAGES})",
+    )
+    parser.add_argument(
+        "--replay", action="store_true", help="paths are files written by --rejections, ingest their goods again"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="commit positions in input files with every batch and resume unchanged files from them",
+    )
+    parser.add_argument(
+        "--snapshot",
+        metavar="REPLICA",
+        help="publish read-only snapshots of the database to this file for readers, see snapshot.py",
+    )
+    parser.add_argument(
+        "--snapshot-every-batches",
+        type=int,
+        metavar="N",
+        help="publish a snapshot after every N committed batches (default: only at the end of the run)",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=float,
+        metavar="SECONDS",
+        help="publish a snapshot every SECONDS seconds if the database changed",
+    )
+    parser.add_argument(
+        "--write-attempts",
+        type=int,
+        default=DEFAULT_WRITE_RETRY.attempts,
+        help="attempts of a write transaction while the database stays locked by another writer, 1 disables "
+        f"retries (default: {DEFAULT_WRITE_RETRY.attempts})",
+    )
+    args = parser.parse_args(argv)
+    if args.write_attempts < 1:
+        parser.error("--write-attempts must be at least 1")
+    if (args.snapshot_every_batches is not None or args.snapshot_interval is not None) and not args.snapshot:
+        parser.error("--snapshot-every-batches and --snapshot-interval need --snapshot")
+    if args.replay and args.workers != 1:
+        parser.error("--replay can't be used with --workers")
+    if args.checkpoint and (args.replay or args.workers != 1):
+        parser.error("--checkpoint can't be used with --replay or --workers")
+    if args.deltas and args.workers != 1:
+        parser.error("--deltas can't be used with --workers")
+    if args.schema is None:
+        args.schema = "delta.schema.json" if args.deltas else "goods.schema.json"
+    if args.replay and args.rejections in args.paths:
+        parser.error("--rejections file can't be replayed in the same run")
+    return args
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Run ingestion from command line and print its report."""
+    args = parse_args(argv)
+    metrics.REGISTRY.enabled = args.metrics_file is not None
+    use_checker_cache(None if args.no_checker_cache else args.checker_cache)
+    use_write_retry(replace(DEFAULT_WRITE_RETRY, attempts=args.write_attempts))
+    schema = read_json(args.schema)
+    sink = rejections.RejectionSink(args.rejections, args.max_error_messages) if args.rejections else None
+    read_documents = rejections.iter_rejected_documents if args.replay else iter_json_documents
+    with closing(connect(args.db, args.profile)) as conn, sink or nullcontext():
+        create_tables_in_db(conn.cursor())
+        if args.normalize and not is_normalized(conn.cursor()):
+            print(normalize_db(conn.cursor()))
+        change_detector = ChangeDetector(conn.cursor()) if args.skip_unchanged else None
+        checkpoint = Checkpoint(conn.cursor()) if args.checkpoint else None
+        publisher = (
+            snapshot.SnapshotPublisher(args.db, args.snapshot, args.snapshot_every_batches) if args.snapshot else None
         )
+        indexes = secondary_indexes_dropped(conn) if CONNECTION_PROFILES[args.profile].drop_indexes else nullcontext()
+        # The last snapshot is published on leaving the block, after secondary indexes are rebuilt.
+        with publisher or nullcontext(), indexes:
+            if publisher is not None:
+                publisher.start(args.snapshot_interval)
+            if args.deltas:
+                report = ingest_stock_delta_files(
+                    conn,
+                    args.paths,
+                    schema,
+                    args.batch_size,
+                    change_detector,
+                    sink,
+                    read_documents,
+                    checkpoint,
+                    publisher,
+                )
+            elif args.workers == 1:
+                report = ingest_files(
+                    conn,
+                    args.paths,
+                    schema,
+                    args.batch_size,
+                    change_detector,
+                    sink,
+                    read_documents,
+                    checkpoint,
+                    publisher,
+                )
+            else:
+                report = ingest_files_parallel(
+                    args.db,
+                    args.paths,
+                    schema,
+                    args.batch_size,
+                    args.workers or None,
+                    args.queue_depth,
+                    change_detector,
+                    args.profile,
+                    sink,
+                    publisher,
+                )
+    print(report)
+    if sink is not None:
+        print(sink.summary())
+    if publisher is not None:
+        print(publisher.summary())
+    if args.metrics_file:
+        metrics.REGISTRY.dump(args.metrics_file, args.metrics_format)
+    return 0
 
 
 if __name__ == "__main__":
-    instance = read_json("data.json")
-    schema = read_json("goods.schema.json")
-    if is_data_valid(instance, schema):
-        prepared_data = prepare_data_for_insert_update(instance)
-        with sqlite3.connect("goods.db") as conn:
-            cur = conn.cursor()
-            create_tables_in_db(cur)
-            insert_or_replace_data_to_goods_table(cur, prepared_data)
-            insert_or_replace_data_to_shops_goods_table(cur, prepared_data)
+    sys.exit(main())
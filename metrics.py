@@ -0,0 +1,314 @@
+"""Small registry of counters and histograms exported in Prometheus text format or as JSON.
+
+Metrics are disabled by default and then cost only a flag check: instrumented code uses
+counters, histograms and timed/timed_iter wrappers, which do nothing until REGISTRY.enabled is set.
+Every metric has a lock, so values updated by writer, shard and snapshot threads aren't lost.
+"""
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FORMATS = ("prometheus", "json")
+
+
+class Registry:
+    """Collection of metrics of the process."""
+
+    def __init__(self) -> None:
+        """Create an empty disabled registry."""
+        self.enabled = False
+        self._metrics: Dict[str, "_Metric"] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> "Counter":
+        """Register a counter, labelled values are created with Counter.labels."""
+        return self._register(Counter(self, name, documentation, tuple(labelnames)))
+
+    def histogram(
+        self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS, labelnames: Sequence[str] = ()
+    ) -> "Histogram":
+        """Register a histogram with upper bounds of buckets."""
+        return self._register(Histogram(self, name, documentation, tuple(labelnames), tuple(sorted(buckets))))
+
+    def reset(self) -> None:
+        """Set every metric to zero."""
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def to_prometheus(self) -> str:
+        """Return every metric in Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.prometheus_samples())
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> Dict[str, Any]:
+        """Return every metric as a JSON-serializable dictionary."""
+        return {
+            metric.name: {"type": metric.kind, "help": metric.documentation, "samples": metric.json_samples()}
+            for metric in self._metrics.values()
+        }
+
+    def dump(self, path: str, file_format: str = "prometheus") -> None:
+        """Atomically replace file at path with every metric in "prometheus" or "json" format."""
+        if file_format not in FORMATS:
+            raise ValueError(f"Unknown metrics format {file_format!r}, use one of {FORMATS}")
+        content = self.to_prometheus() if file_format == "prometheus" else json.dumps(self.to_json(), indent=2)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _register(self, metric: "M") -> "M":
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, registry: Registry, name: str, documentation: str, labelnames: Tuple[str, ...]) -> None:
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def reset(self) -> None:
+        """Set the metric and its labelled metrics to zero."""
+
+    @abstractmethod
+    def prometheus_samples(self) -> List[str]:
+        """Return lines of the metric in Prometheus text format."""
+
+    @abstractmethod
+    def json_samples(self) -> List[Dict[str, Any]]:
+        """Return samples of the metric as dictionaries."""
+
+    def _child(self, labels: Dict[str, str], create: Callable[[], "M"]) -> "M":
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = create()
+            return self._children[key]
+
+    def _child_items(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        with self._lock:
+            return sorted(self._children.items()) if self.labelnames else [((), self)]
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class Counter(_Metric):
+    """Monotonically increasing value, for example number of documents or seconds spent in a stage."""
+
+    kind = "counter"
+
+    def __init__(self, registry: Registry, name: str, documentation: str, labelnames: Tuple[str, ...]) -> None:
+        """Create counter, use Registry.counter instead."""
+        super().__init__(registry, name, documentation, labelnames)
+        self.value = 0.0
+
+    def labels(self, **labels: str) -> "Counter":
+        """Return counter of given label values, it's created on the first call."""
+        return self._child(labels, lambda: Counter(self.registry, self.name, self.documentation, ()))
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase the counter if metrics are enabled."""
+        if self.registry.enabled:
+            with self._lock:
+                self.value += amount
+
+    def reset(self) -> None:
+        """Set the counter and its labelled counters to zero."""
+        with self._lock:
+            self.value = 0.0
+        for child in list(self._children.values()):
+            child.reset()
+
+    def prometheus_samples(self) -> List[str]:
+        """Return lines of the counter in Prometheus text format."""
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {child.value:g}" for key, child in self._child_items()
+        ]
+
+    def json_samples(self) -> List[Dict[str, Any]]:
+        """Return samples of the counter as dictionaries."""
+        return [
+            {"labels": dict(zip(self.labelnames, key)), "value": child.value} for key, child in self._child_items()
+        ]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, for example of commit latencies."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...],
+        buckets: Tuple[float, ...],
+    ) -> None:
+        """Create histogram, use Registry.histogram instead."""
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = buckets
+        self.reset()
+
+    def labels(self, **labels: str) -> "Histogram":
+        """Return histogram of given label values, it's created on the first call."""
+        return self._child(labels, lambda: Histogram(self.registry, self.name, self.documentation, (), self.buckets))
+
+    def observe(self, value: float) -> None:
+        """Add observed value if metrics are enabled."""
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.bucket_counts[index] += 1
+                    break
+
+    def reset(self) -> None:
+        """Forget every observed value."""
+        with self._lock:
+            self.sum = 0.0
+            self.count = 0
+            self.bucket_counts = [0] * len(self.buckets)
+        for child in list(self._children.values()):
+            child.reset()
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        """Return (upper bound, number of values not greater than it) pairs including +Inf bound."""
+        with self._lock:  # the +Inf count must match the buckets
+            bucket_counts, count = list(self.bucket_counts), self.count
+        pairs, total = [], 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            total += bucket_count
+            pairs.append((f"{bound:g}", total))
+        pairs.append(("+Inf", count))
+        return pairs
+
+    def prometheus_samples(self) -> List[str]:
+        """Return lines of the histogram in Prometheus text format."""
+        lines = []
+        for key, child in self._child_items():
+            for bound, count in child.cumulative_counts():
+                labels = _format_labels(self.labelnames, key, 'le="' + bound + '"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {child.sum:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {child.count}")
+        return lines
+
+    def json_samples(self) -> List[Dict[str, Any]]:
+        """Return samples of the histogram as dictionaries."""
+        return [
+            {
+                "labels": dict(zip(self.labelnames, key)),
+                "buckets": dict(child.cumulative_counts()),
+                "sum": child.sum,
+                "count": child.count,
+            }
+            for key, child in self._child_items()
+        ]
+
+
+def timed(func: Callable[..., T], seconds: Counter) -> Callable[..., T]:
+    """Wrap func to add its running time to seconds counter.
+
+    The check is done once: if metrics are disabled when it's called, func itself is returned.
+    """
+    if not seconds.registry.enabled:
+        return func
+
+    def timed_func(*args: Any, **kwargs: Any) -> T:
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds.inc(time.perf_counter() - started)
+
+    return timed_func
+
+
+def timed_iter(items: Iterable[T], seconds: Counter) -> Iterator[T]:
+    """Iterate over items adding time spent producing them to seconds counter.
+
+    If metrics are disabled when it's called, a plain iterator over items is returned.
+    """
+    iterator = iter(items)
+    if not seconds.registry.enabled:
+        return iterator
+    return _timed_iter(iterator, seconds)
+
+
+def _timed_iter(iterator: Iterator[T], seconds: Counter) -> Iterator[T]:
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            seconds.inc(time.perf_counter() - started)
+            return
+        seconds.inc(time.perf_counter() - started)
+        yield item
+
+
+class PeriodicDumper:
+    """Thread dumping a registry to a file every interval seconds, for long-running modes."""
+
+    def __init__(
+        self, registry: Registry, path: str, file_format: str = "prometheus", interval: float = 15.0
+    ) -> None:
+        """Start dumping registry to path."""
+        self.registry = registry
+        self.path = path
+        self.file_format = file_format
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-dumper", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the thread and write the final dump."""
+        self._stopped.set()
+        self._thread.join()
+        self.registry.dump(self.path, self.file_format)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.registry.dump(self.path, self.file_format)
+
+
+REGISTRY = Registry()
+
+
+def start_periodic_dump(path: Optional[str], file_format: str, interval: float) -> Optional[PeriodicDumper]:
+    """Enable REGISTRY and start dumping it to path, do nothing if path is None."""
+    if path is None:
+        return None
+    REGISTRY.enabled = True
+    return PeriodicDumper(REGISTRY, path, file_format, interval)
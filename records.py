@@ -0,0 +1,145 @@
+"""Compact records of goods and shops_goods rows for the bulk write path.
+
+prepare_data_for_insert_update makes a dict per good and the dict writers make another one
+per shop row. GoodsBatch instead keeps a batch as columns: ids and amounts in int64 arrays,
+package sizes in float arrays, names and locations in lists of the parsed strings. Rows are
+produced as plain tuples in column order of the tables, so executemany binds them directly.
+GoodRecord and ShopRecord name the fields of these tuples. Like main.coalesce_batch, a batch
+keeps one row per good and per shop of a good, later documents overwrite their values.
+"""
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+
+class GoodRecord(NamedTuple):
+    """Row of goods table in column order."""
+
+    id: int
+    name: str
+    height: float
+    width: float
+
+
+class ShopRecord(NamedTuple):
+    """Row of shops_goods table without its own id."""
+
+    id_good: int
+    location: str
+    amount: int
+
+
+class GoodsBatch:
+    """Batch of valid goods documents stored as column arrays, one row per good and per shop of a good.
+
+    Integers must fit into 64 bits, as they must to be stored by SQLite. The number of documents
+    merged into earlier documents of the same good is counted in collapsed.
+    """
+
+    __slots__ = (
+        "ids",
+        "names",
+        "heights",
+        "widths",
+        "shop_goods",
+        "locations",
+        "amounts",
+        "collapsed",
+        "_goods",
+        "_shop_starts",
+        "_shop_ends",
+        "_later_shops",
+    )
+
+    def __init__(self) -> None:
+        """Create an empty batch."""
+        self.ids = array("q")
+        self.names: List[str] = []
+        self.heights = array("d")
+        self.widths = array("d")
+        self.shop_goods = array("q")
+        self.locations: List[str] = []
+        self.amounts = array("q")
+        self.collapsed = 0
+        self._goods: Dict[int, int] = {}  # good id -> index of its row
+        # Shop rows of the first document of a good are contiguous, rows added by its later documents aren't.
+        self._shop_starts = array("q")
+        self._shop_ends = array("q")
+        self._later_shops: Dict[int, List[int]] = {}  # good id -> indexes of shop rows added later
+
+    def append(self, document: Any) -> None:
+        """Add a good in the shape of goods.schema.json, it must be already validated.
+
+        If the good is already in the batch, its values and amounts of its shops are replaced.
+        """
+        good_id = int(document["id"])
+        package_params = document["package_params"]
+        index = self._goods.get(good_id)
+        if index is None:
+            self._goods[good_id] = len(self.ids)
+            self.ids.append(good_id)
+            self.names.append(document["name"])
+            self.heights.append(package_params["height"])
+            self.widths.append(package_params["width"])
+            self._shop_starts.append(len(self.amounts))
+            for shop in document["location_and_quantity"]:
+                self.shop_goods.append(good_id)
+                self.locations.append(shop["location"])
+                self.amounts.append(int(shop["amount"]))
+            self._shop_ends.append(len(self.amounts))
+            return
+        self.collapsed += 1
+        self.names[index] = document["name"]
+        self.heights[index] = package_params["height"]
+        self.widths[index] = package_params["width"]
+        shop_rows = {self.locations[row]: row for row in self._shop_rows(index, good_id)}
+        for shop in document["location_and_quantity"]:
+            row = shop_rows.get(shop["location"])
+            if row is None:
+                shop_rows[shop["location"]] = len(self.amounts)
+                self._later_shops.setdefault(good_id, []).append(len(self.amounts))
+                self.shop_goods.append(good_id)
+                self.locations.append(shop["location"])
+                self.amounts.append(int(shop["amount"]))
+            else:
+                self.amounts[row] = int(shop["amount"])
+
+    def _shop_rows(self, index: int, good_id: int) -> Iterator[int]:
+        """Yield indexes of shop rows of a good in the batch."""
+        yield from range(self._shop_starts[index], self._shop_ends[index])
+        yield from self._later_shops.get(good_id, ())
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def documents(self) -> int:
+        """Number of appended documents."""
+        return len(self.ids) + self.collapsed
+
+    def goods_rows(self) -> Iterator[Tuple[int, str, float, float]]:
+        """Yield goods rows as tuples in GoodRecord field order."""
+        return zip(self.ids, self.names, self.heights, self.widths)
+
+    def shop_rows(self) -> Iterator[Tuple[int, str, int]]:
+        """Yield shops_goods rows as tuples in ShopRecord field order."""
+        return zip(self.shop_goods, self.locations, self.amounts)
+
+    def records(self) -> Iterator[Tuple[GoodRecord, List[ShopRecord]]]:
+        """Yield every good with its shops as named records, e.g. for inspecting a batch."""
+        shops: Dict[int, List[ShopRecord]] = {}
+        for shop_row in self.shop_rows():
+            shops.setdefault(shop_row[0], []).append(ShopRecord(*shop_row))
+        for row in self.goods_rows():
+            yield GoodRecord(*row), shops.get(row[0], [])
+
+
+def iter_goods_batches(documents: Iterable[Any], batch_size: int) -> Iterator[GoodsBatch]:
+    """Collect valid goods documents into batches of at most batch_size documents."""
+    batch = GoodsBatch()
+    for document in documents:
+        batch.append(document)
+        if batch.documents >= batch_size:
+            yield batch
+            batch = GoodsBatch()
+    if batch:
+        yield batch
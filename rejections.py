@@ -0,0 +1,115 @@
+"""Dead-letter file of documents rejected by validation.
+
+Every rejected document is appended to an NDJSON file as a record with its validation errors:
+    {"document": {...}, "errors": [{"path": "/package_params/width", "rule": "/properties/...", "message": "..."}]}
+The file is buffered, so writing rejections costs about as much as serializing them and valid
+documents aren't slowed down by console output. Failures are counted per schema rule and only
+the first max_messages rejections are printed. Documents of the file can be read back with
+iter_rejected_documents and ingested again once the producer or the schema is fixed.
+"""
+import json
+import sys
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, TextIO
+
+if TYPE_CHECKING:
+    from jsonschema.exceptions import ValidationError
+
+DEFAULT_MAX_MESSAGES = 10
+BUFFER_SIZE = 1024 * 1024
+
+
+def _pointer(parts: Iterable[Any]) -> str:
+    """Return JSON pointer of path parts, an empty string for the document itself."""
+    return "".join("/" + str(part).replace("~", "~0").replace("/", "~1") for part in parts)
+
+
+def rejection_record(document: Any, errors: Iterable["ValidationError"]) -> Dict[str, Any]:
+    """Return dead-letter record of a document with paths, rules and messages of its errors."""
+    return {
+        "document": document,
+        "errors": [
+            {
+                "path": _pointer(error.absolute_path),
+                "rule": _pointer(error.absolute_schema_path),
+                "message": error.message,
+            }
+            for error in errors
+        ],
+    }
+
+
+class RejectionSink:
+    """Appends records of rejected documents to a dead-letter NDJSON file.
+
+    Attributes:
+        rejected: Number of rejected documents.
+        rule_failures: Number of failures of every schema rule, keyed by JSON pointer of the rule.
+    """
+
+    def __init__(self, path: str, max_messages: int = DEFAULT_MAX_MESSAGES, stream: TextIO = sys.stdout) -> None:
+        """Open dead-letter file at path for appending.
+
+        Args:
+            path: Path to the dead-letter file.
+            max_messages: Number of rejections whose errors are printed to stream, the rest are only written.
+            stream: Where the messages are printed.
+        """
+        self.path = path
+        self.max_messages = max_messages
+        self.rejected = 0
+        self.rule_failures: "Counter[str]" = Counter()
+        self._stream = stream
+        self._file = open(path, "a", encoding="utf-8", buffering=BUFFER_SIZE)
+        self._lock = threading.Lock()
+
+    def reject(self, document: Any, errors: Iterable["ValidationError"]) -> None:
+        """Write a document with its validation errors."""
+        self.write(rejection_record(document, errors))
+
+    def write(self, record: Dict[str, Any]) -> None:
+        """Write a record made by rejection_record, e.g. in a worker process."""
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.rejected += 1
+            self.rule_failures.update(error["rule"] for error in record["errors"])
+            if self.rejected <= self.max_messages:
+                print("---------------------------", file=self._stream)
+                print("Данные не прошли валидацию:", file=self._stream)
+                for error in record["errors"]:
+                    print(f"  {error['path'] or '/'}: {error['message']} ({error['rule']})", file=self._stream)
+
+    def summary(self) -> str:
+        """Return number of rejected documents and failures of every rule, the most frequent first."""
+        lines = [f"Отклонено документов: {self.rejected}, записаны в {self.path}"]
+        lines.extend(f"  {rule}: {count}" for rule, count in self.rule_failures.most_common())
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        """Flush and close the dead-letter file."""
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self) -> "RejectionSink":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+
+def iter_rejected_documents(path: str) -> Iterator[Any]:
+    """Read documents back from a dead-letter file for replaying them.
+
+    Raises:
+        ValueError: If a line of the file isn't a dead-letter record.
+    """
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict) or "document" not in record:
+                raise ValueError(f"{path}:{number} is not a dead-letter record")
+            yield record["document"]
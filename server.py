@@ -0,0 +1,400 @@
+"""Long-running ingestion service accepting goods one document at a time over HTTP.
+
+The service listens on a TCP port or on a Unix socket and understands these requests:
+    POST /goods - body is a good document (or an array of them), the response is sent after it's committed,
+        an array with an invalid document is rejected as a whole, an array partly failed to be written
+        is answered with 207 and a result per document;
+    GET /goods/<id> - the good with its shops, served from an LRU cache invalidated by writes;
+    GET /stats - counters and commit latency percentiles as JSON;
+    GET /metrics - metrics registry in Prometheus text format.
+
+Usage: python server.py --db goods.db [--port 8080 | --unix /run/goods.sock]
+"""
+import argparse
+import asyncio
+import json
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+import main
+import metrics
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_MAX_PENDING = 10000
+MAX_BODY_SIZE = 16 * 1024 * 1024
+LATENCY_WINDOW = 100000
+
+_REASONS = {
+    200: "OK",
+    207: "Multi-Status",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+# Errors caused by a document or a request itself, like an id out of SQLite integer range, answered with 400.
+_CLIENT_ERRORS = (ValueError, TypeError, OverflowError)
+# Errors caused by data of a document, a micro-batch failed with them is written again document by document.
+_DOCUMENT_ERRORS = (sqlite3.IntegrityError,) + _CLIENT_ERRORS
+
+
+class LatencyRecorder:
+    """Keeps latencies of the last window documents and calculates their percentiles."""
+
+    def __init__(self, window: int = LATENCY_WINDOW) -> None:
+        """Create recorder of the last window latencies."""
+        self._latencies: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        """Add latency of a document."""
+        self._latencies.append(seconds)
+
+    def percentile(self, percent: float) -> float:
+        """Return percentile of recorded latencies in seconds, 0 if nothing is recorded."""
+        if not self._latencies:
+            return 0.0
+        latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)]
+
+
+class IngestionService:
+    """Validates incoming goods and writes them to database in micro-batches.
+
+    Documents are queued and flushed in one transaction when batch_size of them are collected
+    or flush_interval seconds passed since the first of them arrived. SQLite calls run in a single
+    dedicated thread, so the event loop is never blocked. When max_pending documents are waiting
+    for the writer, submit waits for a free place, which slows down clients. Documents of the same
+    good in a micro-batch are merged by main.coalesce_batch, the good is written once and each of
+    them gets its result.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        schema: dict,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_pending: int = DEFAULT_MAX_PENDING,
+    ) -> None:
+        """Configure service, call start to open database and start flushing."""
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.latency = LatencyRecorder()
+        self.counters = {"accepted": 0, "invalid": 0, "committed": 0, "batches": 0, "collapsed": 0}
+        self.cache = main.GoodsCache()
+        self._validator = main.get_validator(schema)
+        self._queue: "asyncio.Queue[Tuple[dict, asyncio.Future[None], float]]" = asyncio.Queue(max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._conn: Optional[sqlite3.Connection] = None
+        # Interned shop ids of a normalized database, loaded once for the writer connection.
+        self._locations: Optional[main.LocationIds] = None
+        self._flusher: Optional["asyncio.Task[None]"] = None
+
+    async def start(self) -> None:
+        """Open database in the writer thread and start flushing micro-batches."""
+        self._conn = await self._run_in_writer(main.connect, self.db_path, check_same_thread=False)
+        await self._run_in_writer(main.create_tables_in_db, self._conn.cursor())
+        self._locations = await self._run_in_writer(main.LocationIds.of_database, self._conn.cursor())
+        self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def close(self) -> None:
+        """Commit every queued document, then stop flushing and close database."""
+        await self._queue.join()
+        if self._flusher is not None:
+            self._flusher.cancel()
+        if self._conn is not None:
+            await self._run_in_writer(self._conn.close)
+        self._executor.shutdown()
+
+    async def submit(self, document: Any) -> Optional[str]:
+        """Validate document and wait until it's committed.
+
+        Returns:
+            None if the document is committed or the validation error message.
+
+        Raises:
+            Exception: The error writing the document failed with.
+        """
+        error = self.validate(document)
+        if error is None:
+            await self.commit(document)
+        return error
+
+    def validate(self, document: Any) -> Optional[str]:
+        """Count a received document and return its validation error message, None if it's valid."""
+        main.DOCUMENTS.inc()
+        if self._validator.is_valid(document):
+            return None
+        self.counters["invalid"] += 1
+        main.VALIDATION_FAILURES.inc()
+        return str(self._validator.best_error(document))
+
+    async def commit(self, document: Any) -> None:
+        """Queue a valid document and wait until it's committed.
+
+        Raises:
+            Exception: The error writing the document failed with.
+        """
+        received = time.perf_counter()
+        self.counters["accepted"] += 1
+        committed: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        await self._queue.put((main.prepare_data_for_insert_update(document), committed, received))
+        await committed
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters and commit latency percentiles in milliseconds."""
+        return dict(
+            self.counters,
+            pending=self._queue.qsize(),
+            cache_hits=self.cache.hits,
+            cache_misses=self.cache.misses,
+            latency_p50_ms=round(self.latency.percentile(50) * 1000, 3),
+            latency_p99_ms=round(self.latency.percentile(99) * 1000, 3),
+        )
+
+    async def _run_in_writer(self, func: Any, *args: Any, **kwargs: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: func(*args, **kwargs))
+
+    async def _flush_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(items) < self.batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    items.append(self._queue.get_nowait())
+            await self._flush(items)
+
+    async def _flush(self, items: List[Tuple[dict, "asyncio.Future[None]", float]]) -> None:
+        batch = [prepared for prepared, _, _ in items]
+        merged = main.coalesce_batch(batch)
+        if len(merged) < len(batch):
+            self.counters["collapsed"] += len(batch) - len(merged)
+            main.COLLAPSED_DOCUMENTS.inc(len(batch) - len(merged))
+        try:
+            merged_errors = await self._run_in_writer(self._write, self._conn, merged)
+        except Exception as err:
+            merged_errors = [err] * len(merged)
+        # Every document gets the result of the merged good it went into.
+        error_of = {prepared["id"]: error for prepared, error in zip(merged, merged_errors)}
+        errors = [error_of[prepared["id"]] for prepared in batch]
+        now = time.perf_counter()
+        for (_, committed, received), error in zip(items, errors):
+            if error is None:
+                self.counters["committed"] += 1
+                self.latency.record(now - received)
+            if not committed.done():
+                if error is None:
+                    committed.set_result(None)
+                else:
+                    committed.set_exception(error)
+        if errors.count(None):
+            self.counters["batches"] += 1
+        for _ in items:
+            self._queue.task_done()
+
+    def _write(self, conn: sqlite3.Connection, batch: List[dict]) -> List[Optional[Exception]]:
+        """Write a micro-batch in one transaction, every document in its own one if data of one of them fails it.
+
+        A bad document fails only its own client this way, not every client of the micro-batch. Other errors,
+        like a database which stays locked, fail the whole micro-batch at once, writing its documents one by
+        one would only wait for the lock once per document.
+
+        Returns:
+            None for every committed document, the error writing it failed with for the others.
+        """
+        try:
+            main.write_batch(conn, batch, locations=self._locations)
+            return [None] * len(batch)
+        except Exception as err:
+            if len(batch) == 1 or not isinstance(err, _DOCUMENT_ERRORS):
+                return [err] * len(batch)
+        errors: List[Optional[Exception]] = []
+        for prepared in batch:
+            try:
+                main.write_batch(conn, [prepared], locations=self._locations)
+                errors.append(None)
+            except Exception as err:
+                errors.append(err)
+        return errors
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve HTTP/1.1 requests of a client connection until it's closed."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = (request_line.split(" ") + ["", ""])[:3]
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                content_length = headers.get("content-length", "0") or "0"
+                if not content_length.isdigit():
+                    # The body can't be told from the next request, so the connection is closed.
+                    await self._respond(writer, 400, {"error": f"invalid Content-Length {content_length}"})
+                    break
+                length = int(content_length)
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413, {"error": "body is too large"})
+                    break
+                try:
+                    body = await reader.readexactly(length) if length else b""
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if path == "/metrics" and method == "GET":
+                    await self._respond_text(writer, metrics.REGISTRY.to_prometheus())
+                else:
+                    try:
+                        status, payload = await self._route(method, path, body)
+                    except Exception as err:
+                        status, payload = _error_status(err), {"error": _error_message(err)}
+                    await self._respond(writer, status, payload)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        if path == "/stats":
+            return (200, self.stats()) if method == "GET" else (405, {"error": "use GET"})
+        if path.startswith("/goods/"):
+            return await self._lookup(method, path[len("/goods/") :])
+        if path != "/goods":
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        try:
+            document = json.loads(body)
+        except ValueError as err:
+            return 400, {"error": f"invalid JSON: {err}"}
+        documents = document if isinstance(document, list) else [document]
+        # Documents are validated before any of them is queued, so an array is either valid or not written at all.
+        invalid = [error for error in map(self.validate, documents) if error is not None]
+        if invalid:
+            return 400, {"errors": invalid}
+        results = await asyncio.gather(*(self.commit(item) for item in documents), return_exceptions=True)
+        failed = [result for result in results if isinstance(result, BaseException)]
+        if not failed:
+            return 200, {"committed": len(documents)}
+        if len(failed) == len(documents):
+            status = max(map(_error_status, failed))
+            return status, {"errors": [_error_message(err) for err in failed]}
+        return 207, {
+            "committed": len(documents) - len(failed),
+            "results": [
+                {"status": 200}
+                if result is None
+                else {"status": _error_status(result), "error": _error_message(result)}
+                for result in results
+            ],
+        }
+
+    async def _lookup(self, method: str, id_good: str) -> Tuple[int, Dict[str, Any]]:
+        if method != "GET":
+            return 405, {"error": "use GET"}
+        if not id_good.lstrip("-").isdigit():
+            return 400, {"error": f"invalid id {id_good}"}
+        # Reads run in the writer thread, so they see every committed batch and no partial ones.
+        good = await self._run_in_writer(self.cache.get, self._conn.cursor(), int(id_good))  # type: ignore[union-attr]
+        return (200, good) if good is not None else (404, {"error": f"there is no good {id_good}"})
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1")
+            + body
+        )
+        await writer.drain()
+
+    @staticmethod
+    async def _respond_text(writer: asyncio.StreamWriter, text: str) -> None:
+        body = text.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 200 OK\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1")
+            + body
+        )
+        await writer.drain()
+
+
+def _error_status(err: BaseException) -> int:
+    """Return the HTTP status of a request which failed with err."""
+    return 400 if isinstance(err, _CLIENT_ERRORS) else 500
+
+
+def _error_message(err: BaseException) -> str:
+    """Return the error message of a response to a request which failed with err."""
+    if isinstance(err, sqlite3.Error):
+        return f"database error: {err}"
+    return f"{type(err).__name__}: {err}" if isinstance(err, _CLIENT_ERRORS) else f"internal error: {err}"
+
+
+async def serve(args: argparse.Namespace) -> None:
+    """Run the service until it's interrupted, then print its stats."""
+    service = IngestionService(
+        args.db, main.read_json(args.schema), args.batch_size, args.flush_ms / 1000, args.max_pending
+    )
+    dumper = metrics.start_periodic_dump(args.metrics_file, args.metrics_format, args.metrics_interval)
+    await service.start()
+    if args.unix:
+        server = await asyncio.start_unix_server(service.handle_connection, args.unix)
+    else:
+        server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+        if dumper is not None:
+            dumper.stop()
+        print(json.dumps(service.stats(), ensure_ascii=False))
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    """Parse command line arguments of the service."""
+    parser = argparse.ArgumentParser(description="Accept goods over HTTP and write them to database in micro-batches.")
+    parser.add_argument("--db", default="goods.db", help="path to SQLite database (default: goods.db)")
+    parser.add_argument("--schema", default="goods.schema.json", help="path to JSON schema of goods")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="TCP port to listen on (default: 8080)")
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP port")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="documents flushed at once")
+    parser.add_argument(
+        "--flush-ms", type=float, default=DEFAULT_FLUSH_INTERVAL * 1000, help="maximum wait before a flush"
+    )
+    parser.add_argument(
+        "--max-pending", type=int, default=DEFAULT_MAX_PENDING, help="queued documents before clients wait"
+    )
+    parser.add_argument("--metrics-file", help="enable metrics and dump them to this file periodically")
+    parser.add_argument("--metrics-format", choices=metrics.FORMATS, default="prometheus")
+    parser.add_argument("--metrics-interval", type=float, default=15.0, help="seconds between metrics dumps")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
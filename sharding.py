@@ -0,0 +1,259 @@
+"""Storage of goods split across several SQLite files by id of a good.
+
+Every shard is an ordinary database created by create_tables_in_db and written by the usual
+writers, a good and all its shops_goods rows always live in the same shard. Batches are split
+by shard and the shards are written in parallel, one writer thread and connection per shard,
+so shards don't wait for each other's write lock. Queries about one good go to its shard,
+queries about a shop are sent to every shard and their results are merged.
+
+Usage: python sharding.py --dir goods-shards --shards 4 data.json
+"""
+import argparse
+import glob
+import heapq
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from sqlite3.dbapi2 import Connection
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+import main
+import rejections
+
+T = TypeVar("T")
+
+DEFAULT_SHARDS = 4
+
+_SHARD_FILE = re.compile(r"goods-(\d+)-of-(\d+)\.db$")
+
+
+def shard_of(id_good: int, shards: int) -> int:
+    """Return number of the shard keeping a good.
+
+    Ids are hashed, so goods with ids following some pattern are still spread evenly,
+    and the hash doesn't depend on the process like hash() of strings does. Integral floats
+    such as 3.0 are valid ids too, they're kept as integers and so live in the shard of 3.
+    """
+    return zlib.crc32(int(id_good).to_bytes(8, "little", signed=True)) % shards
+
+
+def shard_path(directory: str, shard: int, shards: int) -> str:
+    """Return path to database file of a shard, the number of shards is a part of the name."""
+    return os.path.join(directory, f"goods-{shard:03d}-of-{shards:03d}.db")
+
+
+class ShardedStorage:
+    """Goods and shops_goods tables split across shards database files in a directory.
+
+    Files of a directory can't be reused with another number of shards: goods would be looked
+    for in wrong shards, so opening them with another number raises ValueError.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        shards: int = DEFAULT_SHARDS,
+        profile: str = main.DEFAULT_CONNECTION_PROFILE,
+        skip_unchanged: bool = False,
+    ) -> None:
+        """Open or create shard databases in directory.
+
+        Args:
+            directory: Directory of shard files, it's created if it doesn't exist.
+            shards: Number of shards.
+            profile: Name of the connection profile of every shard.
+            skip_unchanged: Keep fingerprints of written rows in every shard and don't rewrite unchanged rows.
+        """
+        if shards < 1:
+            raise ValueError(f"Number of shards must be positive, not {shards}")
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "goods-*-of-*.db")):
+            match = _SHARD_FILE.search(path)
+            if match and int(match.group(2)) != shards:
+                raise ValueError(f"{directory} holds {int(match.group(2))} shards, not {shards}")
+        self.directory = directory
+        self.shards = shards
+        self.paths = [shard_path(directory, shard, shards) for shard in range(shards)]
+        # Connections are used by a writer thread and by readers, a lock per shard keeps them from overlapping.
+        self._connections: List[Connection] = []
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._change_detectors: List[Optional[main.ChangeDetector]] = []
+        self._locations: List[Optional[main.LocationIds]] = []
+        try:
+            for path in self.paths:
+                conn = main.connect(path, profile, check_same_thread=False)
+                self._connections.append(conn)
+                main.create_tables_in_db(conn.cursor())
+                self._change_detectors.append(main.ChangeDetector(conn.cursor()) if skip_unchanged else None)
+                self._locations.append(main.LocationIds.of_database(conn.cursor()))
+        except BaseException:
+            self.close()
+            raise
+        self._executor = ThreadPoolExecutor(max_workers=shards, thread_name_prefix="sqlite-shard-writer")
+
+    def close(self) -> None:
+        """Wait for running writes and close every shard."""
+        executor = getattr(self, "_executor", None)
+        if executor is not None:
+            executor.shutdown()
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+
+    def __enter__(self) -> "ShardedStorage":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def shard_of(self, id_good: int) -> int:
+        """Return number of the shard keeping a good."""
+        return shard_of(id_good, self.shards)
+
+    def connection(self, shard: int) -> Connection:
+        """Return connection of a shard, e.g. for maintenance; it must not be used together with the storage."""
+        return self._connections[shard]
+
+    def write_batch(self, batch: Sequence[dict]) -> int:
+        """Write a batch of prepared goods, every shard commits its part in its own transaction in parallel.
+
+        The batch isn't atomic as a whole: if a shard fails, other shards may have committed their parts.
+        Writing the batch again is safe because the writers replace rows of the same goods.
+
+        Returns:
+            Number of goods and shops_goods rows skipped as unchanged.
+        """
+        parts: List[List[dict]] = [[] for _ in range(self.shards)]
+        for prepared_data in batch:
+            parts[self.shard_of(prepared_data["id"])].append(prepared_data)
+        futures = [self._executor.submit(self._write_part, shard, part) for shard, part in enumerate(parts) if part]
+        return sum(future.result() for future in futures)
+
+    def write_stock_deltas(self, events: Sequence[dict]) -> int:
+        """Merge a batch of stock-delta events and apply them, every shard in parallel in its own transaction.
+
+        Returns:
+            Number of shops_goods rows changed after merging.
+        """
+        parts: List[List[dict]] = [[] for _ in range(self.shards)]
+        for event in events:
+            parts[self.shard_of(event["id_good"])].append(event)
+        futures = [
+            self._executor.submit(self._write_part, shard, part, main.write_stock_deltas)
+            for shard, part in enumerate(parts)
+            if part
+        ]
+        return sum(future.result() for future in futures)
+
+    def _write_part(
+        self,
+        shard: int,
+        part: List[dict],
+        write: Callable[
+            [Connection, List[dict], Optional[main.ChangeDetector], Optional[main.LocationIds]], int
+        ] = main.write_batch,
+    ) -> int:
+        with self._locks[shard]:
+            return write(self._connections[shard], part, self._change_detectors[shard], self._locations[shard])
+
+    def _on_shard(self, shard: int, query: Callable[..., T], *args: object) -> T:
+        with self._locks[shard]:
+            return query(self._connections[shard].cursor(), *args)
+
+    def _on_every_shard(self, query: Callable[..., T], *args: object) -> List[T]:
+        return [self._on_shard(shard, query, *args) for shard in range(self.shards)]
+
+    def get_good(self, id_good: int) -> Optional[dict]:
+        """Return a good with its shops in the shape of goods.schema.json or None if there is no such good."""
+        return self._on_shard(self.shard_of(id_good), main.get_good, id_good)
+
+    def get_total_amount(self, id_good: int) -> int:
+        """Return total amount of a good in all shops, 0 if there is no such good."""
+        return self._on_shard(self.shard_of(id_good), main.get_total_amount, id_good)
+
+    def get_location_stock(self, location: str) -> Dict[str, int]:
+        """Return total amount of goods, number of goods and of out-of-stock goods in a shop over every shard."""
+        merged = {"total_amount": 0, "goods": 0, "out_of_stock_goods": 0}
+        for stock in self._on_every_shard(main.get_location_stock, location):
+            for key, value in stock.items():
+                merged[key] += value
+        return merged
+
+    def get_goods_in_stock_at_location(self, location: str) -> List[Tuple[int, int]]:
+        """Return (id_good, amount) pairs of goods available in a shop, ordered by id_good."""
+        return list(heapq.merge(*self._on_every_shard(main.get_goods_in_stock_at_location, location)))
+
+    def get_out_of_stock_goods(self, location: Optional[str] = None) -> List[int]:
+        """Return ids of goods with zero amount in a shop or, if location is None, in every shop."""
+        return list(heapq.merge(*self._on_every_shard(main.get_out_of_stock_goods, location)))
+
+    def count_goods(self) -> int:
+        """Return number of goods in every shard."""
+        return sum(self._on_every_shard(lambda cursor: cursor.execute("SELECT count(*) FROM goods").fetchone()[0]))
+
+
+def ingest_files_sharded(
+    storage: ShardedStorage,
+    paths: Iterable[str],
+    schema: dict,
+    batch_size: int = main.DEFAULT_BATCH_SIZE,
+    sink: Optional[rejections.RejectionSink] = None,
+) -> main.IngestReport:
+    """Validate goods from json-files and write them to sharded storage in batches.
+
+    Works like main.ingest_files, but every batch is split between the shards and written by
+    their writers in parallel.
+    """
+    report = main.IngestReport()
+    started = time.perf_counter()
+    for batch in main.iter_batches(main.iter_prepared_goods(paths, schema, report, sink), batch_size):
+        coalesced = main.coalesce_batch(batch)
+        report.skipped_writes += storage.write_batch(coalesced)
+        report.count_collapsed(len(batch) - len(coalesced))
+        report.batches += 1
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def main_sharded(argv: Optional[Sequence[str]] = None) -> int:
+    """Run ingestion into sharded storage from command line and print its report."""
+    parser = argparse.ArgumentParser(description="Load goods from json-files into sharded database.")
+    parser.add_argument(
+        "paths", nargs="*", default=["data.json"], help="json-files or directories with them (default: data.json)"
+    )
+    parser.add_argument("--dir", default="goods-shards", help="directory of shard databases (default: goods-shards)")
+    parser.add_argument(
+        "--shards", type=int, default=DEFAULT_SHARDS, help=f"number of shards (default: {DEFAULT_SHARDS})"
+    )
+    parser.add_argument(
+        "--schema", default="goods.schema.json", help="path to JSON schema of goods (default: goods.schema.json)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=main.DEFAULT_BATCH_SIZE,
+        help=f"goods split between shards at once (default: {main.DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(main.CONNECTION_PROFILES),
+        default=main.DEFAULT_CONNECTION_PROFILE,
+        help=f"SQLite connection settings of every shard (default: {main.DEFAULT_CONNECTION_PROFILE})",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="keep fingerprints of written rows and don't rewrite rows which haven't changed",
+    )
+    args = parser.parse_args(argv)
+    with ShardedStorage(args.dir, args.shards, args.profile, args.skip_unchanged) as storage:
+        print(ingest_files_sharded(storage, args.paths, main.read_json(args.schema), args.batch_size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_sharded())
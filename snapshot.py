@@ -0,0 +1,266 @@
+"""Read-only snapshots of the database for readers, published by the SQLite online backup API.
+
+Readers such as the website shouldn't query the database being written: in the rollback journal
+mode their long queries block commits, and write bursts stall their pages. A snapshot is copied
+from the live database by Connection.backup a few pages per step into a temporary file, which is
+switched to the rollback journal mode and renamed over the replica file. Readers open the replica
+by open_replica read-only and immutable, so they take no locks at all: a published replica is
+never changed in place, the next snapshot is a new file, and a reader sees it once it reconnects.
+
+A snapshot is copied in one read transaction of its own connection, so commits of writers don't
+restart the copy: without it a backup restarts whenever another connection commits and never
+finishes under a steady stream of batches. In WAL mode the transaction doesn't block writers. In
+the rollback journal mode commits wait for the copy, which is a sequential read of the file and
+much shorter than the queries of readers it takes away from the live database.
+
+SnapshotPublisher publishes snapshots from a background thread every interval seconds and after
+every N batches committed by ingestion, but only if the database changed since the last one.
+
+Usage: python snapshot.py --db goods.db --replica goods-replica.db [--interval 5]
+"""
+import argparse
+import os
+import signal
+import sqlite3
+import stat
+import sys
+import threading
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from sqlite3.dbapi2 import Connection
+from typing import Optional, Sequence
+from urllib.parse import quote
+
+import metrics
+
+DEFAULT_PAGES_PER_STEP = 64
+DEFAULT_INTERVAL = 5.0
+
+SNAPSHOT_SECONDS = metrics.REGISTRY.histogram(
+    "goods_snapshot_seconds", "Time to copy and publish a snapshot of the database."
+)
+
+
+@dataclass
+class SnapshotReport:
+    """Outcome of publishing a snapshot."""
+
+    pages: int
+    size: int
+    elapsed: float
+
+    def __str__(self) -> str:
+        return (
+            f"Опубликован снимок базы: {self.pages} страниц ({self.size / 2**20:.1f} МиБ), "
+            f"время: {self.elapsed:.2f} с"
+        )
+
+
+def publish_snapshot(
+    db_path: str,
+    replica: str,
+    pages: int = DEFAULT_PAGES_PER_STEP,
+    step_sleep: float = 0.0,
+    busy_timeout: float = 5.0,
+) -> SnapshotReport:
+    """Copy a database into a replica file, the replica is replaced only once the copy is complete.
+
+    Args:
+        db_path: Path to the live database.
+        replica: Path to the replica file.
+        pages: Pages copied in one step of the backup.
+        step_sleep: Seconds to sleep between steps, it limits the disk bandwidth taken by the copy.
+        busy_timeout: Seconds to wait for a lock held by a writer.
+
+    Returns:
+        Size and duration of the copy.
+    """
+    started = time.perf_counter()
+    temporary = f"{replica}.tmp"
+    if os.path.exists(temporary):
+        os.remove(temporary)  # left by a failed copy, it may be read-only
+    try:
+        with closing(sqlite3.connect(db_path, timeout=busy_timeout)) as source:
+            source.execute("BEGIN")
+            source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()  # starts the read transaction
+            with closing(sqlite3.connect(temporary)) as target:
+                source.backup(target, pages=pages, sleep=step_sleep)
+                copied = target.execute("PRAGMA page_count").fetchone()[0]
+                target.execute("PRAGMA journal_mode=DELETE")  # readers of a WAL file would need -wal and -shm files
+            source.rollback()
+        os.chmod(temporary, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        size = os.path.getsize(temporary)
+        os.replace(temporary, replica)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    elapsed = time.perf_counter() - started
+    SNAPSHOT_SECONDS.observe(elapsed)
+    return SnapshotReport(copied, size, elapsed)
+
+
+def open_replica(replica: str) -> Connection:
+    """Open a published replica read-only, without locks, for a reader."""
+    return sqlite3.connect(f"file:{quote(os.path.abspath(replica))}?mode=ro&immutable=1", uri=True)
+
+
+class SnapshotPublisher:
+    """Publishes snapshots of a database to a replica file, see publish_snapshot.
+
+    Attributes:
+        published: Number of published snapshots.
+        last: Report of the last published snapshot.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        replica: str,
+        every_batches: Optional[int] = None,
+        pages: int = DEFAULT_PAGES_PER_STEP,
+        step_sleep: float = 0.0,
+        busy_timeout: float = 5.0,
+    ) -> None:
+        """Prepare publishing of a database, nothing is published until publish or start is called.
+
+        Args:
+            db_path: Path to the live database.
+            replica: Path to the replica file.
+            every_batches: If given, a snapshot is published after every every_batches batches noted by batch_committed.
+            pages: Pages copied in one step of the backup.
+            step_sleep: Seconds to sleep between steps of the backup.
+            busy_timeout: Seconds to wait for a lock held by a writer.
+        """
+        self.db_path = db_path
+        self.replica = replica
+        self.every_batches = every_batches
+        self.pages = pages
+        self.step_sleep = step_sleep
+        self.busy_timeout = busy_timeout
+        self.published = 0
+        self.last: Optional[SnapshotReport] = None
+        self._batches = 0
+        self._data_version: Optional[int] = None
+        # data_version of a connection changes when other connections commit, this one never writes.
+        self._watch = sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def publish(self) -> SnapshotReport:
+        """Publish a snapshot now."""
+        with self._lock:
+            # Taken before the copy, so commits made during it are published by the next snapshot.
+            self._data_version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+            self.last = publish_snapshot(self.db_path, self.replica, self.pages, self.step_sleep, self.busy_timeout)
+            self.published += 1
+            return self.last
+
+    def publish_if_changed(self) -> Optional[SnapshotReport]:
+        """Publish a snapshot if the database was changed since the last one or nothing is published yet."""
+        with self._lock:
+            if self._data_version == self._watch.execute("PRAGMA data_version").fetchone()[0]:
+                return None
+            return self.publish()
+
+    def batch_committed(self) -> None:
+        """Note a batch committed by ingestion, every every_batches batches a snapshot is published.
+
+        With a background thread started by start, the thread publishes it and the caller doesn't wait.
+        """
+        if self.every_batches is None:
+            return
+        self._batches += 1
+        if self._batches < self.every_batches:
+            return
+        self._batches = 0
+        if self._thread is None:
+            self.publish_if_changed()
+        else:
+            self._wake.set()
+
+    def start(self, interval: Optional[float] = None) -> None:
+        """Publish snapshots in a background thread every interval seconds and when batch_committed asks for one."""
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="snapshot-publisher", daemon=True)
+        self._thread.start()
+
+    def _run(self, interval: Optional[float]) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.publish_if_changed()
+            except (OSError, sqlite3.Error) as err:  # readers keep the previous snapshot, the next one is retried
+                print("---------------------------")
+                print("Не удалось опубликовать снимок базы:\n", err, "\n")
+
+    def summary(self) -> str:
+        """Return number of published snapshots and the last one."""
+        return f"Опубликовано снимков базы в {self.replica}: {self.published}" + (
+            f"\n{self.last}" if self.last is not None else ""
+        )
+
+    def close(self) -> None:
+        """Stop the background thread and publish the last changes, so the replica is up to date."""
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        try:
+            self.publish_if_changed()
+        finally:
+            self._watch.close()
+
+    def __enter__(self) -> "SnapshotPublisher":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+
+def main_snapshot(argv: Optional[Sequence[str]] = None) -> int:
+    """Publish snapshots of a database from command line until SIGTERM or SIGINT."""
+    parser = argparse.ArgumentParser(description="Publish read-only snapshots of goods database for readers.")
+    parser.add_argument("--db", default="goods.db", help="path to SQLite database (default: goods.db)")
+    parser.add_argument("--replica", required=True, help="path to the replica file read by readers")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=DEFAULT_INTERVAL,
+        help=f"seconds between snapshots, taken only if the database changed (default: {DEFAULT_INTERVAL})",
+    )
+    parser.add_argument(
+        "--pages",
+        type=int,
+        default=DEFAULT_PAGES_PER_STEP,
+        help=f"pages copied in one step (default: {DEFAULT_PAGES_PER_STEP})",
+    )
+    parser.add_argument("--step-sleep", type=float, default=0.0, help="seconds to sleep between steps (default: 0)")
+    parser.add_argument("--once", action="store_true", help="publish one snapshot and exit")
+    args = parser.parse_args(argv)
+    if args.once:
+        print(publish_snapshot(args.db, args.replica, args.pages, args.step_sleep))
+        return 0
+    stop = threading.Event()
+
+    def request_stop(*_: object) -> None:
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    with SnapshotPublisher(args.db, args.replica, pages=args.pages, step_sleep=args.step_sleep) as publisher:
+        publisher.publish()
+        publisher.start(args.interval)
+        stop.wait()
+    print(publisher.summary())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_snapshot())
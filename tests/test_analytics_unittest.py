@@ -0,0 +1,117 @@
+import math
+import os
+import sqlite3
+import sys
+import unittest
+from unittest import mock
+from collections import defaultdict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import analytics
+import datagen
+import main
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def nearest_rank(values, percentile):
+    values = sorted(values)
+    return values[max(math.ceil(percentile * len(values) / 100), 1) - 1]
+
+
+class TestStockReport(unittest.TestCase):
+
+    def setUp(self):
+        goods = list(datagen.generate_goods(150, shops_per_good=3, shop_count=6, update_share=0.2))
+        for good in goods[::10]:
+            for shop in good["location_and_quantity"]:
+                shop["amount"] = 0
+        self.conn = main.connect(":memory:")
+        main.create_tables_in_db(self.conn.cursor())
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(good) for good in goods])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def expected(self, top):
+        """Aggregate rows of shops_goods one by one."""
+        rows = self.conn.execute(
+            """SELECT id_good, name, location, amount, package_height * package_width
+               FROM shops_goods JOIN goods ON goods.id = shops_goods.id_good"""
+        ).fetchall()
+        locations = defaultdict(lambda: [0, 0, 0.0])
+        goods = defaultdict(lambda: [0, 0])
+        names = {}
+        for id_good, name, location, amount, footprint in rows:
+            locations[location][0] += 1
+            locations[location][1] += amount
+            locations[location][2] += amount * footprint
+            goods[id_good][0] += amount
+            goods[id_good][1] += 1
+            names[id_good] = name
+        shortages = sorted(goods.items(), key=lambda item: (item[1][0], item[0]))[:top]
+        return (
+            len(rows),
+            {location: (count, amount, round(footprint, 3)) for location, (count, amount, footprint) in locations.items()},
+            {p: nearest_rank([row[3] for row in rows], p) for p in analytics.DEFAULT_PERCENTILES},
+            {p: nearest_rank([amount for amount, _ in goods.values()], p) for p in analytics.DEFAULT_PERCENTILES},
+            [(id_good, names[id_good], amount, count) for id_good, (amount, count) in shortages],
+        )
+
+    def actual(self, report):
+        return (
+            report.rows,
+            {stock.location: (stock.goods, stock.amount, round(stock.footprint, 3)) for stock in report.locations},
+            report.shop_percentiles,
+            report.good_percentiles,
+            [(s.id_good, s.name, s.amount, s.locations) for s in report.shortages],
+        )
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_chunked_reports_match_row_by_row_aggregation(self):
+        expected = self.expected(top=12)
+        for chunk_size in (1, 7, 100_000):
+            with self.subTest(chunk_size=chunk_size):
+                report = analytics.stock_report(self.conn, top=12, chunk_size=chunk_size)
+                self.assertEqual(self.actual(report), expected)
+                self.assertEqual(report.goods, self.conn.execute("SELECT count(*) FROM goods").fetchone()[0])
+        self.assertEqual([s.amount for s in report.shortages[:3]], [0, 0, 0])
+        footprints = [stock.footprint for stock in report.locations]
+        self.assertEqual(footprints, sorted(footprints, reverse=True))
+        self.assertFalse(self.conn.in_transaction)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_normalized_layout_gives_the_same_reports(self):
+        expected = self.expected(top=5)
+        main.normalize_db(self.conn.cursor())
+        self.assertEqual(self.actual(analytics.stock_report(self.conn, top=5, chunk_size=10)), expected)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_top_larger_than_sql_parameter_limit(self):
+        expected = self.expected(top=200)
+        self.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 7)
+        with mock.patch.object(main, "SQLITE_MAX_PARAMETERS", 7):
+            self.assertEqual(self.actual(analytics.stock_report(self.conn, top=200)), expected)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_empty_database(self):
+        conn = main.connect(":memory:")
+        main.create_tables_in_db(conn.cursor())
+        report = analytics.stock_report(conn)
+        self.assertEqual((report.rows, report.goods, report.locations), (0, 0, []))
+        self.assertEqual((report.shop_percentiles, report.shortages), ({}, []))
+        conn.close()
+
+    @unittest.skipIf(numpy is not None, "NumPy is installed")
+    def test_clear_error_without_numpy(self):
+        with self.assertRaisesRegex(ImportError, "pip install numpy"):
+            analytics.stock_report(self.conn)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,12 @@ import unittest
 import sys
 import os
 import sqlite3
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+from contextlib import closing
+from unittest import mock
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -78,13 +84,69 @@ class TestValidationIncomingData(unittest.TestCase):
             self.assertFalse(main.is_data_valid(invalid_case, VALIDATION_SCHEMA),
                             "Invalid data pass a validation!")
 
+    def test_fast_checker_agrees_with_jsonschema(self):
+        fast_validator = main.SchemaValidator(VALIDATION_SCHEMA)
+        full_validator = main.SchemaValidator(VALIDATION_SCHEMA, fast=False)
+        edge_cases = [
+            dict(DATA, id=True),
+            dict(DATA, id=3.0),
+            dict(DATA, id=3.5),
+            dict(DATA, extra_key=1),
+            dict(DATA, package_params={"width": 1, "height": 2, "depth": 3}),
+            dict(DATA, location_and_quantity=[{"location": "Склад", "amount": None}]),
+            dict(DATA, location_and_quantity=[]),
+            [DATA],
+        ]
+        for case in VALID_TEST_CASES + INVALID_TEST_CASES + edge_cases:
+            self.assertEqual(fast_validator.is_valid(case), full_validator.is_valid(case), case)
+            self.assertEqual(full_validator.is_valid(case), full_validator.best_error(case) is None, case)
+
+    def test_fast_checker_is_not_generated_for_unsupported_keywords(self):
+        self.assertIsNone(main.compile_fast_checker({"type": "integer", "minimum": 0}))
+        self.assertIsNotNone(main.compile_fast_checker(VALIDATION_SCHEMA))
+
+    def test_validator_is_compiled_once_per_schema(self):
+        self.assertIs(main.get_validator(VALIDATION_SCHEMA), main.get_validator(VALIDATION_SCHEMA))
+
+    def test_broken_cached_checker_is_compiled_again(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            main.use_checker_cache(tmp_dir)
+            try:
+                main.SchemaValidator(VALIDATION_SCHEMA)
+                path = main.checker_cache_path(VALIDATION_SCHEMA, tmp_dir)
+                self.assertEqual(os.listdir(tmp_dir), [os.path.basename(path)])
+                with open(path, "wb") as f:
+                    f.write(b"broken")
+                self.assertTrue(main.SchemaValidator(VALIDATION_SCHEMA).is_valid(DATA))
+            finally:
+                main.use_checker_cache(None)
+            with open(path, "rb") as f:
+                self.assertNotEqual(f.read(), b"broken")
+
+    def test_cached_checker_is_loaded_without_jsonschema(self):
+        code = (
+            "import json, sys, main; main.use_checker_cache(sys.argv[1]);"
+            "validator = main.SchemaValidator(main.read_json('goods.schema.json'));"
+            "print(validator.is_valid(json.loads(sys.argv[2])), 'jsonschema' in sys.modules);"
+            "validator.best_error({}); print('jsonschema' in sys.modules)"
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The first run compiles the checker, the second one loads it from the cache.
+            for expected in ("True True\nTrue\n", "True False\nTrue\n"):
+                output = subprocess.run(
+                    [sys.executable, "-c", code, tmp_dir, json.dumps(DATA)],
+                    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    capture_output=True, text=True, check=True,
+                )
+                self.assertEqual(output.stdout, expected)
+
 
 class TestCreatingTablesInDatabase(unittest.TestCase):
     conn = None
 
     @classmethod
     def setUpClass(cls):
-        with sqlite3.connect(":memory:") as cls.conn:
+        with main.connect(":memory:") as cls.conn:
             cls.cur = cls.conn.cursor()
 
     def test_creation_goods_and_shops_goods_tables_in_database(self):
@@ -97,12 +159,299 @@ class TestCreatingTablesInDatabase(unittest.TestCase):
                           f"'{table_name}' table in database!")
 
 
+class TestMigratingDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = main.connect(":memory:")
+        self.conn.executescript("""
+            CREATE TABLE shops_goods (
+                id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                id_good INTEGER NOT NULL,
+                location VARCHAR(100) NOT NULL,
+                amount INTEGER NOT NULL
+            );
+            INSERT INTO shops_goods (id_good, location, amount) VALUES
+                (1, 'Магазин на Ленина', 1), (1, 'Магазин на Ленина', 2), (1, 'Магазин в центре', 3);
+        """)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_duplicates_are_removed_and_unique_index_is_created(self):
+        main.create_tables_in_db(self.conn.cursor())
+        rows = self.conn.execute("SELECT id_good, location, amount FROM shops_goods ORDER BY id").fetchall()
+        self.assertEqual(rows, [(1, 'Магазин на Ленина', 2), (1, 'Магазин в центре', 3)])
+        self.assertEqual(self.conn.execute("PRAGMA user_version").fetchone()[0], len(main.MIGRATIONS))
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.execute("INSERT INTO shops_goods (id_good, location, amount) VALUES (1, 'Магазин в центре', 0)")
+
+    def test_migrations_are_applied_once(self):
+        self.assertEqual(main.migrate_db(self.conn.cursor()), len(main.MIGRATIONS))
+        self.assertEqual(main.migrate_db(self.conn.cursor()), 0)
+
+
+class TestStockAggregates(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = main.connect(":memory:")
+        self.cur = self.conn.cursor()
+        main.create_tables_in_db(self.cur)
+        main.write_batch(self.conn, [
+            main.prepare_data_for_insert_update(DATA),
+            main.prepare_data_for_insert_update(dict(DATA, id=4, location_and_quantity=[
+                {"location": "Магазин на Ленина", "amount": 2}])),
+        ])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def assertAggregatesMatchShopsGoods(self):
+        self.assertEqual(
+            self.cur.execute("SELECT * FROM goods_stock ORDER BY id_good").fetchall(),
+            self.cur.execute("SELECT id_good, sum(amount), count(*), sum(amount = 0) FROM shops_goods "
+                             "GROUP BY id_good ORDER BY id_good").fetchall())
+        self.assertEqual(
+            self.cur.execute("SELECT * FROM location_stock ORDER BY location").fetchall(),
+            self.cur.execute("SELECT location, sum(amount), count(*), sum(amount = 0) FROM shops_goods "
+                             "GROUP BY location ORDER BY location").fetchall())
+
+    def test_aggregates_are_maintained_by_writers(self):
+        self.assertEqual(main.get_total_amount(self.cur, 3), 9)
+        self.assertEqual(main.get_location_stock(self.cur, "Магазин на Ленина"),
+                         {"total_amount": 2, "goods": 2, "out_of_stock_goods": 1})
+        self.assertEqual(main.get_goods_in_stock_at_location(self.cur, "Магазин на Ленина"), [(4, 2)])
+        self.assertEqual(main.get_out_of_stock_goods(self.cur, "Магазин на Ленина"), [3])
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(dict(DATA, location_and_quantity=[
+            {"location": "Магазин в центре", "amount": 0}, {"location": "Склад", "amount": 5}]))])
+        self.assertEqual(main.get_total_amount(self.cur, 3), 5)
+        self.assertAggregatesMatchShopsGoods()
+
+    def test_aggregates_follow_deletes_and_key_updates(self):
+        with self.conn:
+            self.cur.execute("UPDATE shops_goods SET location = 'Склад' WHERE id_good = 4")
+            self.cur.execute("DELETE FROM shops_goods WHERE id_good = 3 AND location = 'Магазин в центре'")
+        self.assertAggregatesMatchShopsGoods()
+        self.assertEqual(main.get_out_of_stock_goods(self.cur), [3])
+        self.assertEqual(main.get_total_amount(self.cur, 100), 0)
+
+    def test_aggregates_are_backfilled_for_existing_rows(self):
+        with self.conn:
+            self.cur.execute("DROP TABLE goods_stock")
+            self.cur.execute("DROP TABLE location_stock")
+            self.cur.execute("PRAGMA user_version = 1")
+            for trigger, in self.cur.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+                self.cur.execute(f"DROP TRIGGER {trigger}")
+            self.cur.execute("DROP INDEX shops_goods_location_amount")
+        main.migrate_db(self.cur)
+        self.assertAggregatesMatchShopsGoods()
+
+
+class TestNormalizedLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = main.connect(":memory:")
+        self.cur = self.conn.cursor()
+        main.create_tables_in_db(self.cur)
+        self.goods = [dict(DATA, id=good_id, location_and_quantity=[
+            {"location": f"Магазин на улице Ленина, дом {shop}", "amount": (good_id + shop) % 4}
+            for shop in range(good_id % 3, good_id % 3 + 5)]) for good_id in range(300)]
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(good) for good in self.goods])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def assertAggregatesMatchShopsGoods(self):
+        TestStockAggregates.assertAggregatesMatchShopsGoods(self)
+
+    def test_normalization_keeps_rows_and_saves_space(self):
+        rows = self.cur.execute("SELECT * FROM shops_goods ORDER BY id").fetchall()
+        size = main.normalize_db(self.cur)
+        self.assertTrue(main.is_normalized(self.cur))
+        self.assertLess(size.after, size.before)
+        self.assertEqual(self.cur.execute("SELECT * FROM shops_goods ORDER BY id").fetchall(), rows)
+        self.assertEqual(self.cur.execute("SELECT count(*) FROM locations").fetchone()[0], 7)
+        self.assertEqual(main.get_good(self.cur, 5), {
+            "id": 5, "name": DATA["name"], "package_params": DATA["package_params"],
+            "location_and_quantity": self.goods[5]["location_and_quantity"]})
+        self.assertAggregatesMatchShopsGoods()
+
+    def test_growth_of_small_database_is_reported_as_positive_change(self):
+        with main.connect(":memory:") as conn:
+            main.create_tables_in_db(conn.cursor())
+            main.write_batch(conn, [main.prepare_data_for_insert_update(DATA)])
+            size = main.normalize_db(conn.cursor())
+        conn.close()
+        self.assertGreater(size.after, size.before)
+        self.assertIn(f"({(size.after / size.before - 1) * 100:+.1f}%)", str(size))
+        self.assertNotIn("--", str(size))
+        self.assertIn("(-50.0%)", str(main.SizeReport(2 ** 20, 2 ** 19)))
+
+    def test_writers_use_stock_table_of_normalized_database(self):
+        main.normalize_db(self.cur)
+        main.create_tables_in_db(self.cur)
+        updated = dict(self.goods[1], location_and_quantity=[{"location": "Новый магазин", "amount": 3},
+                                                             {"location": "Магазин на улице Ленина, дом 1",
+                                                              "amount": 10}])
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(updated)])
+        main.write_stock_deltas(self.conn, [{"id_good": 2, "location": "Новый магазин", "delta": 2},
+                                            {"id_good": 1, "location": "Новый магазин", "delta": -1}])
+        self.assertEqual(
+            self.cur.execute("SELECT location, amount FROM shops_goods WHERE id_good = 1 ORDER BY id").fetchall(),
+            [(f"Магазин на улице Ленина, дом {shop}", (1 + shop) % 4 if shop != 1 else 10) for shop in range(1, 6)]
+            + [("Новый магазин", 2)])
+        self.assertEqual(main.get_location_stock(self.cur, "Новый магазин"),
+                         {"total_amount": 4, "goods": 2, "out_of_stock_goods": 0})
+        self.assertAggregatesMatchShopsGoods()
+
+    def test_ingestion_interns_locations(self):
+        main.normalize_db(self.cur)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "goods.ndjson")
+            with open(path, "w", encoding="utf-8") as f:
+                for good in self.goods:
+                    f.write(json.dumps(dict(good, id=good["id"] + 1000), ensure_ascii=False) + "\n")
+            main.ingest_files(self.conn, [path], VALIDATION_SCHEMA, batch_size=50)
+        self.assertEqual(self.cur.execute("SELECT count(*) FROM stock").fetchone()[0], 3000)
+        self.assertEqual(self.cur.execute("SELECT count(*) FROM locations").fetchone()[0], 7)
+        self.assertAggregatesMatchShopsGoods()
+
+    def test_locations_of_rolled_back_transaction_are_forgotten(self):
+        main.normalize_db(self.cur)
+        locations = main.LocationIds(self.cur)
+        with self.assertRaises(sqlite3.IntegrityError):
+            with main.transaction(self.conn, locations) as cursor:
+                self.assertIn("Склад", locations.resolve(cursor, ["Склад"]))
+                cursor.execute("INSERT INTO goods VALUES (1, 'x', 1, 1)")
+        self.assertEqual(len(locations), 7)
+        self.assertIsNone(self.cur.execute("SELECT id FROM locations WHERE name = 'Склад'").fetchone())
+
+
+class TestGoodsLookupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = main.connect(":memory:")
+        self.cur = self.conn.cursor()
+        main.create_tables_in_db(self.cur)
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(DATA)])
+        self.cache = main.GoodsCache(maxsize=2, ttl=60)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_good_is_returned_in_schema_shape(self):
+        self.assertEqual(main.get_good(self.cur, 3), DATA)
+        self.assertIsNone(main.get_good(self.cur, 4))
+
+    def test_repeated_lookups_are_served_from_cache(self):
+        self.assertEqual(self.cache.get(self.cur, 3), DATA)
+        self.assertEqual(self.cache.get(self.cur, 3), DATA)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_writers_invalidate_cached_goods(self):
+        self.cache.get(self.cur, 3)
+        self.cache.get(self.cur, 4)
+        updated = dict(DATA, location_and_quantity=[{"location": "Магазин на Ленина", "amount": 1}])
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(updated),
+                                     main.prepare_data_for_insert_update(dict(DATA, id=4))])
+        self.assertEqual(self.cache.get(self.cur, 3)["location_and_quantity"][0]["amount"], 1)
+        self.assertEqual(self.cache.get(self.cur, 4)["id"], 4)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 4))
+
+    def test_good_read_before_a_commit_is_not_cached_after_its_invalidation(self):
+        updated = dict(DATA, name="Морозильник")
+        get_good = main.get_good
+
+        def read_then_commit(cursor, id_good):
+            good = get_good(cursor, id_good)
+            main.write_batch(self.conn, [main.prepare_data_for_insert_update(updated)])
+            return good
+
+        with mock.patch("main.get_good", side_effect=read_then_commit):
+            self.assertEqual(self.cache.get(self.cur, 3)["name"], "Холодильник")
+        self.assertEqual(self.cache.get(self.cur, 3)["name"], "Морозильник")
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_cache_is_bounded_and_entries_expire(self):
+        for id_good in (1, 2, 3):
+            self.cache.get(self.cur, id_good)
+        self.assertEqual(len(self.cache), 2)
+        expiring_cache = main.GoodsCache(ttl=0)
+        expiring_cache.get(self.cur, 3)
+        expiring_cache.get(self.cur, 3)
+        self.assertEqual((expiring_cache.hits, expiring_cache.misses), (0, 2))
+
+
+class TestStockDeltas(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.conn = main.connect(":memory:")
+        self.cur = self.conn.cursor()
+        main.create_tables_in_db(self.cur)
+        self.change_detector = main.ChangeDetector(self.cur)
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(DATA)], self.change_detector)
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp_dir.cleanup()
+
+    def amounts(self):
+        return dict(self.cur.execute("SELECT location, amount FROM shops_goods WHERE id_good = 3").fetchall())
+
+    def test_deltas_of_the_same_shop_are_merged(self):
+        merged = main.merge_stock_deltas([
+            {"id_good": 3, "location": "Магазин в центре", "delta": -1},
+            {"id_good": 3, "location": "Магазин на Ленина", "delta": 2},
+            {"id_good": 3, "location": "Магазин в центре", "delta": -2},
+            {"id_good": 4, "location": "Магазин в центре", "delta": 1},
+            {"id_good": 4, "location": "Магазин в центре", "delta": -1},
+        ])
+        self.assertEqual(merged, {(3, "Магазин в центре"): -3, (3, "Магазин на Ленина"): 2})
+
+    def test_deltas_are_added_to_amounts(self):
+        changed = main.write_stock_deltas(self.conn, [
+            {"id_good": 3, "location": "Магазин в центре", "delta": -1},
+            {"id_good": 3, "location": "Магазин в центре", "delta": -2},
+            {"id_good": 3, "location": "Склад", "delta": 5},
+        ], self.change_detector)
+        self.assertEqual(changed, 2)
+        self.assertEqual(self.amounts(), {"Магазин на Ленина": 0, "Магазин в центре": 6, "Склад": 5})
+        self.assertEqual(main.get_total_amount(self.cur, 3), 11)
+
+    def test_snapshot_after_deltas_is_written(self):
+        main.write_stock_deltas(self.conn, [{"id_good": 3, "location": "Магазин в центре", "delta": -1}],
+                                self.change_detector)
+        skipped = main.write_batch(self.conn, [main.prepare_data_for_insert_update(DATA)], self.change_detector)
+        self.assertEqual(skipped, 2)
+        self.assertEqual(self.amounts(), {"Магазин на Ленина": 0, "Магазин в центре": 9})
+
+    def test_cached_good_is_invalidated_by_deltas(self):
+        cache = main.GoodsCache()
+        cache.get(self.cur, 3)
+        main.write_stock_deltas(self.conn, [{"id_good": 3, "location": "Магазин на Ленина", "delta": 4}])
+        self.assertEqual(cache.get(self.cur, 3)["location_and_quantity"][0], {"location": "Магазин на Ленина",
+                                                                            "amount": 4})
+
+    def test_delta_files_are_validated_and_ingested(self):
+        path = os.path.join(self.tmp_dir.name, "deltas.ndjson")
+        with open(path, "w", encoding="utf-8") as f:
+            for event in [{"id_good": 3, "location": "Магазин в центре", "delta": -1},
+                          {"id_good": 3, "location": "Магазин в центре", "delta": 0.5},
+                          {"id_good": 3, "location": "Магазин на Ленина", "delta": 3}]:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        schema = main.read_json(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                             "delta.schema.json"))
+        report = main.ingest_stock_delta_files(self.conn, [path], schema, batch_size=2)
+        self.assertEqual((report.documents, report.invalid, report.batches), (3, 1, 1))
+        self.assertEqual(self.amounts(), {"Магазин на Ленина": 3, "Магазин в центре": 8})
+
+
 class TestInsertingUpdatingDataInDatabase(unittest.TestCase):
     conn = None
 
     @classmethod
     def setUpClass(cls):
-        with sqlite3.connect(TEST_DATABASE_FILE_NAME) as cls.conn:
+        with main.connect(TEST_DATABASE_FILE_NAME) as cls.conn:
             cls.cur = cls.conn.cursor()
             main.create_tables_in_db(cls.cur)
 
@@ -206,6 +555,445 @@ class TestInsertingUpdatingDataInDatabase(unittest.TestCase):
             self.assertNotIn((data["id"], shop["location"], shop["amount"]),
                           all_data, f"Outdated data {data} is present after updating in goods table in Database!")
 
+    def test_updating_in_shops_goods_table_keeps_row_ids(self):
+        data = {"id": 2000, "location_and_quantity": [{"location": "Магазин на Ленина", "amount": 1}]}
+        main.insert_or_replace_data_to_shops_goods_table(self.cur, data)
+        self.cur.execute("SELECT id FROM shops_goods WHERE id_good = 2000")
+        row_id = self.cur.fetchone()[0]
+        data["location_and_quantity"][0]["amount"] = 2
+        main.insert_or_replace_data_to_shops_goods_table(self.cur, data)
+        self.cur.execute("SELECT id, amount FROM shops_goods WHERE id_good = 2000")
+        self.assertEqual(self.cur.fetchall(), [(row_id, 2)])
+
+
+class TestBulkIngestion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        nested_dir = os.path.join(self.tmp_dir.name, "nested")
+        os.mkdir(nested_dir)
+        for good_id in range(1, 6):
+            good = dict(DATA, id=good_id)
+            with open(os.path.join(nested_dir, f"{good_id}.json"), 'w', encoding='utf-8') as f:
+                json.dump(good, f)
+        with open(os.path.join(self.tmp_dir.name, "invalid.json"), 'w', encoding='utf-8') as f:
+            json.dump({"id": "not an integer"}, f)
+        with open(os.path.join(self.tmp_dir.name, "notes.txt"), 'w', encoding='utf-8') as f:
+            f.write("not a json-file")
+        self.conn = main.connect(":memory:")
+        main.create_tables_in_db(self.conn.cursor())
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp_dir.cleanup()
+
+    def test_json_files_are_found_in_directories(self):
+        files = list(main.iter_json_files([self.tmp_dir.name]))
+        self.assertEqual(len(files), 6)
+        self.assertTrue(all(name.endswith(".json") for name in files))
+
+    def test_batches_are_not_bigger_than_batch_size(self):
+        self.assertEqual(list(main.iter_batches(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_all_valid_goods_are_written_in_batches(self):
+        report = main.ingest_files(self.conn, [self.tmp_dir.name], VALIDATION_SCHEMA, batch_size=2)
+        self.assertEqual((report.documents, report.invalid, report.batches), (6, 1, 3))
+        cur = self.conn.cursor()
+        cur.execute("SELECT id FROM goods ORDER BY id")
+        self.assertEqual([row[0] for row in cur.fetchall()], [1, 2, 3, 4, 5])
+        cur.execute("SELECT count(*) FROM shops_goods")
+        self.assertEqual(cur.fetchone()[0], 10)
+
+    def test_repeated_ingestion_updates_rows(self):
+        main.ingest_files(self.conn, [self.tmp_dir.name], VALIDATION_SCHEMA)
+        main.ingest_files(self.conn, [self.tmp_dir.name], VALIDATION_SCHEMA)
+        cur = self.conn.cursor()
+        cur.execute("SELECT count(*) FROM shops_goods")
+        self.assertEqual(cur.fetchone()[0], 10)
+
+    def test_unreadable_file_is_counted_as_invalid(self):
+        missing_file = os.path.join(self.tmp_dir.name, "missing.json")
+        report = main.ingest_files(self.conn, [missing_file], VALIDATION_SCHEMA)
+        self.assertEqual((report.documents, report.invalid, report.batches), (1, 1, 0))
+
+
+class TestStreamingJsonReading(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.goods = [dict(DATA, id=good_id) for good_id in range(1, 51)]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def test_reading_ndjson(self):
+        path = self.write("goods.ndjson", "\n".join(json.dumps(good, ensure_ascii=False) for good in self.goods))
+        self.assertEqual(list(main.iter_json_documents(path, chunk_size=7)), self.goods)
+
+    def test_reading_top_level_array(self):
+        path = self.write("goods.json", json.dumps(self.goods, ensure_ascii=False, indent=4))
+        self.assertEqual(list(main.iter_json_documents(path, chunk_size=13)), self.goods)
+
+    def test_reading_single_document_and_empty_array(self):
+        self.assertEqual(list(main.iter_json_documents(self.write("one.json", json.dumps(DATA)))), [DATA])
+        self.assertEqual(list(main.iter_json_documents(self.write("empty.json", " [ ] "))), [])
+
+    def test_reading_malformed_json_raises_value_error(self):
+        for content in ('[{"id": 1}', '[{"id": 1} {"id": 2}]', '[] []', '{"id": 1'):
+            with self.assertRaises(ValueError, msg=content):
+                list(main.iter_json_documents(self.write("bad.json", content), chunk_size=4))
+
+    def test_malformed_document_is_not_read_to_the_end_of_file(self):
+        head = json.dumps(DATA) + "\n"
+        tail = "\n".join(json.dumps(good, ensure_ascii=False) for good in self.goods * 200)
+        path = self.write("bad.ndjson", head + '{"id": 2, "name": "без конца"\n' + tail)
+        documents = main.iter_json_documents_with_offsets(path, chunk_size=256, max_document_size=4096)
+        self.assertEqual(next(documents), (DATA, len(head.encode()) - 1))
+        tracemalloc.start()
+        try:
+            with self.assertRaisesRegex(ValueError, f"at byte offset {len(head.encode())} of"):
+                next(documents)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, len(tail) // 10)
+        with self.assertRaisesRegex(ValueError, "longer than 100 characters at byte offset 1 of"):
+            list(main.iter_json_documents(self.write("long.json", json.dumps(self.goods)), 64, max_document_size=100))
+
+    def test_reading_resumes_at_yielded_offsets(self):
+        for path in (self.write("goods.ndjson", "\n".join(json.dumps(good, ensure_ascii=False) for good in self.goods)),
+                     self.write("goods.json", json.dumps(self.goods, ensure_ascii=False, indent=4))):
+            offsets = [offset for _, offset in main.iter_json_documents_with_offsets(path, chunk_size=11)]
+            self.assertEqual(len(offsets), len(self.goods))
+            for index in (0, 17, len(offsets) - 1):
+                resumed = [doc for doc, _ in main.iter_json_documents_with_offsets(path, offsets[index], chunk_size=11)]
+                self.assertEqual(resumed, self.goods[index + 1:], msg=path)
+
+    def test_offsets_of_crlf_file_are_byte_offsets(self):
+        lines = [json.dumps(good, ensure_ascii=False) for good in self.goods[:3]]
+        path = os.path.join(self.tmp_dir.name, "crlf.ndjson")
+        with open(path, 'w', encoding='utf-8', newline="") as f:
+            f.write("".join(line + "\r\n" for line in lines))
+        ends = [len("".join(line + "\r\n" for line in lines[:index]).encode()) + len(line.encode())
+                for index, line in enumerate(lines)]
+        self.assertEqual([offset for _, offset in main.iter_json_documents_with_offsets(path, chunk_size=9)], ends)
+        self.assertEqual([doc for doc, _ in main.iter_json_documents_with_offsets(path, ends[0])], self.goods[1:3])
+
+    def test_ingesting_array_file_writes_every_good(self):
+        path = self.write("goods.json", json.dumps(self.goods + [{"id": "bad"}]))
+        with main.connect(":memory:") as conn:
+            main.create_tables_in_db(conn.cursor())
+            report = main.ingest_files(conn, [path], VALIDATION_SCHEMA, batch_size=20)
+            count = conn.execute("SELECT count(*) FROM goods").fetchone()[0]
+        conn.close()
+        self.assertEqual((report.documents, report.invalid, report.batches), (51, 1, 3))
+        self.assertEqual(count, 50)
+
+
+class TestConnectionProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "goods.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def pragmas(self, profile):
+        conn = main.connect(self.db_path, profile)
+        values = [conn.execute(f"PRAGMA {name}").fetchone()[0]
+                  for name in ("journal_mode", "synchronous", "temp_store", "busy_timeout")]
+        conn.close()
+        return values
+
+    def test_safe_profile_uses_wal_with_normal_sync(self):
+        self.assertEqual(self.pragmas("safe"), ["wal", 1, 0, 30000])
+
+    def test_bulk_load_profile_relaxes_sync(self):
+        self.assertEqual(self.pragmas("bulk-load"), ["wal", 0, 2, 300000])
+
+    def test_secondary_indexes_are_rebuilt_after_load(self):
+        conn = main.connect(self.db_path, "bulk-load")
+        main.create_tables_in_db(conn.cursor())
+        index_query = "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL ORDER BY name"
+        indexes = conn.execute(index_query).fetchall()
+        with main.secondary_indexes_dropped(conn) as dropped:
+            self.assertEqual(sorted(dropped), ["goods_stock_total_amount", "shops_goods_location_amount"])
+            self.assertEqual(conn.execute(index_query).fetchall(), [("shops_goods_id_good_location",)])
+            main.write_batch(conn, [main.prepare_data_for_insert_update(DATA)])
+        self.assertEqual(conn.execute(index_query).fetchall(), indexes)
+        self.assertEqual(conn.execute("SELECT count(*) FROM dropped_indexes").fetchone()[0], 0)
+        conn.close()
+
+    def test_indexes_dropped_by_killed_load_are_rebuilt_on_next_start(self):
+        code = (
+            "import os, sys, main; conn = main.connect(sys.argv[1], 'bulk-load');"
+            "main.create_tables_in_db(conn.cursor());"
+            "indexes = main.secondary_indexes_dropped(conn); indexes.__enter__(); os._exit(1)"
+        )
+        process = subprocess.run([sys.executable, "-c", code, self.db_path],
+                                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(process.returncode, 1)
+        index_query = "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL ORDER BY name"
+        with closing(main.connect(self.db_path)) as conn:
+            self.assertEqual(conn.execute(index_query).fetchall(), [("shops_goods_id_good_location",)])
+            main.create_tables_in_db(conn.cursor())
+            self.assertEqual(conn.execute(index_query).fetchall(), [
+                ("goods_stock_total_amount",), ("shops_goods_id_good_location",), ("shops_goods_location_amount",)])
+            self.assertEqual(main.rebuild_dropped_indexes(conn.cursor()), [])
+
+
+class TestChangeDetection(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = main.connect(":memory:")
+        main.create_tables_in_db(self.conn.cursor())
+        self.detector = main.ChangeDetector(self.conn.cursor())
+        self.prepared = main.prepare_data_for_insert_update(DATA)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_unchanged_rows_are_skipped(self):
+        self.assertEqual(main.write_batch(self.conn, [self.prepared], self.detector), 0)
+        self.assertEqual(main.write_batch(self.conn, [self.prepared], self.detector), 3)
+        changed = dict(self.prepared, location_and_quantity=[{"location": "Магазин на Ленина", "amount": 4},
+                                                             {"location": "Магазин в центре", "amount": 9}])
+        self.assertEqual(main.write_batch(self.conn, [changed], self.detector), 2)
+        self.assertEqual(self.conn.execute("SELECT location, amount FROM shops_goods ORDER BY id").fetchall(),
+                         [("Магазин на Ленина", 4), ("Магазин в центре", 9)])
+
+    def test_fingerprints_are_loaded_from_database(self):
+        main.write_batch(self.conn, [self.prepared], self.detector)
+        new_detector = main.ChangeDetector(self.conn.cursor(), cache_size=1)
+        self.assertEqual(main.write_batch(self.conn, [self.prepared], new_detector), 3)
+
+    def test_duplicates_within_batch_are_compared_with_each_other(self):
+        renamed = dict(self.prepared, name="Морозильник")
+        skipped = main.write_batch(self.conn, [self.prepared, renamed, renamed], self.detector)
+        self.assertEqual(skipped, 5)
+        self.assertEqual(self.conn.execute("SELECT name FROM goods").fetchall(), [("Морозильник",)])
+
+    def test_ingestion_reports_skipped_writes(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, "goods.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump([DATA, DATA], f)
+        report = main.ingest_files(self.conn, [path], VALIDATION_SCHEMA, batch_size=1, change_detector=self.detector)
+        tmp_dir.cleanup()
+        self.assertEqual(report.skipped_writes, 3)
+
+
+class TestWriteRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "goods.db")
+        self.holder = main.connect(self.db_path, check_same_thread=False)
+        main.create_tables_in_db(self.holder.cursor())
+
+    def tearDown(self):
+        main.use_write_retry(main.DEFAULT_WRITE_RETRY)
+        self.holder.close()
+        self.tmp_dir.cleanup()
+
+    def test_only_locked_errors_are_retried(self):
+        calls = []
+
+        def fail(error):
+            calls.append(error)
+            raise error
+
+        policy = main.RetryPolicy(attempts=3, initial_delay=0.0)
+        with self.assertRaises(sqlite3.OperationalError):
+            policy.run(lambda: fail(sqlite3.OperationalError("database is locked")))
+        self.assertEqual(len(calls), 3)
+        with self.assertRaises(sqlite3.OperationalError):
+            policy.run(lambda: fail(sqlite3.OperationalError("no such table: goods")))
+        self.assertEqual(len(calls), 4)
+        self.assertTrue(all(0 <= policy.delay(retry) <= 0.1 * 2**retry for retry in range(5) for _ in range(10)))
+
+    def test_writer_outlasts_a_lock_held_longer_than_its_busy_timeout(self):
+        prepared = main.prepare_data_for_insert_update(DATA)
+        for attempts in (1, 10):
+            main.use_write_retry(main.RetryPolicy(attempts=attempts, initial_delay=0.05, max_delay=0.1))
+            self.holder.execute("BEGIN IMMEDIATE")
+            releaser = threading.Timer(0.3, self.holder.rollback)
+            releaser.start()
+            with closing(main.connect(self.db_path, timeout=0.01)) as conn:
+                if attempts == 1:
+                    with self.assertRaisesRegex(sqlite3.OperationalError, "locked"):
+                        main.write_batch(conn, [prepared])
+                else:
+                    main.write_batch(conn, [prepared])
+                    self.assertEqual(main.get_good(conn.cursor(), DATA["id"]), DATA)
+            releaser.join()
+
+
+class TestCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = [
+            dict(DATA, id=1),
+            dict(DATA, id=2),
+            dict(DATA, id=1, name="Морозильник", location_and_quantity=[
+                {"location": "Магазин в центре", "amount": 4}, {"location": "Новый магазин", "amount": 1}]),
+            dict(DATA, id=1, name="Морозильник", location_and_quantity=[{"location": "Новый магазин", "amount": 2}]),
+        ]
+
+    def tables(self, write):
+        with main.connect(":memory:") as conn:
+            main.create_tables_in_db(conn.cursor())
+            write(conn)
+            tables = [conn.execute(f"SELECT {columns} FROM {table} ORDER BY 1, 2").fetchall()
+                      for columns, table in (("*", "goods"), ("id_good, location, amount", "shops_goods"),
+                                             ("*", "goods_stock"), ("*", "location_stock"))]
+        conn.close()
+        return tables
+
+    def test_coalesced_batch_is_written_like_documents_one_by_one(self):
+        coalesced = main.coalesce_batch(self.batch)
+        self.assertEqual([data["id"] for data in coalesced], [1, 2])
+        self.assertEqual(coalesced[0]["location_and_quantity"], [
+            {"location": "Магазин на Ленина", "amount": 0}, {"location": "Магазин в центре", "amount": 4},
+            {"location": "Новый магазин", "amount": 2}])
+
+        def one_by_one(conn):
+            for data in self.batch:
+                main.write_batch(conn, [main.prepare_data_for_insert_update(data)])
+
+        prepared = main.coalesce_batch([main.prepare_data_for_insert_update(data) for data in self.batch])
+        self.assertEqual(self.tables(lambda conn: main.write_batch(conn, prepared)), self.tables(one_by_one))
+
+    def test_batch_without_repeats_is_kept(self):
+        self.assertEqual(main.coalesce_batch(self.batch[:2]), self.batch[:2])
+
+    def test_ingestion_reports_collapsed_documents(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "goods.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.batch, f)
+            for detector in (False, True):
+                with main.connect(":memory:") as conn:
+                    main.create_tables_in_db(conn.cursor())
+                    change_detector = main.ChangeDetector(conn.cursor()) if detector else None
+                    report = main.ingest_files(conn, [path], VALIDATION_SCHEMA, change_detector=change_detector)
+                    self.assertEqual(main.get_good(conn.cursor(), 1)["name"], "Морозильник")
+                conn.close()
+                self.assertEqual((report.documents, report.collapsed), (4, 2))
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "goods.ndjson")
+        self.goods = [dict(DATA, id=good_id, name=f"Товар {good_id}") for good_id in range(1, 51)]
+        self.write_goods(self.goods)
+        self.conn = main.connect(":memory:")
+        main.create_tables_in_db(self.conn.cursor())
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp_dir.cleanup()
+
+    def write_goods(self, goods, newline="\n"):
+        with open(self.path, 'w', encoding='utf-8', newline="") as f:
+            f.write(newline.join(json.dumps(good, ensure_ascii=False) for good in goods) + newline)
+
+    def ingest(self):
+        checkpoint = main.Checkpoint(self.conn.cursor())
+        return main.ingest_files(self.conn, [self.path], VALIDATION_SCHEMA, batch_size=20, checkpoint=checkpoint)
+
+    def test_restart_resumes_after_last_committed_batch(self):
+        self.conn.execute("CREATE TRIGGER crash BEFORE INSERT ON goods WHEN NEW.id = 30 "
+                          "BEGIN SELECT RAISE(ABORT, 'crash'); END")
+        with self.assertRaises(sqlite3.Error):
+            self.ingest()
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM goods").fetchone()[0], 20)
+        self.assertEqual(self.conn.execute("SELECT documents FROM ingest_progress").fetchone()[0], 20)
+        self.conn.execute("DROP TRIGGER crash")
+        report = self.ingest()
+        self.assertEqual((report.documents, report.batches), (30, 2))
+        names = dict(self.conn.execute("SELECT id, name FROM goods").fetchall())
+        self.assertEqual(names, {good["id"]: good["name"] for good in self.goods})
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM shops_goods").fetchone()[0], 100)
+
+    def test_restart_resumes_crlf_file_after_last_committed_batch(self):
+        self.write_goods(self.goods, newline="\r\n")
+        self.conn.execute("CREATE TRIGGER crash BEFORE INSERT ON goods WHEN NEW.id = 30 "
+                          "BEGIN SELECT RAISE(ABORT, 'crash'); END")
+        with self.assertRaises(sqlite3.Error):
+            self.ingest()
+        offset = self.conn.execute("SELECT offset FROM ingest_progress").fetchone()[0]
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read()[offset - 1:offset + 2], b"}\r\n")
+        self.conn.execute("DROP TRIGGER crash")
+        report = self.ingest()
+        self.assertEqual((report.documents, report.invalid), (30, 0))
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM goods").fetchone()[0], 50)
+
+    def test_loaded_file_is_skipped_and_changed_file_is_read_again(self):
+        self.assertEqual(self.ingest().documents, 50)
+        self.assertEqual(self.ingest().documents, 0)
+        self.write_goods(self.goods[:10])
+        self.assertEqual(self.ingest().documents, 10)
+
+
+class TestParallelIngestion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "goods.db")
+        self.ndjson_path = os.path.join(self.tmp_dir.name, "goods.ndjson")
+        self.goods = [dict(DATA, id=good_id % 40, name=f"Товар {good_id}") for good_id in range(100)]
+        with open(self.ndjson_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(json.dumps(good, ensure_ascii=False) for good in self.goods) + "\n")
+        with main.connect(self.db_path) as conn:
+            main.create_tables_in_db(conn.cursor())
+        conn.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_ndjson_ranges_cover_every_document_once(self):
+        items = list(main.iter_work_items([self.ndjson_path], split_size=500))
+        self.assertGreater(len(items), 1)
+        documents = [doc for _, start, end in items for doc in main._iter_ndjson_range(self.ndjson_path, start, end)]
+        self.assertEqual(documents, self.goods)
+
+    def test_only_line_delimited_files_are_split(self):
+        pretty_path = os.path.join(self.tmp_dir.name, "pretty.json")
+        with open(pretty_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(json.dumps(good, ensure_ascii=False, indent=4) for good in self.goods))
+        mixed_path = os.path.join(self.tmp_dir.name, "mixed.json")
+        with open(mixed_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(json.dumps(good, ensure_ascii=False) for good in self.goods[:10]) + "\n")
+            f.write("\n".join(json.dumps(good, ensure_ascii=False, indent=4) for good in self.goods[10:]))
+        for path in (pretty_path, mixed_path):
+            self.assertEqual(list(main.iter_work_items([path], split_size=500)), [(path, 0, -1)])
+        os.remove(self.ndjson_path)
+        report = main.ingest_files_parallel(self.db_path, [pretty_path], VALIDATION_SCHEMA, batch_size=7, workers=2)
+        self.assertEqual((report.documents, report.invalid), (100, 0))
+
+    def test_later_documents_win_in_parallel_ingestion(self):
+        report = main.ingest_files_parallel(self.db_path, [self.tmp_dir.name, self.ndjson_path], VALIDATION_SCHEMA,
+                                            batch_size=7, workers=2, queue_depth=1)
+        self.assertEqual((report.documents, report.invalid), (100, 0))
+        with main.connect(self.db_path) as conn:
+            names = dict(conn.execute("SELECT id, name FROM goods").fetchall())
+        conn.close()
+        last_names = {}
+        for good in self.goods:
+            last_names[good["id"]] = good["name"]
+        self.assertEqual(names, last_names)
+
 
 if __name__ == "__main__":
     unittest.main()
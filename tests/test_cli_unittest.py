@@ -0,0 +1,304 @@
+import io
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+import analytics
+import export
+import main
+import metrics
+import rejections
+import server
+import sharding
+import snapshot
+
+GOODS_SCHEMA = os.path.join(ROOT, "goods.schema.json")
+DELTA_SCHEMA = os.path.join(ROOT, "delta.schema.json")
+GOODS = [
+    {
+        "id": good_id,
+        "name": f"Холодильник {good_id}",
+        "package_params": {"width": 120, "height": 270},
+        "location_and_quantity": [
+            {"location": "Магазин на Ленина", "amount": good_id},
+            {"location": "Магазин в центре", "amount": 9},
+        ],
+    }
+    for good_id in range(1, 31)
+]
+
+
+class CliTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = self.path("goods.db")
+        self.goods_path = self.write("goods.ndjson", GOODS + [dict(GOODS[0], id="bad")])
+
+    def tearDown(self):
+        metrics.REGISTRY.enabled = False
+        metrics.REGISTRY.reset()
+        main.use_checker_cache(None)
+        main.use_write_retry(main.DEFAULT_WRITE_RETRY)
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def write(self, name, documents):
+        with open(self.path(name), 'w', encoding='utf-8') as f:
+            f.write("".join(json.dumps(document, ensure_ascii=False) + "\n" for document in documents))
+        return self.path(name)
+
+    def run_cli(self, entry_point, argv):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            self.assertEqual(entry_point(argv), 0)
+        return stdout.getvalue()
+
+    def assert_cli_error(self, entry_point, argv, message):
+        stderr = io.StringIO()
+        with redirect_stdout(io.StringIO()), redirect_stderr(stderr), self.assertRaises(SystemExit) as raised:
+            entry_point(argv)
+        self.assertEqual(raised.exception.code, 2)
+        self.assertIn(message, stderr.getvalue())
+
+    def query(self, query, db_path=None):
+        with main.connect(db_path or self.db_path) as conn:
+            rows = conn.execute(query).fetchall()
+        conn.close()
+        return rows
+
+    def ingest(self, *options, paths=None):
+        argv = [*(paths or [self.goods_path]), "--db", self.db_path, "--schema", GOODS_SCHEMA, "--no-checker-cache"]
+        return self.run_cli(main.main, argv + list(options))
+
+
+class TestIngestionCli(CliTestCase):
+
+    def test_goods_are_loaded_and_report_is_printed(self):
+        output = self.ingest("--batch-size", "7", "--metrics-file", self.path("metrics.json"),
+                             "--metrics-format", "json")
+        self.assertIn("Документов обработано: 31, невалидных: 1, транзакций: 5", output)
+        self.assertEqual(self.query("SELECT count(*) FROM goods"), [(30,)])
+        self.assertEqual(self.query("SELECT count(*) FROM shops_goods"), [(60,)])
+        with open(self.path("metrics.json"), encoding="utf-8") as f:
+            self.assertTrue(json.load(f))
+
+    def test_option_conflicts_are_rejected(self):
+        cases = [
+            (["--write-attempts", "0"], "--write-attempts must be at least 1"),
+            (["--snapshot-interval", "1"], "--snapshot-every-batches and --snapshot-interval need --snapshot"),
+            (["--snapshot-every-batches", "2"], "--snapshot-every-batches and --snapshot-interval need --snapshot"),
+            (["--replay", "--workers", "2"], "--replay can't be used with --workers"),
+            (["--checkpoint", "--workers", "2"], "--checkpoint can't be used with --replay or --workers"),
+            (["--checkpoint", "--replay"], "--checkpoint can't be used with --replay or --workers"),
+            (["--deltas", "--workers", "0"], "--deltas can't be used with --workers"),
+            (["--replay", "--rejections", self.goods_path], "--rejections file can't be replayed in the same run"),
+        ]
+        for options, message in cases:
+            with self.subTest(options=options):
+                self.assert_cli_error(main.main, [self.goods_path, "--db", self.db_path] + options, message)
+        self.assertFalse(os.path.exists(self.db_path))
+
+    def test_workers_load_every_good(self):
+        output = self.ingest("--workers", "2", "--queue-depth", "1", "--rejections", self.path("rejected.ndjson"))
+        self.assertIn("Документов обработано: 31, невалидных: 1", output)
+        self.assertEqual(self.query("SELECT count(*) FROM goods"), [(30,)])
+        records = main.iter_json_documents(self.path("rejected.ndjson"))
+        self.assertEqual([record["document"]["id"] for record in records], ["bad"])
+
+    def test_checkpoint_skips_loaded_files(self):
+        self.assertIn("Документов обработано: 31", self.ingest("--checkpoint"))
+        self.assertIn("Документов обработано: 0", self.ingest("--checkpoint"))
+        self.assertEqual(self.query("SELECT count(*) FROM goods"), [(30,)])
+
+    def test_replay_ingests_rejected_goods(self):
+        self.ingest()
+        rejected = [rejections.rejection_record(dict(good, name="Морозильник"), []) for good in GOODS[:3]]
+        output = self.ingest("--replay", paths=[self.write("rejected.ndjson", rejected)])
+        self.assertIn("Документов обработано: 3, невалидных: 0", output)
+        self.assertEqual(self.query("SELECT count(*) FROM goods WHERE name = 'Морозильник'"), [(3,)])
+
+    def test_snapshots_are_published(self):
+        replica = self.path("replica.db")
+        output = self.ingest("--batch-size", "10", "--snapshot", replica, "--snapshot-every-batches", "2")
+        self.assertIn("Документов обработано: 31", output)
+        self.assertEqual(self.query("SELECT count(*) FROM goods", replica), [(30,)])
+
+    def test_stock_deltas_are_added(self):
+        self.ingest()
+        deltas = [{"id_good": good["id"], "location": "Магазин в центре", "delta": -2} for good in GOODS]
+        argv = ["--deltas", self.write("deltas.ndjson", deltas), "--db", self.db_path, "--schema", DELTA_SCHEMA,
+                "--no-checker-cache"]
+        self.assertIn("Документов обработано: 30", self.run_cli(main.main, argv))
+        self.assertEqual(self.query("SELECT DISTINCT amount FROM shops_goods WHERE location = 'Магазин в центре'"),
+                         [(7,)])
+
+
+class TestShardedCli(CliTestCase):
+
+    def test_goods_are_loaded_into_shards(self):
+        directory = self.path("shards")
+        output = self.run_cli(sharding.main_sharded, [self.goods_path, "--dir", directory, "--shards", "2",
+                                                      "--schema", GOODS_SCHEMA, "--batch-size", "8"])
+        self.assertIn("Документов обработано: 31, невалидных: 1, транзакций: 4", output)
+        counts = [self.query("SELECT count(*) FROM goods", sharding.shard_path(directory, shard, 2))[0][0]
+                  for shard in range(2)]
+        self.assertEqual(sum(counts), 30)
+        self.assertNotIn(0, counts)
+
+
+class TestWatcherCli(CliTestCase):
+
+    def test_dropped_files_are_loaded_until_terminated(self):
+        spool = self.path("spool")
+        os.mkdir(spool)
+        # The watcher runs until a signal, so it's started as a separate process.
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "watcher.py"), spool, "--db", self.db_path,
+             "--schema", GOODS_SCHEMA, "--no-inotify", "--poll-interval", "0.05", "--batch-size", "10"],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+        try:
+            os.replace(self.write("drop.json", GOODS[:5]), os.path.join(spool, "drop.json"))
+            archive, deadline = os.path.join(spool, "archive"), time.monotonic() + 10
+            while not (os.path.isdir(archive) and os.listdir(archive)):
+                self.assertLess(time.monotonic(), deadline, "the dropped file isn't archived")
+                time.sleep(0.05)
+        finally:
+            process.send_signal(signal.SIGTERM)
+            stdout, stderr = process.communicate(timeout=10)
+        self.assertEqual(process.returncode, 0, stderr)
+        self.assertIn(f"Ожидание файлов в {spool}", stdout)
+        self.assertEqual(self.query("SELECT count(*) FROM goods"), [(5,)])
+
+
+class TestExportCli(CliTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ingest()
+
+    def test_full_and_incremental_exports(self):
+        output_path = self.path("export.ndjson")
+        self.run_cli(export.main_export, ["--db", self.db_path, "--output", output_path, "--track-changes"])
+        self.assertEqual(list(main.iter_json_documents(output_path)), GOODS)
+        watermark_file = self.path("watermark")
+        self.run_cli(export.main_export, ["--db", self.db_path, "--output", output_path, "--format", "array",
+                                          "--watermark-file", watermark_file])
+        self.assertEqual(list(main.iter_json_documents(output_path)), GOODS)
+        self.ingest(paths=[self.write("changed.ndjson", [dict(GOODS[4], name="Морозильник")])])
+        self.run_cli(export.main_export, ["--db", self.db_path, "--output", output_path,
+                                          "--watermark-file", watermark_file])
+        self.assertEqual(list(main.iter_json_documents(output_path)), [dict(GOODS[4], name="Морозильник")])
+
+    def test_option_errors(self):
+        argv = ["--db", self.db_path, "--since", "0", "--watermark-file", self.path("watermark")]
+        self.assert_cli_error(export.main_export, argv, "--since can't be used with --watermark-file")
+        self.assert_cli_error(export.main_export, ["--db", self.db_path, "--since", "0"],
+                              "changes of goods aren't tracked")
+
+
+class TestSnapshotCli(CliTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ingest()
+        self.replica = self.path("replica.db")
+
+    def test_snapshot_is_published_once(self):
+        self.run_cli(snapshot.main_snapshot, ["--db", self.db_path, "--replica", self.replica, "--once"])
+        self.assertEqual(self.query("SELECT count(*) FROM goods", self.replica), [(30,)])
+        self.assert_cli_error(snapshot.main_snapshot, ["--db", self.db_path], "--replica")
+
+    def test_snapshots_are_published_until_terminated(self):
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "snapshot.py"), "--db", self.db_path, "--replica", self.replica,
+             "--interval", "0.05"],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+        try:
+            deadline = time.monotonic() + 10
+            while not os.path.exists(self.replica):
+                self.assertLess(time.monotonic(), deadline, "no snapshot is published")
+                time.sleep(0.05)
+            self.ingest(paths=[self.write("changed.ndjson", [dict(GOODS[0], id=100)])])
+        finally:
+            process.send_signal(signal.SIGTERM)
+            stdout, stderr = process.communicate(timeout=10)
+        self.assertEqual(process.returncode, 0, stderr)
+        self.assertIn(f"Опубликовано снимков базы в {self.replica}", stdout)
+        self.assertEqual(self.query("SELECT count(*) FROM goods", self.replica), [(31,)])
+
+
+class TestAnalyticsCli(CliTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ingest()
+
+    @unittest.skipIf(analytics.np is None, "NumPy is not installed")
+    def test_report_is_printed(self):
+        output = self.run_cli(analytics.main_analytics, ["--db", self.db_path, "--top", "3", "--chunk-size", "7"])
+        self.assertIn("Холодильник 1", output)
+        for options, message in ((["--top", "-1"], "--top must not be negative"),
+                                 (["--chunk-size", "0"], "--chunk-size must be positive"),
+                                 (["--percentiles", "101"], "percentiles must be from 0 to 100")):
+            with self.subTest(options=options):
+                self.assert_cli_error(analytics.main_analytics, ["--db", self.db_path] + options, message)
+
+    @unittest.skipIf(analytics.np is not None, "NumPy is installed")
+    def test_clear_error_without_numpy(self):
+        self.assert_cli_error(analytics.main_analytics, ["--db", self.db_path], "pip install numpy")
+
+
+class TestServerCli(CliTestCase):
+
+    def test_arguments_are_parsed_from_argv(self):
+        args = server.parse_args(["--db", self.db_path, "--port", "0", "--batch-size", "5", "--flush-ms", "20"])
+        self.assertEqual((args.db, args.port, args.unix), (self.db_path, 0, None))
+        self.assertEqual((args.batch_size, args.flush_ms), (5, 20))
+        self.assertEqual(server.parse_args([]).max_pending, server.DEFAULT_MAX_PENDING)
+        self.assert_cli_error(server.parse_args, ["--metrics-format", "xml"], "--metrics-format")
+
+    def test_goods_are_accepted_until_interrupted(self):
+        socket_path = self.path("goods.sock")
+        # The service runs until it's interrupted, so it's started as a separate process.
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "server.py"), "--db", self.db_path, "--unix", socket_path,
+             "--schema", GOODS_SCHEMA, "--flush-ms", "10"],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+        try:
+            deadline = time.monotonic() + 10
+            while not os.path.exists(socket_path):
+                self.assertLess(time.monotonic(), deadline, "the service doesn't listen")
+                time.sleep(0.05)
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(socket_path)
+                body = json.dumps(GOODS[:3]).encode("utf-8")
+                client.sendall(b"POST /goods HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % len(body)
+                               + body)
+                response = b"".join(iter(lambda: client.recv(65536), b""))
+        finally:
+            process.send_signal(signal.SIGINT)
+            stdout, stderr = process.communicate(timeout=10)
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"), response)
+        self.assertEqual(process.returncode, 0, stderr)
+        self.assertEqual(json.loads(stdout)["committed"], 3)
+        self.assertEqual(self.query("SELECT count(*) FROM goods"), [(3,)])
+
+
+if __name__ == "__main__":
+    unittest.main()
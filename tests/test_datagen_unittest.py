@@ -0,0 +1,38 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from constant_test_cases import VALIDATION_SCHEMA
+import datagen
+import main
+
+
+class TestGoodsGenerator(unittest.TestCase):
+
+    def test_generated_goods_are_valid(self):
+        validator = main.SchemaValidator(VALIDATION_SCHEMA, fast=False)
+        for good in datagen.generate_goods(200, shops_per_good=4, update_share=0.3):
+            self.assertTrue(validator.is_valid(good), good)
+            self.assertEqual(len(good["location_and_quantity"]), 4)
+
+    def test_invalid_share_of_goods_violates_schema(self):
+        validator = main.SchemaValidator(VALIDATION_SCHEMA, fast=False)
+        goods = list(datagen.generate_goods(1000, invalid_share=0.2))
+        invalid = sum(1 for good in goods if not validator.is_valid(good))
+        self.assertTrue(150 < invalid < 250, invalid)
+
+    def test_updates_repeat_earlier_ids(self):
+        ids = [good["id"] for good in datagen.generate_goods(1000, update_share=0.3)]
+        self.assertTrue(250 < len(ids) - len(set(ids)) < 350)
+        self.assertEqual(set(ids), set(range(len(set(ids)))))
+
+    def test_generation_is_deterministic(self):
+        self.assertEqual(list(datagen.generate_goods(50, seed=7, update_share=0.5)),
+                         list(datagen.generate_goods(50, seed=7, update_share=0.5)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from constant_test_cases import VALIDATION_SCHEMA
+import datagen
+import export
+import main
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.goods = list(datagen.generate_goods(120, shops_per_good=3, shop_count=6, update_share=0.2))
+        self.conn = main.connect(":memory:")
+        main.create_tables_in_db(self.conn.cursor())
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(good) for good in self.goods])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def export(self, **kwargs):
+        f = io.StringIO()
+        report = export.export_goods(self.conn, f, fetch_size=7, **kwargs)
+        return report, [json.loads(line) for line in f.getvalue().splitlines()]
+
+    def tables(self, conn):
+        # Ids of shops_goods rows aren't exported.
+        return [conn.execute(f"SELECT {columns} FROM {table} ORDER BY 1, 2").fetchall()
+                for columns, table in (("*", "goods"), ("id_good, location, amount", "shops_goods"),
+                                       ("*", "goods_stock"), ("*", "location_stock"))]
+
+    def test_exported_goods_load_into_the_same_tables(self):
+        report, goods = self.export()
+        self.assertEqual(report.goods, len({good["id"] for good in self.goods}))
+        self.assertEqual([good["id"] for good in goods], sorted(good["id"] for good in goods))
+        self.assertEqual(goods[0], main.get_good(self.conn.cursor(), goods[0]["id"]))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "export.json")
+            export.export_to_file(self.conn, path, "array")
+            with main.connect(":memory:") as copy:
+                main.create_tables_in_db(copy.cursor())
+                ingested = main.ingest_files(copy, [path], VALIDATION_SCHEMA)
+                self.assertEqual(self.tables(copy), self.tables(self.conn))
+            copy.close()
+            self.assertEqual(os.listdir(tmp_dir), ["export.json"])
+        self.assertEqual((ingested.documents, ingested.invalid), (report.goods, 0))
+
+    def test_empty_array_is_valid_json(self):
+        f = io.StringIO()
+        self.assertEqual(export.write_goods([], f, "array"), 0)
+        self.assertEqual(json.loads(f.getvalue()), [])
+
+    def test_incremental_export_holds_only_changed_goods(self):
+        for normalized in (False, True):
+            if normalized:
+                main.normalize_db(self.conn.cursor())
+            watermark = self.export(track_changes=True)[0].watermark
+            first, second, third = (main.get_good(self.conn.cursor(), good["id"]) for good in self.goods[:3])
+            main.write_batch(self.conn, [main.prepare_data_for_insert_update(good) for good in (
+                first,
+                dict(second, name=f"Новое имя {normalized}"),
+                dict(third, location_and_quantity=[{"location": "Новый магазин", "amount": normalized}]),
+                dict(first, id=10**6 + normalized),
+            )])
+            main.write_stock_deltas(self.conn, [dict(id_good=self.goods[3]["id"], delta=2,
+                                                     location=self.goods[3]["location_and_quantity"][0]["location"])])
+            report, goods = self.export(since=watermark)
+            self.assertEqual([good["id"] for good in goods],
+                             [second["id"], third["id"], 10**6 + normalized, self.goods[3]["id"]],
+                             msg=f"normalized: {normalized}")
+            self.assertEqual(goods[1], main.get_good(self.conn.cursor(), third["id"]))
+            self.assertGreater(report.watermark, watermark)
+            self.assertEqual(self.export(since=report.watermark)[1], [])
+
+    def test_incremental_export_needs_change_tracking(self):
+        with self.assertRaises(ValueError):
+            self.export(since=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
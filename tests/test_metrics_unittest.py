@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constant_test_cases import VALIDATION_SCHEMA
+import main
+import metrics
+
+
+GOOD = {
+    "id": 3,
+    "name": "Холодильник",
+    "package_params": {"width": 120, "height": 270},
+    "location_and_quantity": [
+        {"location": "Магазин на Ленина", "amount": 0},
+        {"location": "Магазин в центре", "amount": 9},
+    ],
+}
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.counter = self.registry.counter("rows_total", "Rows.", labelnames=("table",))
+        self.histogram = self.registry.histogram("commit_seconds", "Commits.", buckets=(0.1, 1))
+
+    def test_disabled_metrics_are_not_changed(self):
+        self.counter.labels(table="goods").inc(5)
+        self.histogram.observe(0.5)
+        self.assertEqual(self.counter.labels(table="goods").value, 0)
+        self.assertEqual(self.histogram.count, 0)
+        func = len
+        self.assertIs(metrics.timed(func, self.counter.labels(table="goods")), func)
+
+    def test_prometheus_format(self):
+        self.registry.enabled = True
+        self.counter.labels(table="goods").inc(2)
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+        self.assertEqual(self.registry.to_prometheus().splitlines(), [
+            "# HELP rows_total Rows.",
+            "# TYPE rows_total counter",
+            'rows_total{table="goods"} 2',
+            "# HELP commit_seconds Commits.",
+            "# TYPE commit_seconds histogram",
+            'commit_seconds_bucket{le="0.1"} 1',
+            'commit_seconds_bucket{le="1"} 2',
+            'commit_seconds_bucket{le="+Inf"} 3',
+            "commit_seconds_sum 5.55",
+            "commit_seconds_count 3",
+        ])
+
+    def test_dump_in_json(self):
+        self.registry.enabled = True
+        self.counter.labels(table="shops_goods").inc()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metrics.json")
+            self.registry.dump(path, "json")
+            with open(path, encoding="utf-8") as f:
+                dumped = json.load(f)
+        self.assertEqual(dumped["rows_total"]["samples"], [{"labels": {"table": "shops_goods"}, "value": 1}])
+
+    def test_updates_from_threads_are_not_lost(self):
+        self.registry.enabled = True
+        counter = self.counter.labels(table="goods")
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads as often as possible to interleave the updates
+        try:
+            threads = [threading.Thread(target=lambda: [(counter.inc(), self.histogram.observe(0.5))
+                                                        for _ in range(20000)]) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        self.assertEqual((counter.value, self.histogram.count, self.histogram.bucket_counts), (80000, 80000, [0, 80000]))
+
+    def test_metrics_must_implement_samples(self):
+        with self.assertRaises(TypeError):
+            metrics._Metric(self.registry, "metric", "Metric.", ())
+
+    def test_timed_iter_counts_time_of_producing_items(self):
+        self.registry.enabled = True
+        seconds = self.counter.labels(table="read")
+        self.assertEqual(list(metrics.timed_iter(range(3), seconds)), [0, 1, 2])
+        self.assertGreater(seconds.value, 0)
+
+
+class TestIngestionMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.REGISTRY.reset()
+        metrics.REGISTRY.enabled = True
+
+    def tearDown(self):
+        metrics.REGISTRY.enabled = False
+        metrics.REGISTRY.reset()
+
+    def test_stages_rows_and_commits_are_measured(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "goods.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump([GOOD, dict(GOOD, id=4), {"id": "bad"}], f)
+            conn = main.connect(":memory:")
+            main.create_tables_in_db(conn.cursor())
+            main.ingest_files(conn, [path], VALIDATION_SCHEMA, batch_size=1)
+            conn.close()
+        self.assertEqual(main.DOCUMENTS.value, 3)
+        self.assertEqual(main.VALIDATION_FAILURES.value, 1)
+        self.assertEqual(main.ROWS_WRITTEN.labels(table="goods").value, 2)
+        self.assertEqual(main.ROWS_WRITTEN.labels(table="shops_goods").value, 4)
+        self.assertEqual(main.COMMIT_SECONDS.count, 2)
+        for stage in ("read", "validate", "prepare", "write"):
+            self.assertGreater(main.STAGE_SECONDS.labels(stage=stage).value, 0, stage)
+
+
+if __name__ == "__main__":
+    unittest.main()
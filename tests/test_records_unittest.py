@@ -0,0 +1,67 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import datagen
+import main
+import records
+
+
+class TestGoodsBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.goods = list(datagen.generate_goods(50, shops_per_good=3, shop_count=4, update_share=0.4))
+
+    def test_columns_hold_goods_and_their_shops(self):
+        batch = records.GoodsBatch()
+        for good in self.goods[:2]:
+            batch.append(good)
+        self.assertEqual(len(batch), 2)
+        first, second = self.goods[:2]
+        self.assertEqual(list(batch.goods_rows())[0], (first["id"], first["name"],
+                                                        first["package_params"]["height"],
+                                                        first["package_params"]["width"]))
+        self.assertEqual(list(batch.shop_rows()), [
+            (good["id"], shop["location"], shop["amount"])
+            for good in (first, second) for shop in good["location_and_quantity"]])
+        good, shops = list(batch.records())[1]
+        self.assertEqual(good.name, second["name"])
+        self.assertEqual([shop.location for shop in shops],
+                         [shop["location"] for shop in second["location_and_quantity"]])
+
+    def test_batches_are_not_bigger_than_batch_size(self):
+        self.assertEqual([batch.documents for batch in records.iter_goods_batches(self.goods, 20)], [20, 20, 10])
+
+    def test_later_documents_of_a_good_overwrite_earlier_ones(self):
+        batch = records.GoodsBatch()
+        first = self.goods[0]
+        shops = first["location_and_quantity"]
+        batch.append(first)
+        batch.append(dict(first, name="Новое имя", location_and_quantity=[dict(shops[1], amount=99),
+                                                                         {"location": "Новый магазин", "amount": 1}]))
+        self.assertEqual((len(batch), batch.collapsed, batch.documents), (1, 1, 2))
+        good, good_shops = next(batch.records())
+        self.assertEqual(good.name, "Новое имя")
+        self.assertEqual([(shop.location, shop.amount) for shop in good_shops],
+                         [(shops[0]["location"], shops[0]["amount"]), (shops[1]["location"], 99),
+                          (shops[2]["location"], shops[2]["amount"]), ("Новый магазин", 1)])
+
+    def test_column_batches_are_written_like_prepared_goods(self):
+        databases = []
+        for write in (lambda conn, goods: main.write_batch(conn, main.coalesce_batch(
+                          [main.prepare_data_for_insert_update(good) for good in goods])),
+                      lambda conn, goods: main.write_records(conn, next(records.iter_goods_batches(goods, 100)))):
+            conn = main.connect(":memory:")
+            main.create_tables_in_db(conn.cursor())
+            write(conn, self.goods)
+            databases.append([conn.execute(f"SELECT * FROM {table} ORDER BY 1").fetchall()
+                              for table in ("goods", "shops_goods", "goods_stock", "location_stock")])
+            conn.close()
+        self.assertEqual(databases[0], databases[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from constant_test_cases import VALIDATION_SCHEMA
+import datagen
+import main
+import rejections
+
+
+class TestRejectionSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dead_letter_path = os.path.join(self.tmp_dir.name, "rejected.ndjson")
+        self.goods_path = os.path.join(self.tmp_dir.name, "goods.ndjson")
+        # every fifth document is invalid, datagen.VIOLATIONS are used in turn
+        datagen.write_goods(self.goods_path, datagen.generate_goods(100, invalid_share=1.0))
+        self.conn = main.connect(":memory:")
+        main.create_tables_in_db(self.conn.cursor())
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp_dir.cleanup()
+
+    def read_records(self):
+        with open(self.dead_letter_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_invalid_documents_are_written_with_error_paths(self):
+        output = io.StringIO()
+        with rejections.RejectionSink(self.dead_letter_path, stream=output) as sink:
+            self.assertFalse(main.is_data_valid({"id": "1", "name": "Утюг"}, VALIDATION_SCHEMA, sink=sink))
+            self.assertTrue(main.is_data_valid(next(datagen.generate_goods(1)), VALIDATION_SCHEMA, sink=sink))
+        record, = self.read_records()
+        self.assertEqual(record["document"], {"id": "1", "name": "Утюг"})
+        self.assertIn({"path": "/id", "rule": "/properties/id/type", "message": "'1' is not of type 'integer'"},
+                      record["errors"])
+        self.assertIn("/required", [error["rule"] for error in record["errors"]])
+        self.assertIn("/id: '1' is not of type 'integer'", output.getvalue())
+
+    def test_failures_are_counted_per_rule_and_messages_are_capped(self):
+        output = io.StringIO()
+        with rejections.RejectionSink(self.dead_letter_path, max_messages=3, stream=output) as sink:
+            report = main.ingest_files(self.conn, [self.goods_path], VALIDATION_SCHEMA, sink=sink)
+        self.assertEqual((report.documents, report.invalid), (100, 100))
+        self.assertEqual(sink.rejected, 100)
+        self.assertEqual(len(self.read_records()), 100)
+        self.assertEqual(output.getvalue().count("Данные не прошли валидацию"), 3)
+        self.assertEqual(sink.rule_failures["/properties/id/type"], 20)
+        self.assertEqual(sink.rule_failures["/additionalProperties"], 20)
+        self.assertIn("/properties/id/type: 20", sink.summary())
+
+    def test_rejected_documents_are_replayed(self):
+        with rejections.RejectionSink(self.dead_letter_path, max_messages=0) as sink:
+            main.ingest_files(self.conn, [self.goods_path], VALIDATION_SCHEMA, sink=sink)
+        fixed_schema = dict(VALIDATION_SCHEMA, additionalProperties=True)
+        report = main.ingest_files(self.conn, [self.dead_letter_path], fixed_schema,
+                                   read_documents=rejections.iter_rejected_documents)
+        self.assertEqual((report.documents, report.invalid), (100, 80))
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM goods").fetchone()[0], 20)
+
+    def test_workers_send_rejections_to_sink(self):
+        db_path = os.path.join(self.tmp_dir.name, "goods.db")
+        with main.connect(db_path) as conn:
+            main.create_tables_in_db(conn.cursor())
+        conn.close()
+        with rejections.RejectionSink(self.dead_letter_path, max_messages=0) as sink:
+            report = main.ingest_files_parallel(db_path, [self.goods_path], VALIDATION_SCHEMA, workers=2, sink=sink)
+        self.assertEqual(report.invalid, 100)
+        self.assertEqual([record["document"]["id"] for record in self.read_records()][:3], ["0", 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
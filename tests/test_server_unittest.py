@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constant_test_cases import VALIDATION_SCHEMA
+import main
+import server
+
+
+GOOD = {
+    "id": 3,
+    "name": "Холодильник",
+    "package_params": {"width": 120, "height": 270},
+    "location_and_quantity": [
+        {"location": "Магазин на Ленина", "amount": 0},
+        {"location": "Магазин в центре", "amount": 9},
+    ],
+}
+
+
+async def request(port, method, path, payload=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                 + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, response_body = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ")[1]), json.loads(response_body)
+
+
+class TestIngestionService(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "goods.db")
+        self.service = server.IngestionService(self.db_path, VALIDATION_SCHEMA, batch_size=10, flush_interval=0.02)
+        await self.service.start()
+        self.server = await asyncio.start_server(self.service.handle_connection, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.service.close()
+        self.tmp_dir.cleanup()
+
+    def rows(self, query):
+        with main.connect(self.db_path) as conn:
+            rows = conn.execute(query).fetchall()
+        conn.close()
+        return rows
+
+    async def test_documents_are_committed_in_micro_batches(self):
+        responses = await asyncio.gather(*(request(self.port, "POST", "/goods", dict(GOOD, id=good_id))
+                                           for good_id in range(25)))
+        self.assertEqual({status for status, _ in responses}, {200})
+        self.assertEqual(self.rows("SELECT count(*) FROM goods"), [(25,)])
+        self.assertEqual(self.rows("SELECT count(*) FROM shops_goods"), [(50,)])
+        status, stats = await request(self.port, "GET", "/stats")
+        self.assertEqual(status, 200)
+        self.assertEqual(stats["committed"], 25)
+        self.assertLess(stats["batches"], 25)
+        self.assertGreater(stats["latency_p99_ms"], 0)
+
+    async def test_invalid_documents_are_rejected(self):
+        status, payload = await request(self.port, "POST", "/goods", dict(GOOD, id="3"))
+        self.assertEqual(status, 400)
+        self.assertIn("'3' is not of type 'integer'", payload["errors"][0])
+        status, _ = await request(self.port, "POST", "/unknown", GOOD)
+        self.assertEqual(status, 404)
+        self.assertEqual(self.rows("SELECT count(*) FROM goods"), [(0,)])
+
+    async def test_bad_document_fails_only_its_own_request(self):
+        ids = [1, 2, 2 ** 63, 4]  # 2 ** 63 passes the schema but is out of SQLite integer range
+        responses = await asyncio.gather(*(request(self.port, "POST", "/goods", dict(GOOD, id=good_id))
+                                           for good_id in ids))
+        self.assertEqual([status for status, _ in responses], [200, 200, 400, 200])
+        self.assertIn("OverflowError", responses[2][1]["errors"][0])
+        self.assertEqual(self.rows("SELECT id FROM goods ORDER BY id"), [(1,), (2,), (4,)])
+        _, stats = await request(self.port, "GET", "/stats")
+        self.assertEqual(stats["committed"], 3)
+
+    async def test_repeated_goods_of_a_batch_are_written_once(self):
+        documents = [dict(GOOD, id=7), dict(GOOD, id=8), dict(GOOD, id=7, name="Морозильник"),
+                     dict(GOOD, id=8, name="Плита")]
+        with mock.patch.object(main, "write_batch", wraps=main.write_batch) as write_batch:
+            self.assertEqual(await request(self.port, "POST", "/goods", documents), (200, {"committed": 4}))
+        self.assertEqual([len(call.args[1]) for call in write_batch.call_args_list], [2])
+        self.assertEqual(self.rows("SELECT id, name FROM goods ORDER BY id"), [(7, "Морозильник"), (8, "Плита")])
+        _, stats = await request(self.port, "GET", "/stats")
+        self.assertEqual((stats["committed"], stats["collapsed"]), (4, 2))
+
+    async def test_locked_database_fails_the_whole_batch_at_once(self):
+        main.use_write_retry(main.RetryPolicy(attempts=1))
+        self.addCleanup(main.use_write_retry, main.DEFAULT_WRITE_RETRY)
+        await self.service._run_in_writer(self.service._conn.execute, "PRAGMA busy_timeout = 50")
+        locker = main.connect(self.db_path)
+        locker.execute("BEGIN IMMEDIATE")
+        try:
+            with mock.patch.object(main, "write_batch", wraps=main.write_batch) as write_batch:
+                status, payload = await request(self.port, "POST", "/goods",
+                                                [dict(GOOD, id=good_id) for good_id in range(3)])
+        finally:
+            locker.rollback()
+            locker.close()
+        self.assertEqual(status, 500)
+        self.assertEqual(len(payload["errors"]), 3)
+        self.assertIn("database is locked", payload["errors"][0])
+        self.assertEqual(write_batch.call_count, 1)
+
+    async def test_array_with_invalid_document_is_rejected_as_a_whole(self):
+        status, payload = await request(self.port, "POST", "/goods", [GOOD, dict(GOOD, id=4, name=None)])
+        self.assertEqual(status, 400)
+        self.assertEqual(len(payload["errors"]), 1)
+        self.assertEqual(self.rows("SELECT count(*) FROM goods"), [(0,)])
+
+    async def test_array_partly_failed_to_be_written_gets_result_per_document(self):
+        status, payload = await request(self.port, "POST", "/goods", [GOOD, dict(GOOD, id=-2 ** 64)])
+        self.assertEqual(status, 207)
+        self.assertEqual(payload["committed"], 1)
+        self.assertEqual([result["status"] for result in payload["results"]], [200, 400])
+        self.assertEqual(self.rows("SELECT id FROM goods"), [(3,)])
+
+    async def test_every_request_is_answered(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(b"POST /goods HTTP/1.1\r\nContent-Length: many\r\n\r\n")
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        self.assertTrue(response.startswith(b"HTTP/1.1 400 Bad Request\r\n"), response)
+        status, payload = await request(self.port, "GET", f"/goods/{2 ** 64}")
+        self.assertEqual(status, 400)
+        self.assertIn("OverflowError", payload["error"])
+
+    async def test_goods_are_looked_up_through_cache(self):
+        await request(self.port, "POST", "/goods", GOOD)
+        self.assertEqual(await request(self.port, "GET", "/goods/3"), (200, GOOD))
+        await request(self.port, "GET", "/goods/3")
+        status, _ = await request(self.port, "GET", "/goods/4")
+        self.assertEqual(status, 404)
+        await request(self.port, "POST", "/goods", dict(GOOD, name="Морозильник"))
+        status, good = await request(self.port, "GET", "/goods/3")
+        self.assertEqual(good["name"], "Морозильник")
+        _, stats = await request(self.port, "GET", "/stats")
+        self.assertEqual((stats["cache_hits"], stats["cache_misses"]), (1, 3))
+
+    async def test_normalized_database_shop_ids_are_loaded_once(self):
+        db_path = os.path.join(self.tmp_dir.name, "normalized.db")
+        with main.connect(db_path) as conn:
+            main.create_tables_in_db(conn.cursor())
+            main.normalize_db(conn.cursor())
+        conn.close()
+        service = server.IngestionService(db_path, VALIDATION_SCHEMA, batch_size=2, flush_interval=0.01)
+        await service.start()
+        try:
+            with mock.patch.object(main.LocationIds, "of_database", side_effect=AssertionError("reloaded")):
+                errors = await asyncio.gather(*(service.submit(dict(GOOD, id=good_id)) for good_id in range(5)))
+        finally:
+            await service.close()
+        self.assertEqual(errors, [None] * 5)
+        self.assertEqual(service.stats()["committed"], 5)
+        with main.connect(db_path) as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM shops_goods").fetchone(), (10,))
+        conn.close()
+
+    async def test_submit_waits_when_writer_falls_behind(self):
+        service = server.IngestionService(os.path.join(self.tmp_dir.name, "slow.db"), VALIDATION_SCHEMA,
+                                          max_pending=1)
+        await service._queue.put(({}, asyncio.get_running_loop().create_future(), 0.0))
+        submit = asyncio.ensure_future(service.submit(GOOD))
+        await asyncio.sleep(0.05)
+        self.assertFalse(submit.done())
+        submit.cancel()
+        service._executor.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
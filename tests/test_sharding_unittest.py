@@ -0,0 +1,131 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from constant_test_cases import VALIDATION_SCHEMA
+import datagen
+import main
+import sharding
+
+
+class TestShardedStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp_dir.name, "shards")
+        self.goods = list(datagen.generate_goods(200, shops_per_good=3, shop_count=5, update_share=0.3))
+        self.storage = sharding.ShardedStorage(self.directory, shards=3)
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+    def write_goods(self, batch_size=16):
+        batch = [main.prepare_data_for_insert_update(good) for good in self.goods]
+        for start in range(0, len(batch), batch_size):
+            self.storage.write_batch(batch[start:start + batch_size])
+        last_goods = {}
+        for good in self.goods:
+            last_goods[good["id"]] = good
+        return last_goods
+
+    def test_goods_live_in_their_shards(self):
+        last_goods = self.write_goods()
+        self.storage.close()
+        stored = 0
+        for shard, path in enumerate(self.storage.paths):
+            with main.connect(path) as conn:
+                ids = [id_good for id_good, in conn.execute("SELECT id FROM goods")]
+                shop_ids = {id_good for id_good, in conn.execute("SELECT id_good FROM shops_goods")}
+            conn.close()
+            self.assertTrue(ids)
+            self.assertTrue(all(sharding.shard_of(id_good, 3) == shard for id_good in ids))
+            self.assertEqual(shop_ids, set(ids))
+            stored += len(ids)
+        self.assertEqual(stored, len(last_goods))
+
+    def test_good_is_read_from_its_shard(self):
+        last_goods = self.write_goods()
+        for id_good, good in last_goods.items():
+            stored = self.storage.get_good(id_good)
+            self.assertEqual(stored["name"], good["name"])
+            self.assertEqual(self.storage.get_total_amount(id_good),
+                             sum(shop["amount"] for shop in good["location_and_quantity"]))
+        self.assertIsNone(self.storage.get_good(-1))
+        self.assertEqual(self.storage.count_goods(), len(last_goods))
+
+    def test_shop_queries_are_merged_from_every_shard(self):
+        last_goods = self.write_goods()
+        location = datagen.location(2)
+        amounts = sorted((id_good, shop["amount"]) for id_good, good in last_goods.items()
+                         for shop in good["location_and_quantity"] if shop["location"] == location)
+        self.assertEqual(self.storage.get_goods_in_stock_at_location(location),
+                         [pair for pair in amounts if pair[1] > 0])
+        self.assertEqual(self.storage.get_out_of_stock_goods(location),
+                         [id_good for id_good, amount in amounts if amount == 0])
+        self.assertEqual(self.storage.get_location_stock(location), {
+            "total_amount": sum(amount for _, amount in amounts),
+            "goods": len(amounts),
+            "out_of_stock_goods": sum(1 for _, amount in amounts if amount == 0),
+        })
+
+    def test_stock_deltas_are_applied_in_shards_of_goods(self):
+        last_goods = self.write_goods()
+        events = [{"id_good": id_good, "location": good["location_and_quantity"][0]["location"], "delta": 2}
+                  for id_good, good in last_goods.items()]
+        self.assertEqual(self.storage.write_stock_deltas(events + events), len(last_goods))
+        for id_good, good in last_goods.items():
+            self.assertEqual(self.storage.get_total_amount(id_good),
+                             sum(shop["amount"] for shop in good["location_and_quantity"]) + 4)
+
+    def test_goods_with_integral_float_ids_are_kept_in_shards_of_their_integers(self):
+        good = dict(self.goods[0], id=3.0)
+        self.storage.write_batch([main.prepare_data_for_insert_update(good)])
+        self.assertEqual(sharding.shard_of(3.0, 3), sharding.shard_of(3, 3))
+        self.assertEqual(self.storage.get_good(3)["name"], good["name"])
+
+    def test_stock_deltas_with_integral_float_ids_are_applied_in_shards_of_their_integers(self):
+        last_goods = self.write_goods()
+        id_good, good = next(iter(last_goods.items()))
+        location = good["location_and_quantity"][0]["location"]
+        self.assertEqual(
+            self.storage.write_stock_deltas([{"id_good": float(id_good), "location": location, "delta": 5}]), 1)
+        self.assertEqual(self.storage.get_total_amount(id_good),
+                         sum(shop["amount"] for shop in good["location_and_quantity"]) + 5)
+
+    def test_normalized_shards_load_shop_ids_once(self):
+        self.write_goods()
+        self.storage.close()
+        for path in self.storage.paths:
+            with main.connect(path) as conn:
+                main.normalize_db(conn.cursor())
+            conn.close()
+        self.storage = sharding.ShardedStorage(self.directory, shards=3)
+        with mock.patch.object(main.LocationIds, "of_database", side_effect=AssertionError("reloaded")):
+            last_goods = self.write_goods()
+            events = [{"id_good": id_good, "location": "Новый магазин", "delta": 1} for id_good in last_goods]
+            self.storage.write_stock_deltas(events)
+        for id_good, good in last_goods.items():
+            self.assertEqual(self.storage.get_total_amount(id_good),
+                             sum(shop["amount"] for shop in good["location_and_quantity"]) + 1)
+
+    def test_other_number_of_shards_is_rejected(self):
+        self.write_goods()
+        with self.assertRaises(ValueError):
+            sharding.ShardedStorage(self.directory, shards=4)
+
+    def test_files_are_ingested_into_shards(self):
+        path = os.path.join(self.tmp_dir.name, "goods.ndjson")
+        datagen.write_goods(path, self.goods)
+        report = sharding.ingest_files_sharded(self.storage, [path], VALIDATION_SCHEMA, batch_size=50)
+        self.assertEqual((report.documents, report.invalid, report.batches), (200, 0, 4))
+        self.assertEqual(self.storage.count_goods(), len({good["id"] for good in self.goods}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import closing
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from constant_test_cases import VALIDATION_SCHEMA
+import datagen
+import main
+import snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "goods.db")
+        self.replica = os.path.join(self.tmp_dir.name, "replica.db")
+        self.conn = main.connect(self.db_path)
+        main.create_tables_in_db(self.conn.cursor())
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp_dir.cleanup()
+
+    def write(self, count, seed=0):
+        goods = list(datagen.generate_goods(count, seed=seed))
+        main.write_batch(self.conn, [main.prepare_data_for_insert_update(good) for good in goods])
+
+    def goods(self, conn):
+        return conn.execute("SELECT * FROM goods ORDER BY id").fetchall()
+
+    def test_replica_is_a_read_only_copy_taken_while_a_writer_holds_a_transaction(self):
+        self.write(200)
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute("DELETE FROM goods")
+        report = snapshot.publish_snapshot(self.db_path, self.replica, pages=2)
+        self.conn.rollback()
+        self.assertEqual(os.listdir(self.tmp_dir.name).count("replica.db.tmp"), 0)
+        self.assertEqual(report.size, os.path.getsize(self.replica))
+        with closing(snapshot.open_replica(self.replica)) as reader:
+            self.assertEqual(self.goods(reader), self.goods(self.conn))
+            self.assertEqual(reader.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.execute("DELETE FROM goods")
+
+    def test_open_reader_keeps_its_snapshot_until_it_reconnects(self):
+        self.write(50)
+        with snapshot.SnapshotPublisher(self.db_path, self.replica) as publisher:
+            publisher.publish()
+            self.assertIsNone(publisher.publish_if_changed())
+            with closing(snapshot.open_replica(self.replica)) as reader:
+                before = self.goods(reader)
+                self.write(50, seed=1)
+                self.assertIsNotNone(publisher.publish_if_changed())
+                self.assertEqual(self.goods(reader), before)
+            with closing(snapshot.open_replica(self.replica)) as reader:
+                self.assertEqual(self.goods(reader), self.goods(self.conn))
+        self.assertEqual(publisher.published, 2)
+
+    def test_snapshots_are_published_after_every_n_batches(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = os.path.join(data_dir, "goods.json")
+            datagen.write_goods(path, list(datagen.generate_goods(100, update_share=0.0)), "ndjson")
+            for started in (False, True):
+                publisher = snapshot.SnapshotPublisher(self.db_path, self.replica, every_batches=3)
+                if started:
+                    publisher.start()
+                with publisher:
+                    report = main.ingest_files(self.conn, [path], VALIDATION_SCHEMA, batch_size=10, publisher=publisher)
+                    deadline = time.monotonic() + 5
+                    while started and publisher.published < 3 and time.monotonic() < deadline:
+                        time.sleep(0.01)
+                    published = publisher.published
+                self.assertEqual(report.batches, 10)
+                if started:
+                    self.assertGreaterEqual(published, 1, msg="background thread")
+                else:
+                    self.assertEqual(published, 3)
+                with closing(snapshot.open_replica(self.replica)) as reader:
+                    self.assertEqual(self.goods(reader), self.goods(self.conn))
+                self.conn.execute("DELETE FROM goods")
+                self.conn.commit()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constant_test_cases import VALIDATION_SCHEMA
+import main
+import watcher
+
+
+GOOD = {
+    "id": 1,
+    "name": "Холодильник",
+    "package_params": {"width": 120, "height": 270},
+    "location_and_quantity": [{"location": "Магазин на Ленина", "amount": 5}],
+}
+
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.spool = os.path.join(self.tmp_dir.name, "spool")
+        os.mkdir(self.spool)
+        self.conn = main.connect(os.path.join(self.tmp_dir.name, "goods.db"), check_same_thread=False)
+        main.create_tables_in_db(self.conn.cursor())
+        self.watcher = watcher.Watcher(self.conn, self.spool, VALIDATION_SCHEMA)
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp_dir.cleanup()
+
+    def drop(self, name, content, mtime=None):
+        path = os.path.join(self.spool, name)
+        with open(path + ".part", 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.rename(path + ".part", path)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def names(self):
+        return dict(self.conn.execute("SELECT id, name FROM goods").fetchall())
+
+    def test_files_are_claimed_in_order_of_arrival(self):
+        self.drop("b.json", json.dumps(GOOD), mtime=1000)
+        self.drop("a.json", json.dumps(GOOD), mtime=2000)
+        with open(os.path.join(self.spool, "c.json.part"), 'w', encoding='utf-8') as f:
+            f.write("{")
+        claimed = self.watcher.claim()
+        self.assertEqual([os.path.basename(path).split("-", 2)[2] for path in claimed], ["b.json", "a.json"])
+        self.assertEqual(sorted(os.listdir(self.watcher.processing_dir)), sorted(map(os.path.basename, claimed)))
+        self.assertEqual(self.watcher.claim(), [])
+
+    def test_pickup_is_archived_and_unreadable_files_go_to_errors(self):
+        self.drop("first.json", json.dumps(GOOD), mtime=1000)
+        self.drop("broken.json", '{"id": ', mtime=2000)
+        self.drop("second.json", json.dumps([dict(GOOD, name="Морозильник"), dict(GOOD, id=2)]), mtime=3000)
+        pickup = self.watcher.ingest(self.watcher.claim())
+        self.assertEqual((len(pickup.files), len(pickup.failed), pickup.report.batches), (3, 1, 1))
+        self.assertEqual(self.names(), {1: "Морозильник", 2: "Холодильник"})
+        self.assertEqual(os.listdir(self.watcher.processing_dir), [])
+        self.assertEqual(len(os.listdir(self.watcher.archive_dir)), 2)
+        self.assertTrue(os.listdir(self.watcher.error_dir)[0].endswith("broken.json"))
+
+    def test_second_watcher_leaves_files_of_a_live_one(self):
+        self.drop("first.json", json.dumps(GOOD))
+        claimed = self.watcher.claim()
+        second = watcher.Watcher(self.conn, self.spool, VALIDATION_SCHEMA)
+        self.assertEqual(second.unfinished(), [])
+        stop = threading.Event()
+        stop.set()
+        second.run(watcher.PollingWaiter(0.01), stop)
+        self.assertEqual(os.listdir(self.watcher.processing_dir), [os.path.basename(claimed[0])])
+        pickup = self.watcher.ingest(claimed)
+        self.assertEqual((pickup.failed, self.names()), ([], {1: "Холодильник"}))
+        self.assertEqual(len(os.listdir(self.watcher.archive_dir)), 1)
+
+    def test_files_of_other_processes_are_recovered_once_they_exit(self):
+        process = subprocess.Popen([sys.executable, "-c", "import sys; sys.stdin.read()"], stdin=subprocess.PIPE)
+        path = os.path.join(self.watcher.processing_dir, f"{time.time_ns():020d}-{process.pid}-left.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(GOOD, f)
+        try:
+            self.assertEqual(self.watcher.unfinished(), [])
+        finally:
+            process.communicate(b"")
+        self.assertEqual(self.watcher.unfinished(), [path])
+        self.assertEqual(self.watcher.unfinished(), [], msg="taken by the first call")
+
+    def test_files_of_a_failed_pickup_are_recovered_by_the_same_watcher(self):
+        self.drop("first.json", json.dumps(GOOD))
+        claimed = self.watcher.claim()
+        self.conn.execute("DROP TABLE goods")
+        with self.assertRaises(sqlite3.Error):
+            self.watcher.ingest(claimed)
+        self.assertEqual(self.watcher.unfinished(), claimed)
+
+    def test_running_watcher_commits_new_files_soon(self):
+        for waiter in (watcher.open_waiter(self.spool), watcher.PollingWaiter(0.01)):
+            with open(os.path.join(self.watcher.processing_dir, "0-0-left.json"), 'w', encoding='utf-8') as f:
+                json.dump(dict(GOOD, id=3), f)
+            stop = threading.Event()
+            pickups = []
+            thread = threading.Thread(target=self.watcher.run, args=(waiter, stop, pickups.append))
+            thread.start()
+            try:
+                for good_id in range(10, 15):
+                    self.drop(f"good-{good_id}.json", json.dumps(dict(GOOD, id=good_id)))
+                deadline = time.monotonic() + 5
+                while len(self.names()) < 6 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            finally:
+                stop.set()
+                thread.join()
+                waiter.close()
+            self.assertEqual(set(self.names()), {3, 10, 11, 12, 13, 14}, msg=type(waiter).__name__)
+            self.assertLess(max(pickup.latency for pickup in pickups), 1.0)
+            self.conn.execute("DELETE FROM goods")
+            self.conn.commit()
+
+
+if __name__ == "__main__":
+    unittest.main()
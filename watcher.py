@@ -0,0 +1,366 @@
+"""Daemon loading goods files dropped into a spool directory.
+
+Producers write a file under a temporary name and rename it to a *.json name in the spool
+directory when it's complete. The watcher claims files by renaming them into the processing
+directory, so several watchers may share a spool and no file is read twice. Files claimed
+together are ingested by main.ingest_files as one stream of documents, files that arrive
+close together share transactions. Once the data is committed, files are moved to the archive
+directory, files that couldn't be read or parsed are moved to the error directory. Invalid
+goods of a readable file are rejected as by main.py and the file is archived.
+
+New files are noticed by inotify where the C library provides it and by listing the spool
+with os.scandir every poll interval elsewhere. Files left in the processing directory by
+a killed watcher are ingested again first thing at start, writes of goods are idempotent.
+Names of claimed files hold the id of the claiming process, files of processes which are still
+running are left to them, so a watcher starting next to a live one doesn't take its files.
+
+Usage: python watcher.py --db goods.db spool
+"""
+import argparse
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import signal
+import sys
+import threading
+import time
+from contextlib import closing, nullcontext
+from dataclasses import dataclass, field
+from sqlite3.dbapi2 import Connection
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Set
+
+import main
+import rejections
+
+DEFAULT_POLL_INTERVAL = 0.1
+DEFAULT_RESCAN_INTERVAL = 1.0
+DEFAULT_MAX_FILES = 1000
+
+# inotify(7) constants of Linux.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+_CLAIMED_NAME = re.compile(r"\d+-(\d+)-")
+
+# Claimed files which watchers of this process are processing, see Watcher.unfinished.
+_processing: Set[str] = set()
+_processing_lock = threading.Lock()
+
+
+class PollingWaiter:
+    """Waits for new files by sleeping for the poll interval, the spool is listed after every wait."""
+
+    def __init__(self, poll_interval: float = DEFAULT_POLL_INTERVAL) -> None:
+        """Create a waiter sleeping poll_interval seconds."""
+        self.poll_interval = poll_interval
+
+    def wait(self, stop: threading.Event) -> None:
+        """Sleep until the next poll or until stop is set."""
+        stop.wait(self.poll_interval)
+
+    def close(self) -> None:
+        """Nothing to release."""
+
+
+class InotifyWaiter:
+    """Waits for files closed after writing or moved into a directory, using inotify via ctypes.
+
+    Events only wake the watcher up, files are found by listing the spool, so a lost event or
+    an overflowed queue delays a file by rescan_interval at most.
+    """
+
+    def __init__(self, directory: str, libc: Any, rescan_interval: float = DEFAULT_RESCAN_INTERVAL) -> None:
+        """Start watching directory, raises OSError if inotify can't be used."""
+        self.rescan_interval = rescan_interval
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), directory)
+
+    def wait(self, stop: threading.Event) -> None:
+        """Wait for events of the directory and drain them, at most for the rescan interval."""
+        ready, _, _ = select.select([self.fd], [], [], self.rescan_interval)
+        if not ready:
+            return
+        while True:
+            try:
+                os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+    def close(self) -> None:
+        """Stop watching."""
+        os.close(self.fd)
+
+
+def _inotify_libc() -> Optional[Any]:
+    """Return the C library if it provides inotify functions, None otherwise."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def _process_is_running(pid: int) -> bool:
+    """Return whether a process exists, it's assumed it doesn't where kill(pid, 0) isn't available."""
+    if pid <= 0 or os.name != "posix":
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, but belongs to another user
+    return True
+
+
+def open_waiter(directory: str, poll_interval: float = DEFAULT_POLL_INTERVAL, use_inotify: bool = True) -> Any:
+    """Return InotifyWaiter for directory if inotify is available, PollingWaiter otherwise."""
+    libc = _inotify_libc() if use_inotify else None
+    if libc is not None:
+        try:
+            return InotifyWaiter(directory, libc)
+        except OSError as err:
+            print(f"inotify недоступен ({err}), каталог будет опрашиваться каждые {poll_interval} с")
+    return PollingWaiter(poll_interval)
+
+
+@dataclass
+class Pickup:
+    """Files ingested together and the outcome of their ingestion."""
+
+    files: List[str]
+    failed: List[str] = field(default_factory=list)
+    report: main.IngestReport = field(default_factory=main.IngestReport)
+    latency: float = 0.0  # seconds from the earliest modification of the files to the commit of their data
+
+    def __str__(self) -> str:
+        return (
+            f"Файлов: {len(self.files)}, с ошибками: {len(self.failed)}, задержка: {self.latency:.3f} с. "
+            f"{self.report}"
+        )
+
+
+class Watcher:
+    """Claims files of a spool directory, ingests them and moves them to archive or error directory.
+
+    Processing, archive and error directories are spool subdirectories by default, they must be
+    on the same file system as the spool so that files are moved by renaming.
+    """
+
+    def __init__(
+        self,
+        conn: Connection,
+        spool: str,
+        schema: dict,
+        batch_size: int = main.DEFAULT_BATCH_SIZE,
+        max_files: int = DEFAULT_MAX_FILES,
+        processing_dir: Optional[str] = None,
+        archive_dir: Optional[str] = None,
+        error_dir: Optional[str] = None,
+        change_detector: Optional[main.ChangeDetector] = None,
+        sink: Optional[rejections.RejectionSink] = None,
+    ) -> None:
+        """Create missing directories, tables of conn must already exist."""
+        self.conn = conn
+        self.spool = spool
+        self.schema = schema
+        self.batch_size = batch_size
+        self.max_files = max_files
+        self.processing_dir = processing_dir or os.path.join(spool, "processing")
+        self.archive_dir = archive_dir or os.path.join(spool, "archive")
+        self.error_dir = error_dir or os.path.join(spool, "error")
+        self.change_detector = change_detector
+        self.sink = sink
+        for directory in (self.processing_dir, self.archive_dir, self.error_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    def claim(self) -> List[str]:
+        """Move up to max_files files from the spool to the processing directory in the order of their arrival.
+
+        Claimed names are prefixed by the claim time and the process id, so a name reused by
+        a producer doesn't overwrite a file still being processed or archived.
+
+        Returns:
+            Paths of claimed files in the processing directory.
+        """
+        arrived = []
+        with os.scandir(self.spool) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and not entry.name.startswith(".") and entry.is_file():
+                    try:
+                        arrived.append((entry.stat().st_mtime_ns, entry.name))
+                    except FileNotFoundError:
+                        continue  # claimed by another watcher
+        claimed = []
+        for _, name in sorted(arrived)[: self.max_files]:
+            path = os.path.join(self.processing_dir, f"{time.time_ns():020d}-{os.getpid()}-{name}")
+            with _processing_lock:
+                try:
+                    os.rename(os.path.join(self.spool, name), path)
+                except FileNotFoundError:
+                    continue  # claimed by another watcher
+                _processing.add(path)
+            claimed.append(path)
+        return claimed
+
+    def unfinished(self) -> List[str]:
+        """Return files left in the processing directory by a watcher killed before moving them.
+
+        Files claimed by another running process or being processed by another watcher of this
+        process are skipped. A file of a killed watcher whose process id is already reused by a
+        running process waits until that process exits.
+        """
+        with _processing_lock, os.scandir(self.processing_dir) as entries:
+            unfinished = []
+            for entry in entries:
+                match = _CLAIMED_NAME.match(entry.name)
+                pid = int(match.group(1)) if match else 0
+                if not entry.is_file() or entry.path in _processing:
+                    continue
+                if pid != os.getpid() and _process_is_running(pid):
+                    continue
+                _processing.add(entry.path)
+                unfinished.append(entry.path)
+        return sorted(unfinished)
+
+    def ingest(self, files: List[str]) -> Pickup:
+        """Ingest claimed files in one stream of documents, then move them out of the processing directory."""
+        pickup = Pickup(files)
+        failed: Set[str] = set()
+
+        def read_documents(json_file: str) -> Iterator[Any]:
+            try:
+                yield from main.iter_json_documents(json_file)
+            except (OSError, ValueError):
+                failed.add(json_file)
+                raise
+
+        try:
+            arrived = min((os.stat(path).st_mtime for path in files), default=time.time())
+            pickup.report = main.ingest_files(
+                self.conn, files, self.schema, self.batch_size, self.change_detector, self.sink, read_documents
+            )
+            pickup.latency = time.time() - arrived
+            for path in files:
+                directory = self.error_dir if path in failed else self.archive_dir
+                os.replace(path, os.path.join(directory, os.path.basename(path)))
+        finally:
+            with _processing_lock:  # files left by a failure are recovered by unfinished
+                _processing.difference_update(files)
+        pickup.failed = [path for path in files if path in failed]
+        return pickup
+
+    def run(
+        self,
+        waiter: Any,
+        stop: Optional[threading.Event] = None,
+        on_pickup: Callable[[Pickup], None] = print,
+    ) -> None:
+        """Ingest files until stop is set, waiting with waiter while the spool is empty.
+
+        A pickup is taken right after the previous one, so files arriving while a pickup is
+        ingested are grouped into the next one. Database errors stop the watcher, claimed files
+        stay in the processing directory until the next start.
+        """
+        stop = stop or threading.Event()
+        files = self.unfinished()
+        while not stop.is_set():
+            files = files or self.claim()
+            if files:
+                on_pickup(self.ingest(files))
+                files = []
+            else:
+                waiter.wait(stop)
+
+
+def main_watcher(argv: Optional[Sequence[str]] = None) -> int:
+    """Run the watcher from command line until it's interrupted or terminated."""
+    parser = argparse.ArgumentParser(description="Load goods files dropped into a spool directory.")
+    parser.add_argument("spool", help="directory producers put *.json files into")
+    parser.add_argument("--db", default="goods.db", help="path to SQLite database (default: goods.db)")
+    parser.add_argument(
+        "--schema", default="goods.schema.json", help="path to JSON schema of goods (default: goods.schema.json)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=main.DEFAULT_BATCH_SIZE,
+        help=f"goods committed in one transaction (default: {main.DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--max-files",
+        type=int,
+        default=DEFAULT_MAX_FILES,
+        help=f"files claimed at once (default: {DEFAULT_MAX_FILES})",
+    )
+    parser.add_argument("--archive-dir", help="directory of ingested files (default: SPOOL/archive)")
+    parser.add_argument("--error-dir", help="directory of unreadable files (default: SPOOL/error)")
+    parser.add_argument("--processing-dir", help="directory of claimed files (default: SPOOL/processing)")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help=f"seconds between listings of the spool without inotify (default: {DEFAULT_POLL_INTERVAL})",
+    )
+    parser.add_argument("--no-inotify", action="store_true", help="poll the spool even if inotify is available")
+    parser.add_argument(
+        "--profile",
+        choices=sorted(main.CONNECTION_PROFILES),
+        default=main.DEFAULT_CONNECTION_PROFILE,
+        help=f"SQLite connection settings (default: {main.DEFAULT_CONNECTION_PROFILE})",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="keep fingerprints of written rows and don't rewrite rows which haven't changed",
+    )
+    parser.add_argument("--rejections", help="append invalid goods with their errors to this NDJSON file")
+    args = parser.parse_args(argv)
+
+    stop = threading.Event()
+
+    def request_stop(*_: object) -> None:
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    sink = rejections.RejectionSink(args.rejections) if args.rejections else None
+    waiter = open_waiter(args.spool, args.poll_interval, not args.no_inotify)
+    with closing(main.connect(args.db, args.profile)) as conn, closing(waiter), sink or nullcontext():
+        main.create_tables_in_db(conn.cursor())
+        change_detector = main.ChangeDetector(conn.cursor()) if args.skip_unchanged else None
+        watcher = Watcher(
+            conn,
+            args.spool,
+            main.read_json(args.schema),
+            args.batch_size,
+            args.max_files,
+            args.processing_dir,
+            args.archive_dir,
+            args.error_dir,
+            change_detector,
+            sink,
+        )
+        print(f"Ожидание файлов в {args.spool} ({type(waiter).__name__})")
+        watcher.run(waiter, stop)
+    if sink is not None:
+        print(sink.summary())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_watcher())